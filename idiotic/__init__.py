@@ -9,8 +9,9 @@ from werkzeug.wsgi import DispatcherMiddleware
 from .utils import AttrDict, TaggedDict, mangle_name, join_url, _APIWrapper, IdioticEncoder
 from .dispatch import Dispatcher
 from .version import VERSION
+from . import event, history
 
-__all__ = ['declare', 'dispatch', 'event', 'history', 'item', 'modutils', 'persistence', 'rule', 'scene', 'timer', 'version', 'distrib', 'utils']
+__all__ = ['declare', 'dispatch', 'event', 'history', 'item', 'modutils', 'persistence', 'rule', 'scene', 'sketch', 'timer', 'version', 'distrib', 'utils']
 
 LOG = logging.getLogger("idiotic.init")
 
@@ -22,8 +23,16 @@ def __sched_job_do_now(self, func, *args, **kwargs):
     func(*args, **kwargs)
     self.do(func, *args, **kwargs)
 
+def __sched_job_unique(self, key=None):
+    # Only one node in the cluster will run this job. Nodes must agree
+    # on the key, so it defaults to one derived from the job function
+    self.cluster_unique = True
+    self.cluster_key = key
+    return self
+
 schedule.Job.do_once = __sched_job_do_once
 schedule.Job.do_now = __sched_job_do_now
+schedule.Job.unique = __sched_job_unique
 
 instance = None
 
@@ -64,6 +73,8 @@ class Idiotic:
         self.persist_instance = None
         self.distribution = None
         self.distrib_thread = None
+        self.cluster = None
+        self._loop = None
         self._root_api = Flask(__name__)
         self._root_api.json_encoder = IdioticEncoder
         self._apis = {}
@@ -76,6 +87,14 @@ class Idiotic:
                 runnable_jobs = sorted((job for job in self.scheduler.jobs if job.should_run))
                 if len(runnable_jobs):
                     for job in runnable_jobs:
+                        if getattr(job, "cluster_unique", False) and \
+                           self.cluster and not self.cluster.owns(job):
+                            # Another node owns this one, so just wait
+                            # for its next run in case that changes
+                            job.last_run = datetime.datetime.now()
+                            job._schedule_next_run()
+                            continue
+
                         # i'm sorry this is kind of terrible
                         # but dammit, it works
                         ret = yield from asyncio.coroutine(job.job_func)()
@@ -169,49 +188,98 @@ class Idiotic:
 
     def _recv_event(self, evt):
         LOG.debug("_recv_event!")
-        self.dispatcher.dispatch(event.unpack_event(evt, self.modules))
+        # This is called from the transport's thread
+        self._loop.call_soon_threadsafe(self.dispatcher.dispatch,
+                                        event.unpack_event(evt, self.modules))
 
     def _start_distrib(self, dist, host, conf):
         try:
             dist_cls = distrib_types[dist]
         except NameError as e:
             raise NameError("Could not find distribution method {}".format(dist), e)
+        self._loop = asyncio.get_event_loop()
         self.distribution = dist_cls(host, conf)
         self.distribution.connect()
 
-        self.dispatcher.bind(_send_event, utils.Filter(not_hasattr='_remote'))
-        self.distribution.receive(_recv_event)
+        self.dispatcher.bind(self._send_event, utils.Filter(not_hasattr='_remote'))
+        self.distribution.receive(self._recv_event)
+
+        self.distrib_thread = threading.Thread(target=self.distribution.run, daemon=True)
+        self.distrib_thread.start()
 
-        thread = threading.Thread(target=self.distribution.run, daemon=True)
-        thread.start()
+        from .distrib.cluster import Cluster
+        self.cluster = Cluster(self, host, conf)
+        self.cluster.start()
 
     def _stop_distrib(self):
+        if self.cluster:
+            self.cluster.leave()
+
         if self.distribution:
+            self.distribution.stop()
             self.distribution.disconnect()
 
         if self.distrib_thread:
             self.distrib_thread.join()
 
+    def _start_history(self, conf):
+        history.manager.configure(conf.get("budget"), conf.get("policies"),
+                                  conf.get("default", "evict"), conf.get("min_entries", 1))
+
+        if history.manager.budget is not None:
+            self.scheduler.every(conf.get("interval", 60)).seconds.do(history.manager.enforce)
+
     def _record_state_change(self, evt):
         if evt and evt.item:
-            self.persist_instance.append_item_history(evt.item, evt.time, evt.new, kind="state")
+            self.persist_instance.append_nowait(evt.item, evt.time, evt.new, kind="state")
 
     def _start_persistence(self, persist, conf):
+        from .persistence import AsyncPersistence
+
         persist_cls = persist_types[persist]
-        self.persist_instance = persist_cls(conf)
-        self.persist_instance.connect()
+        self.persist_instance = AsyncPersistence(persist_cls, conf, conf.get("max_queue", 10000))
+        self.persist_instance.start()
+        engine = self.persist_instance.engine
+
         self.dispatcher.bind(self._record_state_change, utils.Filter(type=event.StateChangeEvent, kind="after"))
 
-        for item in self.items.all():
-            history = list(self.persist_instance.get_item_history(item))
-            if len(history):
-                item._state = history[-1][0]
+        # Appends are buffered, so write them out even when things are quiet
+        self.scheduler.every(engine.flush_interval).seconds.do(self.persist_instance.flush)
+
+        if engine.purge_interval:
+            self.scheduler.every(engine.purge_interval).seconds.do(
+                lambda: self.persist_instance.purge(self.items.all()))
+
+        # Startup should take time in proportion to the number of items,
+        # not the size of the database, so only the latest state of each
+        # and 'warmup' seconds of history are loaded
+        items = list(self.items.all())
+        last = self.persist_instance.call(engine.get_last_states, items)
+
+        warmup = conf.get("warmup", 24 * 60 * 60)
+        if warmup:
+            since = datetime.datetime.now() - datetime.timedelta(seconds=warmup)
+            recent = self.persist_instance.call(engine.get_recent_history, items, since)
+            commands = self.persist_instance.call(
+                engine.get_recent_history, items, since, kind="command")
+        else:
+            recent = commands = {}
+
+        for item in items:
+            if item in commands and hasattr(item, "command_history"):
+                item.command_history.extend((ts, name) for name, ts in commands[item])
+
+            if item not in last:
+                continue
+
+            value, ts = last[item]
+            item._state = value
+            item._changed()
 
             if hasattr(item, "state_history"):
-                for state in history:
-                    item.state_history.record(*state)
+                entries = recent.get(item) or [(value, ts)]
+                item.state_history.extend((when, state) for state, when in entries)
 
     def _stop_persistence(self):
         if self.persist_instance:
-            self.persist_instance.sync()
-            self.persist_instance.disconnect()
+            self.persist_instance.stop()
@@ -134,6 +134,9 @@ def init():
     for module in instance.modules.all(lambda m:hasattr(m, "ready")):
         module.ready()
 
+    if "history" in config:
+        instance._start_history(config["history"])
+
     # correspond with other instances?
     if "distribution" in config and config["distribution"]:
         LOG.info("Initializing distribution system...")
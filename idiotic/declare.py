@@ -39,8 +39,9 @@ class Condition:
     @property
     def state(self):
         if not self.__set:
-            self.recalculate()
+            # Set this first, since recalculating may read the state
             self.__set = True
+            self.recalculate()
 
         return self.__state
 
@@ -303,7 +304,7 @@ class ItemLambdaCondition(Condition):
     def __str__(self):
         return "ItemLambdaCondition on {}".format(len(self.items) + " items" if len(self.items) > 1 else self.items[0])
 
-class ChangedSinceCondition(Condition):
+class ChangedSinceCondition(ItemLambdaCondition):
     def __init__(self, item, since, **kwargs):
         self.item = item
         self.since = since
@@ -354,6 +355,67 @@ class CommandReceivedCondition(ItemLambdaCondition):
     def __str__(self):
         return "CommandReceivedCondition for {}, commands={}".format(self.item, "any" if self.commands is None else self.commands) + ("within {} seconds".format(self.since) if self.since else "")
 
+class HistoryCondition(ItemLambdaCondition):
+    def __init__(self, item, aggregate, *args, time=None, age=None, **kwargs):
+        """A condition whose value is an aggregate of an item's state history
+over a window of time, which can then be compared like any other.
+
+        Arguments:
+        item      -- The item whose state history to use.
+        aggregate -- The name of a History aggregate, such as "mean",
+                     "integral", "minimum", "maximum", "rate", or
+                     "percent_in_state". Any other arguments are
+                     passed along to it.
+
+        Keyword arguments:
+        time      -- When the window starts, or a function returning
+                     that, for windows like "since midnight".
+        age       -- How many seconds ago the window starts.
+
+        Example:
+            Rule(HistoryCondition(c.items.power, "mean", age=600,
+                                  recalculate_delay=30) > 1500,
+                 yes=c.items.dryer.off)
+        """
+        self.item = item
+        self.aggregate = aggregate
+        self.age = age
+
+        super().__init__(lambda i: getattr(i.state_history, aggregate)(*args, time=time, age=age),
+                         item, **kwargs)
+
+    def __str__(self):
+        return "HistoryCondition {} of {}".format(self.aggregate, self.item) + (" over {} seconds".format(self.age) if self.age else "")
+
+class SketchCondition(ItemLambdaCondition):
+    def __init__(self, item, aggregate, *args, sketch="state", **kwargs):
+        """A condition whose value is an estimate from one of an item's
+sketches, over the window it was created with. The item must have been
+given sketches.
+
+        Arguments:
+        item      -- The item whose sketch to use.
+        aggregate -- "quantile", "rank" or "distinct". Any other
+                     arguments are passed along to it.
+
+        Keyword arguments:
+        sketch    -- "state" for the item's states, or "command" for
+                     how long its commands take to run.
+
+        Example:
+            Rule(SketchCondition(c.items.power, "quantile", .95) > 3000,
+                 yes=c.items.alarm.on)
+        """
+        self.item = item
+        self.aggregate = aggregate
+        self.sketch = sketch
+
+        super().__init__(lambda i: getattr(getattr(i, sketch + "_sketch"), aggregate)(*args),
+                         item, **kwargs)
+
+    def __str__(self):
+        return "SketchCondition {} of {} {}".format(self.aggregate, self.item, self.sketch)
+
 class StateBetweenCondition(ItemLambdaCondition):
     def __init__(self, item, min=-2147483648, max=2147483647, **kwargs):
         super().__init__(lambda i: min < i.state < max, item, **kwargs)
@@ -1,4 +1,6 @@
 from . import udp
 from . import base
+from . import cluster
+from . import loopback
 
-__ALL__ = [base, udp]
+__ALL__ = [base, udp, cluster, loopback]
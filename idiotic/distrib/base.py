@@ -88,3 +88,19 @@ or discovered neighbors as needed.
         node.
 
         """
+
+    def stats(self):
+        """Return counters for the packets and bytes this transport has sent
+and received.
+
+        """
+        return {k: getattr(self, k, 0) for k in ("packets_sent", "bytes_sent",
+                                                 "packets_received", "bytes_received")}
+
+    def _count_sent(self, data):
+        self.packets_sent = getattr(self, "packets_sent", 0) + 1
+        self.bytes_sent = getattr(self, "bytes_sent", 0) + len(data)
+
+    def _count_received(self, data):
+        self.packets_received = getattr(self, "packets_received", 0) + 1
+        self.bytes_received = getattr(self, "bytes_received", 0) + len(data)
@@ -0,0 +1,118 @@
+import functools
+import hashlib
+import logging
+import time
+from idiotic import event, utils
+
+LOG = logging.getLogger("idiotic.distrib.cluster")
+
+def job_key(job):
+    """Return the name all nodes use to refer to a scheduled job. This is
+the key given to Job.unique(), or else one built from the job's function
+and interval, since those come from the same config on every node.
+
+    """
+    key = getattr(job, "cluster_key", None)
+    if key:
+        return key
+
+    func = job.job_func
+    while isinstance(func, functools.partial):
+        func = func.func
+
+    return "{}.{}:{}{}".format(getattr(func, "__module__", None),
+                               getattr(func, "__qualname__", repr(func)),
+                               job.interval, job.unit)
+
+class Cluster:
+    """Keeps track of which nodes are alive, using heartbeats sent over the
+distribution layer, and decides which one of them owns each
+cluster-unique job.
+
+Ownership is decided by rendezvous hashing over the live nodes, so every
+node picks the same owner without any extra messages, and only the jobs
+belonging to a node which stops sending heartbeats will move.
+
+A node does not know who else is alive until it has heard their
+heartbeats, so it claims no jobs until one 'heartbeat_timeout' after
+start(); otherwise a job due in that time would run twice.
+
+    """
+    def __init__(self, context, name, config=None):
+        config = config or {}
+
+        self.context = context
+        self.name = name
+
+        #: How often, in seconds, to announce that this node is alive
+        self.interval = config.get("heartbeat", 5)
+
+        #: How long, in seconds, before a silent node is considered dead
+        #: and its jobs are handed off
+        self.timeout = config.get("heartbeat_timeout", self.interval * 3)
+
+        self.__last_seen = {}
+        self.__started = None
+        self.job = None
+
+    def start(self):
+        self.__started = time.monotonic()
+        self.context.dispatcher.bind(self._heartbeat_received,
+                                     utils.Filter(type=event.HeartbeatEvent))
+        self.job = self.context.scheduler.every(self.interval).seconds
+        self.job.do_now(self.heartbeat)
+
+    def heartbeat(self):
+        self.context.dispatcher.dispatch(event.HeartbeatEvent(self.name))
+
+    def leave(self):
+        """Tell the other nodes that we are going away, so they can take over
+our jobs immediately instead of waiting for the timeout.
+
+        """
+        if self.job:
+            self.context.scheduler.cancel_job(self.job)
+            self.job = None
+
+        try:
+            self.context.distribution.send(
+                event.pack_event(event.HeartbeatEvent(self.name, leaving=True)))
+        except OSError:
+            LOG.warning("Unable to announce departure from cluster")
+
+    def _heartbeat_received(self, evt):
+        if evt.node == self.name:
+            return
+
+        if evt.leaving:
+            LOG.info("Node {} left the cluster".format(evt.node))
+            self.__last_seen.pop(evt.node, None)
+        else:
+            if evt.node not in self.__last_seen:
+                LOG.info("Node {} joined the cluster".format(evt.node))
+            self.__last_seen[evt.node] = time.monotonic()
+
+    def nodes(self):
+        """Return the names of all nodes, including this one, which are
+currently considered alive.
+
+        """
+        cutoff = time.monotonic() - self.timeout
+        for node, seen in list(self.__last_seen.items()):
+            if seen < cutoff:
+                LOG.warning("Node {} timed out; taking over its jobs".format(node))
+                del self.__last_seen[node]
+
+        return [self.name] + list(self.__last_seen)
+
+    def owner(self, key):
+        # hash() is randomized per process, so it can't be used here
+        return max(self.nodes(), key=lambda node: hashlib.sha1(
+            "{}/{}".format(node, key).encode('UTF-8')).digest())
+
+    def settled(self):
+        """Return whether every live node should have been heard from."""
+        return self.__started is None or time.monotonic() - self.__started >= self.timeout
+
+    def owns(self, job):
+        return self.settled() and self.owner(job_key(job)) == self.name
@@ -0,0 +1,218 @@
+"""Simulate a cluster of idiotic nodes on one machine and measure how
+events propagate between them.
+
+Usage:
+  harness.py --help
+  harness.py [--nodes=<n>] [--items=<n>] [--rate=<n>] [--duration=<s>] [--port=<port>] [--processes] [--method=<name>]...
+
+Options:
+  -h --help           Show this text.
+  -n --nodes=<n>      Number of nodes to start [default: 3].
+  -i --items=<n>      Number of items on each node [default: 10].
+  -r --rate=<n>       State changes per second, across all nodes [default: 200].
+  -d --duration=<s>   How long to generate traffic, in seconds [default: 10].
+  -P --port=<port>    First port to use for methods that need one [default: 28400].
+  -p --processes      Run every node in its own process. Not every method
+                      can work between processes.
+  -m --method=<name>  A transport method to benchmark. May be given more
+                      than once [default: loopback udp].
+"""
+
+import multiprocessing
+import asyncio
+import logging
+import random
+import time
+import idiotic
+from idiotic import event, item, utils
+
+LOG = logging.getLogger("idiotic.distrib.harness")
+
+# Wait this long after traffic stops for the last events to arrive
+DRAIN_TIME = 2
+
+def node_name(index):
+    return "node{}".format(index)
+
+def node_config(method, index, count, port):
+    """Return a distribution config which lets node 'index' of 'count' talk to
+all of the others without leaving the machine.
+
+    """
+    if method == "udp":
+        return {
+            "method": method,
+            "listen": "127.0.0.1",
+            "port": port + index,
+            "broadcast": False,
+            "connect": [{"name": node_name(i), "host": "127.0.0.1", "port": port + i}
+                        for i in range(count) if i != index],
+        }
+    else:
+        return {"method": method, "bus": "harness"}
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+class Recorder:
+    """Collects the propagation latency of every state change which arrives
+from another node.
+
+    """
+    def __init__(self):
+        self.latencies = []
+        self.last = None
+
+    def __call__(self, evt):
+        # The sender's time arrives as a timestamp; every node shares
+        # the same clock here, so there is no skew to worry about
+        self.last = time.time()
+        self.latencies.append(self.last - evt.time)
+
+def start_node(method, index, count, items, port, recorder):
+    name = node_name(index)
+    node = idiotic.Idiotic({}, name)
+
+    # Items register with whichever instance is current
+    idiotic.instance = node
+
+    node._start_distrib(method, name, node_config(method, index, count, port))
+    node.dispatcher.bind(recorder, utils.Filter(
+        type=event.StateChangeEvent, kind="after", hasattr="_remote"))
+
+    node.sim_items = [item.Number("{} sensor {}".format(name, i)) for i in range(items)]
+    return node
+
+@asyncio.coroutine
+def generate(items, rate, duration):
+    """Change the state of the given items, round-robin, 'rate' times per
+second for 'duration' seconds. Returns the number of changes made.
+
+    """
+    count = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        due = int((time.monotonic() - start) * rate)
+        while count < due:
+            items[count % len(items)].state = random.random()
+            count += 1
+        yield from asyncio.sleep(.001)
+    return count
+
+def run_nodes(nodes, items, rate, duration):
+    loop = asyncio.get_event_loop()
+    runners = [asyncio.ensure_future(n.dispatcher.run()) for n in nodes]
+
+    start = time.time()
+    changes = loop.run_until_complete(generate(items, rate, duration))
+    loop.run_until_complete(asyncio.sleep(DRAIN_TIME))
+
+    for runner in runners:
+        runner.cancel()
+
+    stats = [n.distribution.stats() for n in nodes]
+
+    for node in nodes:
+        node._stop_distrib()
+
+    return start, changes, stats
+
+def run_in_process(method, count, items, rate, duration, port):
+    recorder = Recorder()
+    nodes = [start_node(method, i, count, items, port, recorder) for i in range(count)]
+    start, changes, stats = run_nodes(nodes, [i for n in nodes for i in n.sim_items],
+                                      rate, duration)
+    return summarize(method, count, start, changes, recorder.latencies, recorder.last, stats)
+
+def _child(method, index, count, items, rate, duration, port, barrier, results):
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    recorder = Recorder()
+    node = start_node(method, index, count, items, port, recorder)
+    barrier.wait()
+
+    start, changes, stats = run_nodes([node], node.sim_items, rate / count, duration)
+    results.put((start, changes, recorder.latencies, recorder.last, stats[0]))
+
+def run_multi_process(method, count, items, rate, duration, port):
+    barrier = multiprocessing.Barrier(count)
+    results = multiprocessing.Queue()
+    children = [multiprocessing.Process(target=_child, args=(
+        method, i, count, items, rate, duration, port, barrier, results))
+                for i in range(count)]
+
+    for child in children:
+        child.start()
+
+    outputs = [results.get() for _ in children]
+
+    for child in children:
+        child.join()
+
+    return summarize(method, count,
+                     min(o[0] for o in outputs),
+                     sum(o[1] for o in outputs),
+                     [l for o in outputs for l in o[2]],
+                     max((o[3] for o in outputs if o[3]), default=None),
+                     [o[4] for o in outputs])
+
+def summarize(method, count, start, changes, latencies, last, stats):
+    totals = {k: sum(s[k] for s in stats) for k in stats[0]}
+    elapsed = (last - start) if last else float('nan')
+
+    return {
+        "method": method,
+        "nodes": count,
+        "changes": changes,
+        "expected": changes * (count - 1),
+        "delivered": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "packets": totals["packets_sent"],
+        "bytes": totals["bytes_sent"],
+        "bytes_per_packet": totals["bytes_sent"] / max(totals["packets_sent"], 1),
+        "bytes_per_change": totals["bytes_sent"] / max(changes, 1),
+    }
+
+def report(result):
+    print("{method}: {nodes} nodes, {changes} state changes".format(**result))
+    print("  delivered      {delivered} of {expected}".format(**result))
+    print("  throughput     {throughput:.1f} events/s".format(**result))
+    print("  latency        p50 {p50:.3f} ms, p99 {p99:.3f} ms".format(**result))
+    print("  packets sent   {packets} ({bytes} bytes)".format(**result))
+    print("  bytes/packet   {bytes_per_packet:.1f}".format(**result))
+    print("  bytes/change   {bytes_per_change:.1f}".format(**result))
+
+def main():
+    import docopt
+    arguments = docopt.docopt(__doc__)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    count = int(arguments["--nodes"])
+    items = int(arguments["--items"])
+    rate = float(arguments["--rate"])
+    duration = float(arguments["--duration"])
+    port = int(arguments["--port"])
+
+    for method in arguments["--method"]:
+        if method not in idiotic.distrib_types:
+            LOG.error("Unknown distribution method {}".format(method))
+            continue
+
+        if arguments["--processes"]:
+            if method == "loopback":
+                LOG.error("The loopback method only works within one process")
+                continue
+            result = run_multi_process(method, count, items, rate, duration, port)
+        else:
+            result = run_in_process(method, count, items, rate, duration, port)
+        report(result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+from . import base
+import threading
+import logging
+import queue
+
+LOG = logging.getLogger("idiotic.distrib.loopback")
+
+# All the transports in this process, by bus name and then hostname
+BUSES = {}
+BUS_LOCK = threading.Lock()
+
+class LoopbackItem(base.RemoteItem):
+    pass
+
+class LoopbackModule(base.RemoteModule):
+    pass
+
+class LoopbackNeighbor(base.Neighbor):
+    def __init__(self, name):
+        self.name = name
+        self.modules = []
+        self.items = []
+
+class LoopbackTransportMethod(base.TransportMethod):
+    """A transport which passes packets between instances in the same
+process. Each one still receives on its own thread, as with a real
+transport, but no network is needed, which makes it useful for tests and
+benchmarks.
+
+    """
+    NEIGHBOR_CLASS = LoopbackNeighbor
+    MODULE_CLASS = LoopbackModule
+    ITEM_CLASS = LoopbackItem
+    NAME = "loopback"
+
+    def __init__(self, hostname, config):
+        self.hostname = hostname
+
+        config = config or {}
+
+        #: Only transports on the same bus will see each other
+        self.bus = config.get("bus", "default")
+        self.incoming = queue.Queue()
+        self.running = False
+
+    def connect(self):
+        with BUS_LOCK:
+            BUSES.setdefault(self.bus, {})[self.hostname] = self
+
+    def disconnect(self):
+        with BUS_LOCK:
+            BUSES.get(self.bus, {}).pop(self.hostname, None)
+
+    def run(self):
+        LOG.info("Starting loopback distribution on bus {}".format(self.bus))
+        self.running = True
+        while self.running:
+            try:
+                data = self.incoming.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            self._count_received(data)
+            for cb in list(getattr(self, "callbacks", ())):
+                try:
+                    cb(data)
+                except:
+                    LOG.exception("Error while handling received event:")
+
+    def stop(self):
+        self.running = False
+
+    def send(self, event, targets=True):
+        LOG.debug("Sending event {} to: {}".format(event, targets))
+        peers = dict(BUSES.get(self.bus, {}))
+
+        if targets is True:
+            targets = [n for n in peers if n != self.hostname]
+
+        for name in targets:
+            if name in peers:
+                peers[name].incoming.put(event)
+                self._count_sent(event)
+
+    def neighbors(self):
+        return [LoopbackNeighbor(n) for n in BUSES.get(self.bus, {})
+                if n != self.hostname]
+
+METHOD = LoopbackTransportMethod
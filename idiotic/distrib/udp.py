@@ -21,6 +21,10 @@ FORMAT = {
 HEADER_FORMAT = "!5sBI"
 HEADER_LEN = struct.calcsize(HEADER_FORMAT)
 
+# Packed items are often bigger than a typical MTU, so accept anything
+# that fits in a single datagram
+MAX_PACKET = 65535
+
 LOG = logging.getLogger("idiotic.distrib.udp")
 
 class UDPItem(base.RemoteItem):
@@ -51,7 +55,11 @@ class UDPTransportMethod(base.TransportMethod):
         self.listen_port = config.get("port", 28300)
         self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.listener.settimeout(5)
-        self.listener.bind(('', self.listen_port))
+        self.listener.bind((config.get("listen", ''), self.listen_port))
+
+        # When broadcast is off, events go to each known neighbor
+        # instead, which also works where there is no broadcast route
+        self.broadcast = config.get("broadcast", True)
 
         self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sender.bind(('', 0))
@@ -107,15 +115,17 @@ class UDPTransportMethod(base.TransportMethod):
     def connect(self):
         for neighbor in self.neighbor_dict.values():
             self._send_discovery(neighbor.host, neighbor.port)
-        self._send_discovery()
+        if self.broadcast:
+            self._send_discovery()
 
     def run(self):
         LOG.info("Starting UDP Distribution client.")
         self.running = True
         while self.running:
             try:
-                data, addr = self.listener.recvfrom(2048)
+                data, addr = self.listener.recvfrom(MAX_PACKET)
                 LOG.debug("Received '{}' from {}".format(data, addr))
+                self._count_received(data)
                 try:
                     kind, tup = self._decode_packet(data)
                 except ValueError:
@@ -159,19 +169,25 @@ class UDPTransportMethod(base.TransportMethod):
 
     def __do_callback(self, event):
         for cb in list(self.callbacks):
-            cb(event)
+            try:
+                cb(event)
+            except:
+                LOG.exception("Error while handling received event:")
 
     def send(self, event, targets=True):
         LOG.debug("Sending event {} to: {}".format(event, targets))
-        if targets is True:
+        if targets is True and self.broadcast:
             targets = [('<broadcast>', self.listen_port)]
+        elif targets is True:
+            targets = [(n.host, n.port) for n in self.neighbor_dict.values()]
         else:
             targets = [(self.neighbor_dict[n].host, self.neighbor_dict[n].port) for n in targets
                        if n in self.neighbor_dict]
 
+        packet = self._encode_packet(EVENT, event)
         for target in targets:
-            self.sender.sendto(self._encode_packet(EVENT, event),
-                               target)
+            self.sender.sendto(packet, target)
+            self._count_sent(packet)
 
     def neighbors(self):
         return list(self.neighbor_dict.values())
@@ -116,6 +116,19 @@ class CommandEvent(BaseEvent):
     def __repr__(self):
         return "CommandEvent({0.kind}, '{0.command}' on {0.item} from {0.source})".format(self)
 
+class HeartbeatEvent(BaseEvent):
+    MODULE = 'idiotic'
+    def __init__(self, node, leaving=False):
+        super().__init__()
+        self.node = node
+        self.leaving = leaving
+
+    def cancel(self):
+        pass
+
+    def __repr__(self):
+        return "HeartbeatEvent({0.node}{1})".format(self, ", leaving" if self.leaving else "")
+
 class SceneEvent(BaseEvent):
     MODULE = 'idiotic'
     def __init__(self, scene, state, kind):
@@ -1,12 +1,211 @@
 import collections
 import datetime
+import numbers
+import operator
+import weakref
+import logging
+import struct
 import bisect
+import array
+import mmap
+import time
+import sys
+import os
+
+try:
+    import numpy
+except ImportError:
+    # Aggregations will fall back to plain Python
+    numpy = None
+
+LOG = logging.getLogger("idiotic.history")
 
 Entry = collections.namedtuple('Entry', ['time', 'state'])
+Bucket = collections.namedtuple('Bucket', ['time', 'min', 'max', 'mean', 'count', 'last'])
+Window = collections.namedtuple('Window', ['times', 'states', 'durations', 'start', 'end'])
+
+#: Rollup resolutions, in seconds, used when rollups=True
+DEFAULT_ROLLUPS = (60, 15 * 60, 60 * 60)
+
+#: How many buckets each rollup keeps by default
+ROLLUP_BUCKETS = 4096
+
+#: How many entries an MMapHistory file holds by default
+MMAP_CAPACITY = 65536
+
+#: How many entries CompressedHistory keeps uncompressed before sealing
+#: them into a block
+BLOCK_SIZE = 256
+
+#: What None is stored as in a NumericHistory of ints
+NULL_INT = -2 ** 63
+
+class HistoryView:
+    """A read-only range of the entries in a History. Nothing is copied until
+the view is iterated or indexed, so taking one is cheap no matter how long
+the history is. A view reflects the positions of entries when it was
+made, so it should not be kept around while its history changes.
+
+    """
+    def __init__(self, history, start, stop, reverse=False):
+        self.history = history
+        self.start = start
+        self.stop = max(start, stop)
+        self.reverse = reverse
+
+    def _range(self):
+        if self.reverse:
+            return range(self.stop - 1, self.start - 1, -1)
+        else:
+            return range(self.start, self.stop)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        for i in self._range():
+            yield self.history._entry(i)
+
+    def __reversed__(self):
+        for i in reversed(self._range()):
+            yield self.history._entry(i)
+
+    def __getitem__(self, pos):
+        r = self._range()[pos]
+        if isinstance(r, int):
+            return self.history._entry(r)
+        elif r.step == 1:
+            return HistoryView(self.history, r.start, r.stop)
+        elif r.step == -1:
+            return HistoryView(self.history, r.stop + 1, r.start + 1, reverse=True)
+        else:
+            return [self.history._entry(i) for i in r]
+
+    def all(self):
+        return list(self)
+
+    def json(self):
+        return self.all()
+
+    def __str__(self):
+        return str(self.all())
+
+    def __repr__(self):
+        return "HistoryView({})".format(self.all())
+
+class Rollup:
+    """A summary of numeric states over consecutive buckets of time, each
+'resolution' seconds long, holding the minimum, maximum, sum, count, and
+last value of the states recorded in it. Only the newest 'maxlen'
+buckets are kept.
+
+    """
+    def __init__(self, resolution, maxlen=ROLLUP_BUCKETS):
+        self.resolution = resolution
+        self.maxlen = maxlen
+
+        self.starts = array.array('d')
+        self.mins = array.array('d')
+        self.maxs = array.array('d')
+        self.sums = array.array('d')
+        self.counts = array.array('q')
+        self.lasts = array.array('d')
+        self.last_times = array.array('d')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def nbytes(self):
+        """Return the number of bytes used by the buckets."""
+        return len(self.starts) * sum(c.itemsize for c in (
+            self.starts, self.mins, self.maxs, self.sums,
+            self.counts, self.lasts, self.last_times))
+
+    def add(self, timestamp, value):
+        start = timestamp - timestamp % self.resolution
+
+        if self.starts and self.starts[-1] == start:
+            pos = len(self.starts) - 1
+        else:
+            pos = bisect.bisect_left(self.starts, start)
+            if pos == len(self.starts) or self.starts[pos] != start:
+                if pos == 0 and len(self.starts) >= self.maxlen:
+                    # Older than anything we are keeping
+                    return
+                self.starts.insert(pos, start)
+                self.mins.insert(pos, value)
+                self.maxs.insert(pos, value)
+                self.sums.insert(pos, 0)
+                self.counts.insert(pos, 0)
+                self.lasts.insert(pos, value)
+                self.last_times.insert(pos, timestamp)
+                self._trim()
+                pos = bisect.bisect_left(self.starts, start)
+
+        if value < self.mins[pos]:
+            self.mins[pos] = value
+        if value > self.maxs[pos]:
+            self.maxs[pos] = value
+        self.sums[pos] += value
+        self.counts[pos] += 1
+        if timestamp >= self.last_times[pos]:
+            self.lasts[pos] = value
+            self.last_times[pos] = timestamp
+
+    def _trim(self):
+        extra = len(self.starts) - self.maxlen
+        if extra > 0:
+            for column in (self.starts, self.mins, self.maxs, self.sums,
+                           self.counts, self.lasts, self.last_times):
+                del column[:extra]
+
+    def _range(self, since=None, until=None):
+        lo = 0 if since is None else bisect.bisect_left(self.starts, since - since % self.resolution)
+        hi = len(self.starts) if until is None else bisect.bisect_right(self.starts, until)
+        return lo, hi
+
+    def count(self, since=None, until=None):
+        """Return the number of buckets between two timestamps."""
+        lo, hi = self._range(since, until)
+        return max(hi - lo, 0)
+
+    def buckets(self, since=None, until=None):
+        """Return the buckets between two timestamps, oldest first."""
+        lo, hi = self._range(since, until)
+        return [Bucket(datetime.datetime.fromtimestamp(self.starts[i]),
+                       self.mins[i], self.maxs[i], self.sums[i] / self.counts[i],
+                       self.counts[i], self.lasts[i])
+                for i in range(lo, hi)]
 
 class History:
-    def __init__(self, initial=[], maxlen=None, maxage=None):
-        self.values = collections.deque(sorted((Entry(*i) for i in initial)), maxlen=maxlen)
+    """A record of states or commands, ordered by time.
+
+Times and states are kept in separate parallel arrays, so finding an
+entry by time is a binary search. Dropping old entries only moves the
+start of the arrays forward, and the space is given back once it is
+the larger part of them.
+
+If 'rollups' is True, or a list of resolutions in seconds, numeric states
+are also summarized into buckets of each resolution as they are
+recorded. Those summaries outlive 'maxlen' and 'maxage', so long ranges
+can still be read, cheaply, with downsample().
+
+    """
+    #: Don't bother compacting the arrays for less than this many entries
+    COMPACT_MIN = 1024
+
+    def __init__(self, initial=[], maxlen=None, maxage=None, rollups=None,
+                 rollup_buckets=ROLLUP_BUCKETS):
+        self._clear()
+
+        #: Whether any entries have been dropped because of maxlen or maxage
+        self.truncated = False
+
+        #: When this history was last read, from time.monotonic()
+        self.last_access = None
+        self._touch()
+
+        self.maxlen = maxlen
 
         if isinstance(maxage, int):
             self.maxage = datetime.timedelta(seconds=maxage)
@@ -17,101 +216,1240 @@ class History:
         else:
             raise ValueError("maxage must be int or timedelta")
 
+        if rollups is True:
+            rollups = DEFAULT_ROLLUPS
+        self.rollups = collections.OrderedDict(
+            (r, Rollup(r, rollup_buckets)) for r in sorted(rollups or ()))
+
+        for when, state in sorted((Entry(*i) for i in initial), key=lambda e: e.time):
+            self._append(self._to_key(when), state)
+            self._roll_up(when, state)
+        self._trim()
+
+    # The methods below are the only ones which touch the underlying
+    # storage; subclasses may override them to store entries differently.
+
+    def _clear(self):
+        self._times = []
+        self._states = []
+        self._start = 0
+
+    def _to_key(self, time):
+        """Convert a datetime to the value stored and searched by."""
+        return time
+
+    def _from_key(self, key):
+        """Convert a stored time back into a datetime."""
+        return key
+
+    def __len__(self):
+        return len(self._times) - self._start
+
+    def _key(self, pos):
+        return self._times[self._start + pos]
+
+    def _state(self, pos):
+        return self._states[self._start + pos]
+
+    def _entry(self, pos):
+        return Entry(self._from_key(self._times[self._start + pos]),
+                     self._states[self._start + pos])
+
+    def _bisect_left(self, key):
+        return bisect.bisect_left(self._times, key, self._start) - self._start
+
+    def _bisect_right(self, key):
+        return bisect.bisect_right(self._times, key, self._start) - self._start
+
+    def _append(self, key, state):
+        self._times.append(key)
+        self._states.append(state)
+
+    def _extend(self, keys, states):
+        self._times.extend(keys)
+        self._states.extend(states)
+
+    def _insert(self, pos, key, state):
+        self._times.insert(self._start + pos, key)
+        self._states.insert(self._start + pos, state)
+
+    def _truncate(self, pos):
+        """Remove every entry from 'pos' onward."""
+        del self._times[self._start + pos:]
+        del self._states[self._start + pos:]
+
+    def _arrays(self, lo, hi):
+        """Return the timestamps and states of entries lo through hi, as
+NumPy arrays if it is available, or lists if not.
+
+        """
+        times = [self._from_key(self._key(i)).timestamp() for i in range(lo, hi)]
+        states = [float('nan') if s is None else s
+                  for s in self._states[self._start + lo:self._start + hi]]
+        if numpy is not None:
+            # Left to itself, NumPy would turn a mix of numbers and
+            # strings into an array of strings
+            if all(isinstance(s, numbers.Number) for s in states):
+                return numpy.array(times), numpy.array(states)
+            return numpy.array(times), numpy.array(states, dtype=object)
+        return times, states
+
+    def _drop(self, count):
+        """Remove the oldest 'count' entries."""
+        self._start += min(count, len(self))
+
+        if self._start >= self.COMPACT_MIN and self._start * 2 >= len(self._times):
+            self._compact()
+
+    def _compact(self):
+        """Give back the space used by dropped entries."""
+        del self._times[:self._start]
+        del self._states[:self._start]
+        self._start = 0
+
+    def _entry_size(self):
+        """Estimate the bytes taken by each entry."""
+        if not len(self):
+            return 0
+        # A pointer to each of the time and state, plus the objects
+        # themselves, supposing the latest state is typical
+        return 2 * 8 + sys.getsizeof(self._key(len(self) - 1)) + \
+            sys.getsizeof(self._state(len(self) - 1))
+
+    # End of storage methods
+
+    def _touch(self):
+        self.last_access = time.monotonic()
+
+    def nbytes(self):
+        """Estimate the memory used by the entries and rollups."""
+        return len(self) * self._entry_size() + \
+            sum(r.nbytes() for r in self.rollups.values())
+
+    def evict(self, count):
+        """Remove the oldest 'count' entries and give back their memory
+right away.
+
+        """
+        self._forget(count)
+        self._compact()
+
+    def add_rollups(self, resolutions=DEFAULT_ROLLUPS, buckets=ROLLUP_BUCKETS):
+        """Start keeping rollups, if there are none yet, and summarize the
+entries already recorded into them.
+
+        """
+        if self.rollups:
+            return
+
+        self.rollups = collections.OrderedDict(
+            (r, Rollup(r, buckets)) for r in sorted(resolutions))
+        for i in range(len(self)):
+            self._roll_up(self._from_key(self._key(i)), self._state(i))
+
+    def _forget(self, count):
+        if count > 0:
+            self._drop(count)
+            self.truncated = True
+
+    def _trim(self):
+        if self.maxlen is not None and len(self) > self.maxlen:
+            self._forget(len(self) - self.maxlen)
+        self.cull()
+
+    def _roll_up(self, time, state):
+        if self.rollups and isinstance(state, (int, float)) and state == state:
+            timestamp = time.timestamp()
+            for rollup in self.rollups.values():
+                rollup.add(timestamp, state)
+
+    def _time(self, time=None, age=None):
+        if age:
+            return datetime.datetime.now() - datetime.timedelta(seconds=age)
+        elif time is None:
+            return datetime.datetime.now()
+        elif isinstance(time, (int, float)):
+            return datetime.datetime.fromtimestamp(time)
+        else:
+            return time
+
     def cull(self):
-        if self.maxage:
-            pos = bisect.bisect_left(list(zip(*self.values))[0], datetime.datetime.now() - self.maxage)
-            for _ in range(pos):
-                self.values.popleft()
+        if self.maxage and len(self):
+            self._forget(self._bisect_left(self._to_key(datetime.datetime.now() - self.maxage)))
 
     def record(self, value, time=None):
         if time is None:
-            self.values.append(Entry(datetime.datetime.now(), value))
-        elif isinstance(time, datetime.datetime):
-            if len(self.values) and time < self.values[-1][0]:
-                raise NotImplementedError("We can't alter history!... yet....")
-            else:
-                self.values.append(Entry(time, value))
-        else:
+            time = datetime.datetime.now()
+        elif not isinstance(time, datetime.datetime):
             raise ValueError("time must be datetime")
 
-    def closest(self, time=None, age=None):
-        if isinstance(time, int):
-            time = datetime.datetime.fromtimestamp(seconds=time)
+        key = self._to_key(time)
+        if len(self) and key < self._key(len(self) - 1):
+            self._insert(self._bisect_right(key), key, value)
+        else:
+            self._append(key, value)
 
-        if age:
-            time = datetime.datetime.now() - datetime.timedelta(seconds=age)
+        self._roll_up(time, value)
+        self._trim()
+
+    def extend(self, entries):
+        """Record many (time, state) entries at once, in any order. The batch
+is sorted and then merged with any newer entries already recorded in a
+single pass, which is much faster than recording them one by one.
 
-        if not self.values:
+        """
+        batch = list(entries)
+        if not batch:
+            return
+
+        new = sorted(((self._to_key(when), state) for when, state in batch),
+                     key=operator.itemgetter(0))
+        pos = self._bisect_right(new[0][0])
+
+        if pos < len(self):
+            # Both runs are already sorted, which sort() merges linearly;
+            # being stable, it also keeps existing entries first on ties
+            old = [(self._key(i), self._state(i)) for i in range(pos, len(self))]
+            self._truncate(pos)
+            new = sorted(old + new, key=operator.itemgetter(0))
+
+        self._extend([e[0] for e in new], [e[1] for e in new])
+
+        if self.rollups:
+            for when, state in batch:
+                self._roll_up(when, state)
+        self._trim()
+
+    def closest(self, time=None, age=None):
+        self._touch()
+        if not len(self):
             return None
 
-        last_after = self.values[-1]
-        last_before = None
-        for i in reversed(range(len(self.values))):
-            if self.values[i].time <= time:
-                last_before = self.values[i]
-                break
-            else:
-                last_after = self.values[i]
+        time = self._time(time, age)
+        pos = self._bisect_right(self._to_key(time))
 
-        if not last_before:
-            return last_after
+        if pos == 0:
+            return self._entry(0)
+        elif pos == len(self):
+            return self._entry(pos - 1)
 
-        after_diff = abs(last_after.time - time)
-        before_diff = abs(last_before.time - time)
-        if after_diff < before_diff:
-            return last_after
+        before = self._entry(pos - 1)
+        after = self._entry(pos)
+        if abs(after.time - time) < abs(before.time - time):
+            return after
         else:
-            return last_before
+            return before
 
     def at(self, time=None, age=None):
-        if isinstance(time, int):
-            time = datetime.datetime.fromtimestamp(seconds=time)
+        self._touch()
+        pos = self._bisect_right(self._to_key(self._time(time, age)))
+        if pos:
+            return self._entry(pos - 1)
+        return None
 
-        if age:
-            time = datetime.datetime.now() - datetime.timedelta(seconds=age)
+    def since(self, time=None, age=None, include_last=False):
+        """Return a view of the entries after the given time, newest first. If
+'include_last' is True, also include the last entry from before then,
+i.e. the state that was current at that time.
 
-        for i in reversed(range(len(self.values))):
-            if self.values[i].time <= time:
-                return self.values[i]
+        """
+        self._touch()
+        pos = self._bisect_right(self._to_key(self._time(time, age)))
+        if include_last and pos:
+            pos -= 1
+        return HistoryView(self, pos, len(self), reverse=True)
 
-        return None
+    def downsample(self, since=None, until=None, points=None):
+        """Return the history between two times, with no more than about
+'points' entries. If the recorded entries fit, and reach back far enough,
+a view of them is returned. Otherwise, this returns the Buckets of the
+finest rollup that fits, so as much detail is kept as the budget allows,
+or those of the coarsest rollup if none do.
 
-    def since(self, time=None, age=None, include_last=False):
-        if isinstance(time, int):
-            time = datetime.datetime.fromtimestamp(seconds=time)
+        """
+        self._touch()
+        since = None if since is None else self._time(since)
+        until = None if until is None else self._time(until)
 
-        if age:
-            time = datetime.datetime.now() - datetime.timedelta(seconds=age)
+        lo = 0 if since is None else self._bisect_left(self._to_key(since))
+        hi = len(self) if until is None else self._bisect_right(self._to_key(until))
 
-        for i in reversed(range(len(self.values))):
-            if self.values[i].time > time:
-                yield self.values[i]
-            else:
-                if include_last:
-                    yield self.values[i]
-                raise StopIteration()
+        covered = len(self) and (not self.truncated or
+                                 (since is not None and self._entry(0).time <= since))
+        if not self.rollups or (covered and (points is None or hi - lo <= points)):
+            return HistoryView(self, lo, hi)
+
+        since = None if since is None else since.timestamp()
+        until = None if until is None else until.timestamp()
+
+        for rollup in self.rollups.values():
+            if points is None or rollup.count(since, until) <= points:
+                break
+
+        return rollup.buckets(since, until)
+
+    def window(self, time=None, age=None, until=None):
+        """Return the states held during a window of time, starting at 'time'
+or 'age' seconds ago and ending at 'until' or now, as a Window of arrays:
+the time each state began, the state, and how many seconds of the
+window it was held for. The first state is the one which was current
+at the start of the window. 'time' may also be a function which returns
+the start. Returns None if there is nothing recorded.
+
+        """
+        window = self._window(time, age, until)
+        if window is not None and numpy is not None:
+            # The internal arrays may be views of our storage
+            return window._replace(times=window.times.copy(), states=window.states.copy())
+        return window
+
+    def _window(self, time=None, age=None, until=None):
+        self._touch()
+        if callable(time):
+            time = time()
+        start = self._time(time, age)
+        end = self._time(until)
+
+        lo = max(self._bisect_right(self._to_key(start)) - 1, 0)
+        hi = self._bisect_right(self._to_key(end))
+        if hi <= lo:
+            return None
+
+        times, states = self._arrays(lo, hi)
+        start = max(times[0], start.timestamp())
+        end = end.timestamp()
+
+        if numpy is not None:
+            durations = numpy.empty(len(times))
+            numpy.subtract(times[1:], times[:-1], out=durations[:-1])
+            durations[-1] = end - times[-1]
+            durations[0] -= start - times[0]
         else:
-            raise StopIteration()
+            edges = [start] + list(times[1:]) + [end]
+            durations = [b - a for a, b in zip(edges, edges[1:])]
+
+        return Window(times, states, durations, start, end)
+
+    def _numeric_window(self, time, age, until):
+        window = self._window(time, age, until)
+        if window is None:
+            return None, None, None
+
+        if numpy is not None and window.states.dtype.kind in 'biuf':
+            states = window.states.astype(numpy.float64, copy=False)
+            missing = numpy.isnan(states)
+            if window.states.dtype.kind == 'i':
+                missing |= window.states == NULL_INT
+            if missing.any():
+                return window, states[~missing], window.durations[~missing]
+            return window, states, window.durations
 
-        return []
+        # Other states, such as strings or None, don't count
+        pairs = [(float(s), d) for s, d in zip(window.states, window.durations)
+                 if isinstance(s, numbers.Number) and s == s and
+                 not (isinstance(s, int) and s == NULL_INT)]
+        states, durations = [p[0] for p in pairs], [p[1] for p in pairs]
+        if numpy is not None:
+            return window, numpy.array(states), numpy.array(durations)
+        return window, states, durations
+
+    def integral(self, time=None, age=None, until=None):
+        """The sum of each state multiplied by the seconds it was held for,
+over a window. See window() for the arguments.
+
+        """
+        _, states, durations = self._numeric_window(time, age, until)
+        if states is None:
+            return None
+        elif numpy is not None:
+            return float(numpy.dot(states, durations))
+        else:
+            return sum(s * d for s, d in zip(states, durations))
+
+    def mean(self, time=None, age=None, until=None):
+        """The average state over a window, weighted by how long each state
+was held. See window() for the arguments.
+
+        """
+        _, states, durations = self._numeric_window(time, age, until)
+        if states is None or not len(states):
+            return None
+
+        if numpy is not None:
+            total = durations.sum()
+            if total:
+                return float(numpy.dot(states, durations) / total)
+        else:
+            total = sum(durations)
+            if total:
+                return sum(s * d for s, d in zip(states, durations)) / total
+
+        return float(states[-1])
+
+    def minimum(self, time=None, age=None, until=None):
+        """The lowest state held during a window."""
+        _, states, _ = self._numeric_window(time, age, until)
+        if states is None or not len(states):
+            return None
+        return float(min(states) if numpy is None else states.min())
+
+    def maximum(self, time=None, age=None, until=None):
+        """The highest state held during a window."""
+        _, states, _ = self._numeric_window(time, age, until)
+        if states is None or not len(states):
+            return None
+        return float(max(states) if numpy is None else states.max())
+
+    def rate(self, time=None, age=None, until=None):
+        """The change per second between the state at the start of a window
+and the latest state in it.
+
+        """
+        window, states, _ = self._numeric_window(time, age, until)
+        if states is None or len(states) < 2:
+            return 0.0 if states is not None else None
+
+        elapsed = window.times[-1] - window.start
+        if elapsed <= 0:
+            # The latest state came right as the window opened
+            return 0.0
+        return float(states[-1] - states[0]) / elapsed
+
+    def duration_in_state(self, state, time=None, age=None, until=None):
+        """How many seconds of a window were spent in the given state. 'state'
+may also be a function which tests states, like lambda s: s > 30. With
+NumPy it is given the whole array of states at once, so it should be
+written to work on either.
+
+        """
+        window = self._window(time, age, until)
+        if window is None:
+            return 0.0
+        return self._duration_in_state(window, state)
+
+    def _duration_in_state(self, window, state):
+        if numpy is not None:
+            match = state(window.states) if callable(state) else window.states == state
+            match = numpy.broadcast_to(numpy.asarray(match, dtype=bool), window.durations.shape)
+            return float(window.durations[match].sum())
+        else:
+            match = (state(s) if callable(state) else s == state for s in window.states)
+            return sum(d for m, d in zip(match, window.durations) if m)
+
+    def percent_in_state(self, state, time=None, age=None, until=None):
+        """The percentage of a window spent in the given state. See
+duration_in_state() for the arguments.
+
+        """
+        window = self._window(time, age, until)
+        if window is None or window.end <= window.start:
+            return None
+        return 100 * self._duration_in_state(window, state) / (window.end - window.start)
 
     def all(self):
-        return list(self.values)
+        self._touch()
+        return list(HistoryView(self, 0, len(self)))
 
     def last(self, nth=None):
+        self._touch()
         if nth:
-            return list(self.values)[-nth:]
+            return HistoryView(self, max(len(self) - nth, 0), len(self))
         else:
-            if self.values:
-                return self.values[-1]
+            if len(self):
+                return self._entry(len(self) - 1)
             else:
                 return []
 
-    def __len__(self):
-        return len(self.values)
+    @property
+    def values(self):
+        self._touch()
+        return HistoryView(self, 0, len(self))
 
     def __getitem__(self, pos):
-        return list(self.values)[pos]
+        self._touch()
+        return HistoryView(self, 0, len(self))[pos]
+
+    def __iter__(self):
+        self._touch()
+        return iter(HistoryView(self, 0, len(self)))
 
     def __str__(self):
-        return str(self.values)
+        return str(self.all())
+
+class NumericHistory(History):
+    """A History of numbers, which keeps its times and states in typed
+arrays instead of lists of objects. Each entry takes 16 bytes, rather than
+the hundred or more needed for a datetime and a boxed number, and the
+arrays are contiguous in memory.
+
+Times are stored as POSIX timestamps. States are stored as integers if
+'kind' is int, and otherwise as floats, where None is stored as NaN, or
+as NULL_INT for integers.
+
+States which would not come back the same from the array, such as bools
+or strings, are also kept as they are, by time, so that reads return
+what was recorded. In the array they count as 1 and 0 if they are bools
+and as None otherwise. These are not saved by MMapHistory.
+
+    """
+    def __init__(self, *args, kind=float, **kwargs):
+        self.kind = kind
+        self._typecode = 'q' if kind is int else 'd'
+
+        # States which the array can't hold, as (stored, state) by key
+        self._odd = {}
+        super().__init__(*args, **kwargs)
+
+    def _clear(self):
+        self._times = array.array('d')
+        self._states = array.array(self._typecode)
+        self._start = 0
+
+    def _to_key(self, time):
+        return time.timestamp()
+
+    def _from_key(self, key):
+        return datetime.datetime.fromtimestamp(key)
+
+    def _null(self):
+        return NULL_INT if self._typecode == 'q' else float('nan')
+
+    def _pack(self, key, state):
+        """Return what to store in the array for a state recorded at 'key'."""
+        if state is None:
+            return self._null()
+
+        if isinstance(state, bool):
+            stored = int(state) if self._typecode == 'q' else float(state)
+        elif self._typecode == 'q':
+            if isinstance(state, int) and NULL_INT < state < -NULL_INT:
+                return state
+            stored = self._null()
+        elif isinstance(state, (int, float)):
+            return state
+        else:
+            stored = self._null()
+
+        self._odd[key] = (stored, state)
+        return stored
+
+    def _unpack(self, key, state):
+        """Return the state recorded at 'key' which was stored as 'state'."""
+        if self._odd:
+            odd = self._odd.get(key)
+            if odd is not None and (odd[0] == state or (odd[0] != odd[0] and state != state)):
+                return odd[1]
+
+        if state != state or (self._typecode == 'q' and state == NULL_INT):
+            return None
+        return state
+
+    def _trim(self):
+        super()._trim()
+
+        # Forget odd states older than every entry, now and then
+        if len(self._odd) > 2 * len(self) + 64:
+            first = self._key(0) if len(self) else None
+            self._odd = {key: odd for key, odd in self._odd.items()
+                         if first is not None and key >= first}
+
+    def _state(self, pos):
+        return self._unpack(self._times[self._start + pos], self._states[self._start + pos])
+
+    def _entry(self, pos):
+        key = self._times[self._start + pos]
+        return Entry(datetime.datetime.fromtimestamp(key),
+                     self._unpack(key, self._states[self._start + pos]))
+
+    def _append(self, key, state):
+        self._states.append(self._pack(key, state))
+        self._times.append(key)
+
+    def _extend(self, keys, states):
+        self._states.extend(self._pack(k, s) for k, s in zip(keys, states))
+        self._times.extend(keys)
+
+    def _insert(self, pos, key, state):
+        self._states.insert(self._start + pos, self._pack(key, state))
+        self._times.insert(self._start + pos, key)
+
+    def _entry_size(self):
+        return self._times.itemsize + self._states.itemsize
+
+    def _arrays(self, lo, hi):
+        lo += self._start
+        hi += self._start
+        if numpy is not None:
+            # These are views of the arrays themselves, not copies
+            return (numpy.frombuffer(self._times, dtype=numpy.float64)[lo:hi],
+                    numpy.frombuffer(self._states, dtype=self._states.typecode)[lo:hi])
+        return self._times[lo:hi], self._states[lo:hi]
+
+class _Keys:
+    """The stored times of a History, as a sequence that bisect can search."""
+    def __init__(self, history):
+        self.history = history
+
+    def __len__(self):
+        return len(self.history)
+
+    def __getitem__(self, pos):
+        return self.history._key(pos)
+
+class MMapHistory(NumericHistory):
+    """A NumericHistory kept in a memory-mapped ring file at 'path', holding
+the newest 'capacity' entries as fixed-width (timestamp, state) records.
+An existing file keeps the capacity it was created with.
+
+Each entry is written straight into the mapping, so there is nothing to
+save or load: a history opened on an existing file carries on where the
+last one left off, and the file survives the process exiting or
+crashing. With NumPy, ranges are read as views of the mapping itself.
+
+The records live in the page cache rather than the heap, so only the
+rollups count towards the memory budget.
+
+    """
+    MAGIC = b"IDHIST\0\0"
+    VERSION = 1
+    HEADER = struct.Struct('<8sBc6xQQQ')
+    HEADER_SIZE = 64
+
+    def __init__(self, path, *args, capacity=None, **kwargs):
+        self.path = path
+        self.capacity = capacity
+        super().__init__(*args, **kwargs)
+
+        if self.rollups and self._restored:
+            # Summarize the entries that were already in the file
+            resolutions = list(self.rollups)
+            buckets = next(iter(self.rollups.values())).maxlen
+            self.rollups = collections.OrderedDict()
+            self.add_rollups(resolutions, buckets)
+
+    def _clear(self):
+        self._record = struct.Struct('<d' + self._typecode)
+        self._time_record = struct.Struct('<d')
+        self._keys = _Keys(self)
+
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) >= self.HEADER_SIZE
+        self._file = open(self.path, 'r+b' if exists else 'w+b')
+
+        if exists:
+            magic, version, typecode, capacity, first, count = \
+                self.HEADER.unpack(self._file.read(self.HEADER.size))
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError("{} is not a history file".format(self.path))
+            if typecode.decode() != self._typecode:
+                raise ValueError("{} holds states of type '{}', not '{}'".format(
+                    self.path, typecode.decode(), self._typecode))
+            if self.capacity not in (None, capacity):
+                LOG.warning("Using the capacity of {}, {}, instead of {}".format(
+                    self.path, capacity, self.capacity))
+            self.capacity = capacity
+        else:
+            first = count = 0
+            self.capacity = self.capacity or MMAP_CAPACITY
+            self._file.truncate(self.HEADER_SIZE + self.capacity * self._record.size)
+
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._first = first
+        self._count = count
+        self._restored = count
+
+        if numpy is not None:
+            self._records = numpy.frombuffer(
+                self._map, offset=self.HEADER_SIZE, count=self.capacity,
+                dtype=[('time', '<f8'), ('state', '<' + self._states_dtype())])
+
+        if not exists:
+            self._write_header()
+
+    def _states_dtype(self):
+        return 'i8' if self._typecode == 'q' else 'f8'
+
+    def _write_header(self):
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self.VERSION,
+                              self._typecode.encode(), self.capacity,
+                              self._first, self._count)
+
+    def _offset(self, pos):
+        return self.HEADER_SIZE + (self._first + pos) % self.capacity * self._record.size
+
+    def __len__(self):
+        return self._count
+
+    def _key(self, pos):
+        return self._time_record.unpack_from(self._map, self._offset(pos))[0]
+
+    def _state(self, pos):
+        return self._unpack(*self._record.unpack_from(self._map, self._offset(pos)))
+
+    def _entry(self, pos):
+        key, state = self._record.unpack_from(self._map, self._offset(pos))
+        return Entry(datetime.datetime.fromtimestamp(key), self._unpack(key, state))
+
+    def _bisect_left(self, key):
+        return bisect.bisect_left(self._keys, key, 0, self._count)
+
+    def _bisect_right(self, key):
+        return bisect.bisect_right(self._keys, key, 0, self._count)
+
+    def _put(self, key, state):
+        if self._count == self.capacity:
+            # Overwrite the oldest entry
+            self._first = (self._first + 1) % self.capacity
+            self._count -= 1
+            self.truncated = True
+
+        self._record.pack_into(self._map, self._offset(self._count), key, self._pack(key, state))
+        self._count += 1
+
+    def _append(self, key, state):
+        self._put(key, state)
+        self._write_header()
+
+    def _extend(self, keys, states):
+        for key, state in zip(keys, states):
+            self._put(key, state)
+        self._write_header()
+
+    def _insert(self, pos, key, state):
+        # Rewrite everything after the new entry, which is cheap as long
+        # as entries are only a little out of order
+        newer = [(self._key(i), self._state(i)) for i in range(pos, self._count)]
+        self._count = pos
+        self._extend([key] + [e[0] for e in newer], [state] + [e[1] for e in newer])
+
+    def _truncate(self, pos):
+        self._count = pos
+        self._write_header()
+
+    def _arrays(self, lo, hi):
+        if numpy is not None:
+            start = (self._first + lo) % self.capacity
+            stop = start + hi - lo
+            if stop <= self.capacity:
+                # Views of the mapping, not copies
+                records = self._records[start:stop]
+            else:
+                records = numpy.concatenate((self._records[start:],
+                                             self._records[:stop - self.capacity]))
+            return records['time'], records['state']
+
+        records = [self._record.unpack_from(self._map, self._offset(i)) for i in range(lo, hi)]
+        return [r[0] for r in records], [r[1] for r in records]
+
+    def _drop(self, count):
+        count = min(count, self._count)
+        self._first = (self._first + count) % self.capacity
+        self._count -= count
+        self._write_header()
+
+    def _compact(self):
+        pass
+
+    def _entry_size(self):
+        return 0
+
+    def flush(self):
+        """Ask the OS to write the file out to disk now."""
+        self._map.flush()
+
+    def close(self):
+        self.flush()
+        self._records = None
+        self._map.close()
+        self._file.close()
+
+#: The prefixes and widths used for delta-of-deltas, which are in
+#: microseconds, so they are wider than Gorilla's, which are in seconds
+_DOD_WIDTHS = (('10', 7), ('110', 12), ('1110', 20), ('11110', 32), ('11111', 64))
+
+_BLOCK_HEADER = struct.Struct('<IqqQ')
+
+def _bits(value, width):
+    return format(value & ((1 << width) - 1), '0{}b'.format(width))
+
+def _encode_block(keys, states, typecode):
+    """Compress the times, as integer microseconds, and states of a block in
+the manner of Facebook's Gorilla: each time as the difference between
+consecutive deltas, and each state as its XOR with the previous state.
+
+    """
+    count = len(keys)
+    values = struct.unpack('<{}Q'.format(count), struct.pack('<{}{}'.format(count, typecode), *states))
+    first_delta = delta = keys[1] - keys[0] if count > 1 else 0
+
+    # The bits are built up as a string, which is much faster in Python
+    # than shifting them into an integer one at a time
+    out = []
+    for i in range(2, count):
+        new_delta = keys[i] - keys[i - 1]
+        dod = new_delta - delta
+        delta = new_delta
+
+        if dod == 0:
+            out.append('0')
+            continue
+
+        for prefix, width in _DOD_WIDTHS:
+            if -(1 << (width - 1)) <= dod < (1 << (width - 1)):
+                out.append(prefix)
+                out.append(_bits(dod, width))
+                break
+
+    lead = trail = -1
+    for prev, value in zip(values, values[1:]):
+        xor = prev ^ value
+        if not xor:
+            out.append('0')
+            continue
+
+        new_lead = min(64 - xor.bit_length(), 31)
+        new_trail = (xor & -xor).bit_length() - 1
+        if lead >= 0 and new_lead >= lead and new_trail >= trail:
+            # Fits in the same window as the last one
+            out.append('10')
+        else:
+            lead, trail = new_lead, new_trail
+            out.append('11')
+            out.append(_bits(lead, 5))
+            out.append(_bits(63 - lead - trail, 6))
+        out.append(_bits(xor >> trail, 64 - lead - trail))
+
+    bits = ''.join(out)
+    size = (len(bits) + 7) // 8
+    return _BLOCK_HEADER.pack(count, keys[0], first_delta, values[0]) + \
+        (int(bits.ljust(size * 8, '0'), 2).to_bytes(size, 'big') if bits else b'')
+
+def _decode_block(data, typecode):
+    """Return the arrays of times and states in a block."""
+    count, key, delta, value = _BLOCK_HEADER.unpack_from(data)
+    size = len(data) - _BLOCK_HEADER.size
+    bits = format(int.from_bytes(data[_BLOCK_HEADER.size:], 'big'), 'b').zfill(size * 8)
+    pos = 0
+
+    keys = array.array('q', [key])
+    if count > 1:
+        key += delta
+        keys.append(key)
+    for _ in range(count - 2):
+        length = 0
+        while length < 5 and bits[pos] == '1':
+            length += 1
+            pos += 1
+
+        if length:
+            if length < 5:
+                pos += 1
+            width = _DOD_WIDTHS[length - 1][1]
+            dod = int(bits[pos:pos + width], 2)
+            if dod >= 1 << (width - 1):
+                dod -= 1 << width
+            pos += width
+            delta += dod
+        else:
+            pos += 1
+
+        key += delta
+        keys.append(key)
+
+    values = [value]
+    lead = trail = 0
+    for _ in range(count - 1):
+        if bits[pos] == '1':
+            if bits[pos + 1] == '1':
+                lead = int(bits[pos + 2:pos + 7], 2)
+                trail = 63 - lead - int(bits[pos + 7:pos + 13], 2)
+                pos += 13
+            else:
+                pos += 2
+            width = 64 - lead - trail
+            value ^= int(bits[pos:pos + width], 2) << trail
+            pos += width
+        else:
+            pos += 1
+        values.append(value)
+
+    states = array.array(typecode, struct.unpack(
+        '<{}{}'.format(count, typecode), struct.pack('<{}Q'.format(count), *values)))
+    return keys, states
+
+class CompressedHistory(NumericHistory):
+    """A NumericHistory which compresses older entries. New entries are
+kept in a small uncompressed head, and every 'block_size' of them are
+sealed into an immutable block, compressed as in Facebook's Gorilla.
+
+Sensor readings which come at steady intervals and change slowly take a
+bit or two for each time and a few bytes for each state, instead of 16
+bytes for both. The last time in each block is kept aside, so finding
+entries by time only decompresses the one block they are in, and the
+last block read is cached, so reading entries in order decompresses each
+block once.
+
+    """
+    def __init__(self, *args, block_size=BLOCK_SIZE, **kwargs):
+        self.block_size = block_size
+        super().__init__(*args, **kwargs)
+
+    def _clear(self):
+        self._head_keys = array.array('q')
+        self._head_states = array.array(self._typecode)
+        self._blocks = []
+        self._block_lasts = array.array('q')
+        self._block_counts = array.array('q')
+        #: The position of each block's first entry, counting from the
+        #: first block, including any entries dropped from it
+        self._block_starts = array.array('q')
+        self._sealed = 0
+        self._skip = 0
+        self._cached = None
+
+    def _to_key(self, time):
+        return round(time.timestamp() * 1000000)
+
+    def _from_key(self, key):
+        return datetime.datetime.fromtimestamp(key / 1000000)
+
+    def _decoded(self, block):
+        if self._cached is None or self._cached[0] != block:
+            self._cached = (block,) + _decode_block(self._blocks[block], self._typecode)
+        return self._cached[1], self._cached[2]
+
+    def _locate(self, pos):
+        """Return the block and offset in it of an entry, or None and the
+offset in the head.
+
+        """
+        pos += self._skip
+        if pos >= self._sealed:
+            return None, pos - self._sealed
+        block = bisect.bisect_right(self._block_starts, pos) - 1
+        return block, pos - self._block_starts[block]
+
+    def __len__(self):
+        return self._sealed - self._skip + len(self._head_keys)
+
+    def _get(self, pos):
+        block, offset = self._locate(pos)
+        if block is None:
+            return self._head_keys[offset], self._head_states[offset]
+        keys, states = self._decoded(block)
+        return keys[offset], states[offset]
+
+    def _key(self, pos):
+        return self._get(pos)[0]
+
+    def _state(self, pos):
+        return self._unpack(*self._get(pos))
+
+    def _entry(self, pos):
+        key, state = self._get(pos)
+        return Entry(self._from_key(key), self._unpack(key, state))
+
+    def _bisect(self, key, find_block, search):
+        block = find_block(self._block_lasts, key)
+        if block == len(self._blocks):
+            pos = self._sealed + search(self._head_keys, key)
+        else:
+            pos = self._block_starts[block] + search(self._decoded(block)[0], key)
+        return max(pos - self._skip, 0)
+
+    def _bisect_left(self, key):
+        return self._bisect(key, bisect.bisect_left, bisect.bisect_left)
+
+    def _bisect_right(self, key):
+        return self._bisect(key, bisect.bisect_right, bisect.bisect_right)
+
+    def _seal(self):
+        keys, states = self._head_keys, self._head_states
+        self._blocks.append(_encode_block(keys, states, self._typecode))
+        self._block_lasts.append(keys[-1])
+        self._block_counts.append(len(keys))
+        self._block_starts.append(self._sealed)
+        self._sealed += len(keys)
+        self._head_keys = array.array('q')
+        self._head_states = array.array(self._typecode)
+
+    def _append(self, key, state):
+        self._head_keys.append(key)
+        self._head_states.append(self._pack(key, state))
+        if len(self._head_keys) >= self.block_size:
+            self._seal()
+
+    def _extend(self, keys, states):
+        for key, state in zip(keys, states):
+            self._append(key, state)
+
+    def _insert(self, pos, key, state):
+        block, offset = self._locate(pos)
+        if block is None:
+            self._head_keys.insert(offset, key)
+            self._head_states.insert(offset, self._pack(key, state))
+            return
+
+        # Blocks are immutable, so build a new one with the entry added
+        keys, states = self._decoded(block)
+        keys, states = array.array('q', keys), array.array(self._typecode, states)
+        keys.insert(offset, key)
+        states.insert(offset, self._pack(key, state))
+
+        self._blocks[block] = _encode_block(keys, states, self._typecode)
+        self._block_lasts[block] = keys[-1]
+        self._block_counts[block] += 1
+        for i in range(block + 1, len(self._blocks)):
+            self._block_starts[i] += 1
+        self._sealed += 1
+        self._cached = None
+
+    def _truncate(self, pos):
+        block, offset = self._locate(pos)
+        if block is None:
+            del self._head_keys[offset:]
+            del self._head_states[offset:]
+            return
+
+        # The rest of the block it ends in becomes the head again
+        keys, states = self._decoded(block)
+        self._head_keys = array.array('q', keys[:offset])
+        self._head_states = array.array(self._typecode, states[:offset])
+        self._sealed = self._block_starts[block]
+        for column in (self._blocks, self._block_lasts,
+                       self._block_counts, self._block_starts):
+            del column[block:]
+        self._cached = None
+
+    def _arrays(self, lo, hi):
+        keys, states = array.array('q'), array.array(self._typecode)
+        pos = lo
+        while pos < hi:
+            block, offset = self._locate(pos)
+            if block is None:
+                block_keys, block_states = self._head_keys, self._head_states
+            else:
+                block_keys, block_states = self._decoded(block)
+            end = min(len(block_keys), offset + hi - pos)
+            keys.extend(block_keys[offset:end])
+            states.extend(block_states[offset:end])
+            pos += end - offset
+
+        if numpy is not None:
+            return (numpy.frombuffer(keys, dtype=numpy.int64) / 1000000,
+                    numpy.frombuffer(states, dtype=states.typecode))
+        return [k / 1000000 for k in keys], states
+
+    def _drop(self, count):
+        self._skip += min(count, len(self))
+
+        # Whole blocks can simply be thrown away
+        dropped = 0
+        while dropped < len(self._blocks) and \
+              self._block_starts[dropped] + self._block_counts[dropped] <= self._skip:
+            dropped += 1
+
+        if dropped:
+            freed = self._block_starts[dropped - 1] + self._block_counts[dropped - 1]
+            for column in (self._blocks, self._block_lasts,
+                           self._block_counts, self._block_starts):
+                del column[:dropped]
+            for i in range(len(self._block_starts)):
+                self._block_starts[i] -= freed
+            self._sealed -= freed
+            self._skip -= freed
+            self._cached = None
+
+        if not self._blocks and self._skip:
+            del self._head_keys[:self._skip]
+            del self._head_states[:self._skip]
+            self._skip = 0
+
+    def _compact(self):
+        pass
+
+    def _storage_bytes(self):
+        return (sum(len(b) for b in self._blocks) +
+                len(self._blocks) * 3 * 8 +
+                len(self._head_keys) * (8 + self._head_states.itemsize))
+
+    def _entry_size(self):
+        if not len(self):
+            return 0
+        return -(-self._storage_bytes() // len(self))
+
+
+#: History classes which items may choose by name, with history_backend
+backends = {
+    "memory": History,
+    "numeric": NumericHistory,
+    "mmap": MMapHistory,
+    "compressed": CompressedHistory,
+}
+
+def backend(name):
+    """Return the History class called 'name' in backends. Classes are
+returned unchanged.
+
+    """
+    if isinstance(name, str):
+        try:
+            return backends[name]
+        except KeyError:
+            raise ValueError("Unknown history backend {}".format(name))
+    return name
+
+
+#: Eviction policies, from the least to the most conservative
+POLICIES = ("evict", "downsample", "keep")
+
+def parse_size(size):
+    """Convert a size like 1048576, "512K", "64M" or "1G" to bytes."""
+    if size is None or isinstance(size, (int, float)):
+        return size
+
+    size = str(size).strip().upper().rstrip("B")
+    for power, suffix in enumerate("KMG", 1):
+        if size.endswith(suffix):
+            return int(float(size[:-1]) * 1024 ** power)
+    return int(size)
+
+class HistoryManager:
+    """Keeps the memory used by every tracked History in the process under
+a total budget.
+
+When the budget is exceeded, the oldest entries are evicted from the
+histories which were least recently read, until enough has been freed.
+How each history may be shrunk is chosen by the tags of the item it
+belongs to, through 'policies', which maps tags to one of:
+
+evict
+    Drop the oldest entries.
+downsample
+    Summarize the entries into rollups, if they are numeric and the
+    history does not keep rollups already, and then drop the oldest, so
+    they can still be read with downsample().
+keep
+    Never drop anything.
+
+If an item has tags with different policies, the most conservative one
+wins. Items without any are given the 'default' policy.
+
+    """
+    def __init__(self, budget=None, policies=None, default="evict", min_entries=1):
+        #: Weak references, so that histories can still be freed
+        self.__histories = weakref.WeakKeyDictionary()
+        self.configure(budget, policies, default, min_entries)
+
+        #: How many entries have been evicted in total
+        self.evicted = 0
+
+        #: How many times the budget was found to be exceeded
+        self.overruns = 0
+
+    def configure(self, budget=None, policies=None, default="evict", min_entries=1):
+        #: The total number of bytes histories may use, or None for no limit
+        self.budget = parse_size(budget)
+
+        #: A mapping of tags to eviction policies
+        self.policies = dict(policies or {})
+
+        #: The policy for items with no tag in 'policies'
+        self.default = default
+
+        #: The number of the newest entries never evicted from a history
+        self.min_entries = min_entries
+
+        for policy in list(self.policies.values()) + [default]:
+            if policy not in POLICIES:
+                raise ValueError("Unknown history policy {}".format(policy))
+
+    def track(self, history, owner=None, kind="state"):
+        """Start keeping 'history' within the budget. 'owner' is the item it
+belongs to, whose tags decide its policy.
+
+        """
+        self.__histories[history] = (None if owner is None else weakref.ref(owner), kind)
+
+    def histories(self):
+        """Return (history, owner, kind) for every tracked history."""
+        res = []
+        for history, (ref, kind) in list(self.__histories.items()):
+            res.append((history, ref() if ref else None, kind))
+        return res
+
+    def policy(self, owner):
+        policies = [self.policies[t] for t in getattr(owner, "tags", ()) if t in self.policies]
+        if policies:
+            return max(policies, key=POLICIES.index)
+        return self.default
+
+    def usage(self):
+        return sum(h.nbytes() for h, _, _ in self.histories())
+
+    def enforce(self):
+        """Evict entries until the histories fit in the budget. Returns the
+number of bytes freed.
+
+        """
+        if self.budget is None:
+            return 0
+
+        tracked = self.histories()
+        used = sum(h.nbytes() for h, _, _ in tracked)
+        if used <= self.budget:
+            return 0
+
+        self.overruns += 1
+        excess = used - self.budget
+
+        for history, owner, _ in sorted(tracked, key=lambda t: t[0].last_access):
+            if excess <= 0:
+                break
+
+            policy = self.policy(owner)
+            spare = len(history) - self.min_entries
+            size = history._entry_size()
+            if policy == "keep" or spare <= 0 or not size:
+                continue
+
+            before = history.nbytes()
+            if policy == "downsample":
+                history.add_rollups()
+
+            count = min(spare, -(-excess // size))
+            history.evict(count)
+
+            self.evicted += count
+            excess -= before - history.nbytes()
+
+        freed = used - self.budget - excess
+        if excess > 0:
+            LOG.warning("History is still {} bytes over its budget".format(excess))
+        else:
+            LOG.debug("Evicted {} bytes of history".format(freed))
+        return freed
+
+    def stats(self):
+        now = time.monotonic()
+        histories = []
+        for history, owner, kind in self.histories():
+            histories.append({
+                "item": getattr(owner, "id", None),
+                "kind": kind,
+                "entries": len(history),
+                "bytes": history.nbytes(),
+                "policy": self.policy(owner),
+                "idle": now - history.last_access,
+                "truncated": history.truncated,
+            })
+
+        return {
+            "budget": self.budget,
+            "used": sum(h["bytes"] for h in histories),
+            "evicted": self.evicted,
+            "overruns": self.overruns,
+            "histories": sorted(histories, key=lambda h: -h["bytes"]),
+        }
+
+#: The manager for every item history in this process
+manager = HistoryManager()
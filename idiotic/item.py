@@ -1,14 +1,21 @@
+import itertools
 import functools
 import datetime
+import inspect
 import logging
+import json
+import time
 import idiotic
 from collections import defaultdict
-from idiotic import event, history, utils
+from idiotic import event, history, sketch, utils
 from idiotic.declare import Watch
 from typing import Union, get_type_hints
 
 LOG = logging.getLogger("idiotic.item")
 
+# Versions are drawn from one counter, so no two items or changes share one
+_versions = itertools.count(1)
+
 def default_command(func):
     setattr(func, "default", True)
     return func
@@ -43,12 +50,16 @@ def command(func):
         self.idiotic.dispatcher.dispatch_sync(pre_event)
 
         if not pre_event.canceled:
+            start = time.monotonic()
             func(self, *args, **kwargs)
 
+            if self.command_sketch is not None:
+                self.command_sketch.update(time.monotonic() - start)
+
             self.command_history.record(name)
 
             if self.idiotic.persist_instance:
-                self.idiotic.persist_instance.append_item_history(
+                self.idiotic.persist_instance.append_nowait(
                     self, datetime.datetime.now(),
                     name, kind="command",
                     extra={"args": args, "kwargs": kwargs} if args or kwargs else None)
@@ -77,7 +88,72 @@ def display_unit(unit, precision=2, multiplier=1, type="f", sep=" "):
         return "?" if s.state is None else  "{value:.{precision}{type}}{sep}{unit}".format(value=s.state * multiplier, precision=precision, type=type, unit=unit, sep=sep)
     return fmt
 
-class BaseItem:
+def command_spec(func):
+    """Describe a command for commands(): its description, its arguments
+with their types and hints, and whether it is the default.
+
+    """
+    return {
+        "description": func.__doc__.split('\n')[0] if func.__doc__ else None,
+        "arguments": {
+            l: {
+                "type": w,
+                "default": None,
+                "description": getattr(func, "command_hints", {}).get(l, None) or l.title()
+            } for l, w in func.command_annotations.items() if l != "return"
+        }, "default": getattr(func, "default", False),
+    }
+
+class ItemType(type):
+    """Keeps, for each item class, the specs of its commands and which of
+its public attributes are methods, so that commands(), json() and pack()
+need not look through dir() on every call. These are worked out the
+first time they are needed, and again if the class or one of its bases
+is changed.
+
+    """
+    def __init__(cls, name, bases, attrs):
+        super(ItemType, cls).__init__(name, bases, attrs)
+        cls._item_members = None
+
+    def __setattr__(cls, attr, val):
+        super(ItemType, cls).__setattr__(attr, val)
+        if attr != "_item_members":
+            cls._forget_members()
+
+    def __delattr__(cls, attr):
+        super(ItemType, cls).__delattr__(attr)
+        cls._forget_members()
+
+    def _forget_members(cls):
+        type.__setattr__(cls, "_item_members", None)
+        for sub in cls.__subclasses__():
+            sub._forget_members()
+
+    def members(cls):
+        """Return (command specs by name, public method names, public
+attribute names) for the class. Properties count as attributes.
+
+        """
+        if cls._item_members is None:
+            commands, methods, attrs = {}, set(), set()
+            for k in dir(cls):
+                value = getattr(cls, k, None)
+                if isinstance(inspect.getattr_static(cls, k, None), property):
+                    callable_ = False
+                else:
+                    callable_ = callable(value)
+
+                if callable_ and hasattr(value, "is_command"):
+                    commands[k] = command_spec(value)
+
+                if not k.startswith('_'):
+                    (methods if callable_ else attrs).add(k)
+
+            type.__setattr__(cls, "_item_members", (commands, methods, attrs))
+        return cls._item_members
+
+class BaseItem(metaclass=ItemType):
     """
 .. autoclass:: BaseItem
 
@@ -86,9 +162,25 @@ behind-the-scenes functionality and makes no assumptions about the
 nature of its state.
 
     """
+    #: The kind of sketch kept of this item's states, if it keeps any
+    SKETCH = "distinct"
+
+    #: A sketch of this item's recent states, or None
+    state_sketch = None
+
+    #: A sketch of how long, in seconds, this item's commands have
+    #: recently taken to run, or None
+    command_sketch = None
+
     def __init__(self, name, groups=None, friends=None, bindings=None, update=None, tags=None,
                  ignore_redundant=False, aliases=None, id=None, state_translate=lambda s:s,
-                 validator=lambda s:s, disable_commands=[], display=lambda s:str(s.state)):
+                 validator=lambda s:s, disable_commands=[], display=lambda s:str(s.state),
+                 history_options=None, history_backend=None, sketches=None):
+        #: Increases whenever the item's state, tags or whether it is
+        #: enabled change, and with them its json()
+        self.version = next(_versions)
+        self.__json = None
+
         #: The user-friendly label for the item
         self.name = name
         self._state = None
@@ -141,7 +233,29 @@ nature of its state.
         self.enabled = True
 
         self.__command_history = history.History()
-        self.__state_history = history.History()
+        #: Keyword arguments for this item's state History, such as
+        #: maxage or rollups
+        self.history_options = dict(history_options or {})
+
+        #: The History class, or the name of one in history.backends,
+        #: for this item's states. Otherwise, the item picks one
+        self.history_backend = history_backend
+
+        self.__state_history = self._new_state_history(
+            history.backend(history_backend), **self.history_options)
+
+        history.manager.track(self.__state_history, self, "state")
+        history.manager.track(self.__command_history, self, "command")
+
+        if sketches:
+            #: Options for this item's sketches, such as the window in
+            #: seconds, or True for the defaults
+            self.sketches = {} if sketches is True else dict(sketches)
+
+            options = dict(self.sketches)
+            self.state_sketch = sketch.windowed(options.pop("kind", self.SKETCH), **options)
+            self.command_sketch = sketch.windowed(
+                "quantiles", self.sketches.get("window"), self.sketches.get("panes", 6))
 
         self.__state_overlay = []
 
@@ -175,12 +289,29 @@ nature of its state.
                 else:
                     base_func(item)
 
+            def name_job(job, attr):
+                # Every update job shares wrap_update, so give unique
+                # ones a name the other nodes will agree on
+                if getattr(job, "cluster_unique", False) and not job.cluster_key:
+                    job.cluster_key = "item.{}.{}:{}{}".format(self.id, attr, job.interval, job.unit)
+
             if isinstance(update, dict):
                 for key, updaters in update.items():
                     for interval, func in updaters:
-                        interval.do(wrap_update, self, key, func)
+                        name_job(interval.do(wrap_update, self, key, func), key)
             elif isinstance(update, tuple):
-                update[0].do(wrap_update, self, None, update[1])
+                name_job(update[0].do(wrap_update, self, None, update[1]), None)
+
+    def _new_state_history(self, backend=None, kind=None, **kwargs):
+        """Create the History that will hold this item's states, using the
+'backend' class if one was chosen. Subclasses whose states are always int
+or float pass it as 'kind', so they get a NumericHistory by default.
+
+        """
+        backend = backend or (history.NumericHistory if kind else history.History)
+        if issubclass(backend, history.NumericHistory):
+            kwargs["kind"] = kind or float
+        return backend(**kwargs)
 
     def bind_on_command(self, function, **kwargs):
         LOG.debug("Binding on command for {}".format(self))
@@ -195,6 +326,20 @@ nature of its state.
     def __repr__(self):
         return type(self).__name__ + " '" + self.name + "' on local"
 
+    def _changed(self):
+        """Note that the item's json() may have changed."""
+        self.version = next(_versions)
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, enabled):
+        if enabled != getattr(self, "_enabled", None):
+            self._enabled = enabled
+            self._changed()
+
     def disable(self):
         self.enabled = False
 
@@ -206,9 +351,11 @@ nature of its state.
 
     def add_tag(self, tag):
         self.tags.add(tag)
+        self._changed()
 
     def remove_tag(self, tag):
         self.tags.remove(tag)
+        self._changed()
 
     def change_state(self, state):
         pass
@@ -241,6 +388,7 @@ nature of its state.
             self.change_state(target_state)
         elif not self.__state_overlay:
             self.change_state(self.state)
+        self._changed()
 
         if enabled is not None:
             self.enabled = enabled
@@ -293,9 +441,13 @@ nature of its state.
         self.idiotic.dispatcher.dispatch(pre_event)
         if not pre_event.canceled:
             self._state = val
+            self._changed()
 
             self.__state_history.record(self._state)
 
+            if self.state_sketch is not None:
+                self.state_sketch.update(self._state)
+
             for group in self.groups:
                 group._member_state_changed(self, self._state, source)
 
@@ -317,35 +469,52 @@ nature of its state.
     @display.setter
     def display(self, val):
         self._display = val
+        self._changed()
 
     def commands(self):
-        return { k: {
-            "description": getattr(self, k).__doc__.split('\n')[0] if getattr(self, k).__doc__ else None,
-            "arguments": {
-                l: {
-                    "type": w,
-                    "default": None,
-                    "description": getattr(getattr(self, k), "command_hints", {}).get(l, None) or l.title()
-                } for l, w in getattr(self, k).command_annotations.items() if l != "return"
-            }, "default": getattr(getattr(self, k), "default", False),
-        }
-                 for k in dir(self)
-                 if callable(getattr(self, k, None))
-                 and hasattr(getattr(self, k), "is_command")
-                 and k not in self.disable_commands
-        }
+        commands = type(self).members()[0]
+        res = {k: spec for k, spec in commands.items() if k not in self.disable_commands}
+
+        # Commands may also be set on the item itself
+        for k, value in vars(self).items():
+            if k in self.disable_commands:
+                continue
+            if callable(value) and hasattr(value, "is_command"):
+                res[k] = command_spec(value)
+            else:
+                res.pop(k, None)
+
+        return res
+
+    def _members(self):
+        """Return sorted lists of the public attributes and methods of the
+item, as found by dir().
+
+        """
+        _, methods, attrs = type(self).members()
+        methods, attrs = set(methods), set(attrs)
+
+        for k, value in vars(self).items():
+            if not k.startswith('_'):
+                if callable(value):
+                    attrs.discard(k)
+                    methods.add(k)
+                else:
+                    methods.discard(k)
+                    attrs.add(k)
+
+        return sorted(attrs), sorted(methods)
 
     def pack(self):
+        attrs, methods = self._members()
         res = {
             "__class__": type(self).__name__,
             "__owner__": getattr(self, 'MODULE', 'unknown'),
             "__kind__": "item",
             "__host__": None,
             "__commands__": self.commands(),
-            "__attrs__": [k for k in dir(self) if not callable(getattr(self, k, None))
-                          and not k.startswith('_')],
-            "__methods__": [k for k in dir(self) if callable(getattr(self, k, None))
-                            and not k.startswith('_')]
+            "__attrs__": attrs,
+            "__methods__": methods,
         }
 
         return res
@@ -359,8 +528,7 @@ nature of its state.
             "enabled": self.enabled,
             "commands": self.commands(),
             "display": self.display,
-            "methods": [k for k in dir(self) if callable(getattr(self, k, None))
-                        and not k.startswith('_')],
+            "methods": self._members()[1],
             "aliases": self.aliases,
         }
 
@@ -369,6 +537,16 @@ nature of its state.
 
         return res
 
+    def json_bytes(self):
+        """Return json() encoded as UTF-8 JSON. This is only encoded again
+once the item's version changes.
+
+        """
+        if self.__json is None or self.__json[0] != self.version:
+            self.__json = (self.version,
+                           json.dumps(self.json(), cls=utils.IdioticEncoder).encode('UTF-8'))
+        return self.__json[1]
+
     def state_translator(self, func):
         self.state_translate = func
         return func
@@ -498,6 +676,7 @@ class Dimmer(Toggle):
     is applied when the state is on. The value should be between 0 and 1
 
     """
+    SKETCH = "quantiles"
 
     DisplayOnOffPercent = lambda s: "On" if s.state == s.max else ("{:.0f}%".format(float(s.state)) if s.state and isinstance(s.state, float) else "Off")
 
@@ -511,6 +690,9 @@ class Dimmer(Toggle):
             kwargs["display"] = Dimmer.DisplayOnOffPercent
         super().__init__(*args, **kwargs)
 
+    def _new_state_history(self, backend=None, **kwargs):
+        return super()._new_state_history(backend, kind=float, **kwargs)
+
     def change_state(self, state):
         self.set(state)
 
@@ -601,6 +783,7 @@ class Trigger(BaseItem):
 
 class Number(BaseItem):
     """An item which represents a numerical quantity of some sort."""
+    SKETCH = "quantiles"
 
     DisplayPercent = display_unit("%", multiplier=100, sep="")
     DisplayWholePercent = display_unit("%", sep="")
@@ -614,6 +797,10 @@ class Number(BaseItem):
                 kwargs["display"] = display_formatted("{:d}")
         super().__init__(*args, validator=kind, **kwargs)
 
+    def _new_state_history(self, backend=None, **kwargs):
+        return super()._new_state_history(
+            backend, kind=self.kind if self.kind in (int, float) else None, **kwargs)
+
     def change_state(self, state):
         self.set(state)
 
@@ -880,9 +1067,11 @@ class Group(BaseItem):
     def add(self, item):
         if item not in self.members:
             self.members.append(item)
+            self._changed()
 
     def _member_state_changed(self, member, state, source):
         if self._group_state_getter:
+            self._changed()
             post_event = event.StateChangeEvent(self, None, self.state, "group_member," + source, kind="after")
             self.idiotic.dispatcher.dispatch(post_event)
 
@@ -1,4 +1,59 @@
-from . import _register_persistence
+from . import _register_persistence, history
+import concurrent.futures
+import collections
+import datetime
+import threading
+import asyncio
+import logging
+import queue
+import sys
+import time
+
+LOG = logging.getLogger("idiotic.persistence")
+
+# append_item_history() has an argument called time
+_now = time.monotonic
+
+HistoryRow = collections.namedtuple('HistoryRow', ['item', 'time', 'value', 'kind', 'extra'])
+
+#: The resolutions, in seconds, which get_item_rollups() can be asked for
+RESOLUTIONS = collections.OrderedDict([("minute", 60), ("hour", 60 * 60)])
+
+#: Seconds in each suffix accepted by parse_duration()
+DURATIONS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60,
+             "w": 7 * 24 * 60 * 60, "y": 365 * 24 * 60 * 60}
+
+def parse_duration(duration):
+    """Convert a duration like 3600, "90m", "7d" or "1y" to seconds. None
+means forever, and stays None.
+
+    """
+    if duration is None or isinstance(duration, (int, float)):
+        return duration
+
+    duration = str(duration).strip().lower()
+    if duration[-1:] in DURATIONS:
+        return float(duration[:-1]) * DURATIONS[duration[-1]]
+    return float(duration)
+
+def _bucket_start(time, seconds):
+    """Return the start of the 'seconds' long bucket which a datetime falls
+in, as get_item_rollups() buckets it.
+
+    """
+    timestamp = time.timestamp()
+    return datetime.datetime.fromtimestamp(timestamp - timestamp % seconds)
+
+def _cut(res, since, resolution):
+    """Return the entries of a cached result after 'since', or the buckets
+from it, as they would have been read.
+
+    """
+    if since is None:
+        return list(res)
+    elif resolution is not None:
+        return [bucket for bucket in res if bucket.time >= since]
+    return [entry for entry in res if entry[1] > since]
 
 class PersistenceType(type):
     def __init__(cls, name, bases, attrs):
@@ -10,8 +65,75 @@ class NotConnected(Exception):
     pass
 
 class Persistence(metaclass=PersistenceType):
+    """The base class for persistence engines.
+
+Appends are not written right away, but collected into a buffer, which
+is handed to write_item_history() all at once when 'batch_size' rows
+have been collected, when the oldest is 'flush_interval' seconds old,
+or on sync() or disconnect(). Engines can then write a whole batch in
+one transaction. A 'batch_size' of 1 writes every row as it comes.
+
+Range queries made through read_item_history() are kept in an LRU cache
+of 'cache_size' results, and an item's are dropped when it changes.
+Queries which only differ in where they start share one result, so a
+dashboard asking for "the last six hours" again and again is served
+from the cache.
+Engines which set 'concurrent_reads' can serve those queries on a thread
+and connection of their own, through query_item_history(), so reads do
+not wait behind writes.
+
+How long history is kept is set by 'retention', which gives a duration
+for "raw" entries and for "rollups", with overrides by item name or by
+tag; see retention(). purge() enforces it.
+
+    """
+    #: Whether query_item_history() may be called on another thread
+    #: while writes go on
+    concurrent_reads = False
+
     def __init__(self, config):
-        pass
+        config = config or {}
+
+        #: How many rows to collect before writing them
+        self.batch_size = config.get("batch_size", 500)
+
+        #: How long, in seconds, a row may wait before being written
+        self.flush_interval = config.get("flush_interval", 1)
+
+        #: The most rows to hold on to while writes are failing; the
+        #: oldest are dropped beyond this
+        self.max_buffer = config.get("max_buffer", 100000)
+
+        retention = config.get("retention", {})
+
+        #: How long to keep history, by default and for particular items
+        #: and tags, as {"raw": seconds, "rollups": seconds} dicts
+        self.default_retention = self._parse_retention(retention)
+        self.item_retention = {name: self._parse_retention(r)
+                               for name, r in retention.get("items", {}).items()}
+        self.tag_retention = {tag.lower(): self._parse_retention(r)
+                              for tag, r in retention.get("tags", {}).items()}
+
+        #: How often, in seconds, purge() should be run
+        self.purge_interval = config.get("purge_interval", 60 * 60)
+
+        #: How many range query results to cache
+        self.cache_size = config.get("cache_size", 256)
+
+        self.__buffer = []
+        self.__buffer_since = None
+        self.__lock = threading.Lock()
+
+        # Rows taken from the buffer which are being written
+        self.__writing = []
+
+        # Cached results by query, the queries cached for each item name,
+        # and how many times each item has changed
+        self.__cache = collections.OrderedDict()
+        self.__cached = {}
+        self.__versions = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def __enter__(self):
         self.connect()
@@ -24,8 +146,11 @@ class Persistence(metaclass=PersistenceType):
         pass
 
     def disconnect(self):
-        """Close the connection to the database, if necessary."""
-        pass
+        """Close the connection to the database, if necessary. Subclasses
+should call this first, so the buffer is written out.
+
+        """
+        self.flush()
 
     def create(self):
         """Create and initialize the database, if it does not already exist.
@@ -45,18 +170,444 @@ May be called automatically by the persistence engine if needed.
 
     def sync(self):
         """Write any uncommitted data to the underlying database engine."""
-        pass
+        self.flush()
+
+    def flush(self):
+        """Write out every buffered row. If that fails, they are kept to be
+tried again next time.
+
+        """
+        with self.__lock:
+            rows, self.__buffer = self.__buffer, []
+            self.__buffer_since = None
+            self.__writing = rows
 
-    def purge(self):
-        """Delete any data that does not meet retention requirements."""
+        if not rows:
+            return
+
+        try:
+            self.write_item_history(rows)
+        except:
+            LOG.exception("Unable to write {} history rows; will retry".format(len(rows)))
+            with self.__lock:
+                self.__buffer[:0] = rows
+                self.__buffer_since = _now()
+
+                extra = len(self.__buffer) - self.max_buffer
+                if extra > 0:
+                    LOG.error("Dropping {} unwritten history rows".format(extra))
+                    del self.__buffer[:extra]
+        finally:
+            with self.__lock:
+                self.__writing = []
+
+    def pending(self):
+        """Return the number of rows waiting to be written."""
+        return len(self.__buffer)
+
+    @staticmethod
+    def _parse_retention(retention):
+        return {kind: parse_duration(retention[kind])
+                for kind in ("raw", "rollups") if kind in retention}
+
+    def retention(self, item, kind="raw"):
+        """Return how many seconds of 'kind' history, "raw" or "rollups", to
+keep for an item, or None to keep it forever.
+
+A setting for the item's name wins over its tags, and its tags over the
+default. If several tags set it, the longest is used.
+
+        """
+        if item is not None:
+            if kind in self.item_retention.get(item.name, {}):
+                return self.item_retention[item.name][kind]
+
+            # Tags are matched regardless of case, as in has_tag()
+            tagged = [self.tag_retention[tag.lower()][kind] for tag in item.tags
+                      if kind in self.tag_retention.get(tag.lower(), {})]
+            if tagged:
+                return None if None in tagged else max(tagged)
+
+        return self.default_retention.get(kind)
+
+    def purge(self, items=()):
+        """Delete any data that does not meet retention requirements.
+'items' are the items whose settings may differ from the default;
+anything else is kept for the default time.
+
+        """
         pass
 
     def get_item_history(self, item, kind="state", since=None, count=-1):
-        """Retrieve the history for the given item."""
+        """Retrieve the history for the given item, as (value, time) pairs,
+oldest first. 'kind' is "state" or "command"; the value of a command is
+its name.
+
+        """
         pass
 
-    def append_item_history(self, item, time, value, kind="state", extra=None):
+    def get_item_rollups(self, item, resolution, since=None):
+        """Return the history.Buckets summarizing the numeric states of an
+item at a resolution in RESOLUTIONS, oldest first. Engines which keep
+rollups should read them instead of the raw history, as this does.
+
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError("Unknown resolution {}".format(resolution))
+
+        rollup = history.Rollup(RESOLUTIONS[resolution], maxlen=sys.maxsize)
+        for value, when in self.get_item_history(item, since=since) or ():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and value == value:
+                rollup.add(when.timestamp(), value)
+        return rollup.buckets()
+
+    def query_item_history(self, item, kind="state", since=None, count=None, resolution=None):
+        """Return the history which has been written for an item, as a list,
+like get_item_history(), or get_item_rollups() if a 'resolution' is
+given. Engines which set 'concurrent_reads' implement this without
+flushing, on a connection of their own, as it is called on another
+thread.
+
+        """
+        raise NotImplementedError()
+
+    def disconnect_reader(self):
+        """Close whatever query_item_history() opened. This is called on the
+same thread.
+
+        """
         pass
 
+    def read_item_history(self, item, kind="state", since=None, count=None,
+                          resolution=None, cache=True):
+        """Return a list of the history of an item, like get_item_history(),
+or of its history.Buckets if a 'resolution' is given, like
+get_item_rollups().
+
+Results are cached, unless 'cache' is False, until the item next
+changes. With 'concurrent_reads', this may be called on another thread
+than writes, and buffered rows are included as well as written ones,
+though rollups only include what has been written. Rollups always start
+at the beginning of the bucket which 'since' falls in.
+
+        """
+        if resolution is not None and since is not None:
+            since = _bucket_start(since, RESOLUTIONS[resolution])
+
+        # Without a count, queries which only start at different times
+        # share the widest result asked for, and the rest are cut from it
+        if count and count > 0:
+            key = (item.name, kind, since, count, resolution)
+        else:
+            key = (item.name, kind, None, None, resolution)
+
+        with self.__lock:
+            cached = self.__cache.get(key)
+            if cached is not None and (cached[0] is None or
+                                       (since is not None and since >= cached[0])):
+                self.__cache.move_to_end(key)
+                self.cache_hits += 1
+                return _cut(cached[1], since, resolution)
+
+            self.cache_misses += 1
+            version = self.__versions.get(item.name, 0)
+
+        if self.concurrent_reads:
+            res = self._read_concurrently(item, kind, since, count, resolution)
+        elif resolution is not None:
+            res = list(self.get_item_rollups(item, resolution, since=since))
+        else:
+            res = list(self.get_item_history(item, kind=kind, since=since, count=count) or ())
+
+        if cache and self.cache_size:
+            with self.__lock:
+                # Only if the item did not change while this was read
+                if self.__versions.get(item.name, 0) == version:
+                    self.__cache[key] = (since, res)
+                    self.__cached.setdefault(item.name, set()).add(key)
+
+                    while len(self.__cache) > self.cache_size:
+                        old, _ = self.__cache.popitem(last=False)
+                        self.__cached[old[0]].discard(old)
+
+        return list(res)
+
+    def _read_concurrently(self, item, kind, since, count, resolution):
+        with self.__lock:
+            pending = [row for row in self.__writing + self.__buffer
+                       if row.item.name == item.name and row.kind == kind and
+                       (since is None or row.time > since)]
+
+        res = self.query_item_history(item, kind, since, count, resolution)
+        if resolution is not None or not pending:
+            return res
+
+        # Rows which were pending may have been written by the time they
+        # were queried
+        written = {when for _, when in res}
+        res = sorted(res + [(row.value, row.time) for row in pending if row.time not in written],
+                     key=lambda e: e[1])
+        return res[:count] if count and count > 0 else res
+
+    def _invalidate(self, name):
+        self.__versions[name] = self.__versions.get(name, 0) + 1
+        for key in self.__cached.pop(name, ()):
+            self.__cache.pop(key, None)
+
+    def clear_cache(self):
+        """Forget every cached query, as after a purge."""
+        with self.__lock:
+            self.__cache.clear()
+            self.__cached.clear()
+
+    def cache_stats(self):
+        return {
+            "size": len(self.__cache),
+            "max_size": self.cache_size,
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+        }
+
+    def get_last_states(self, items, kind="state"):
+        """Return a dict of the latest (value, time) of each of the given
+items which has any. Engines should do this in one query if they can.
+
+        """
+        res = {}
+        for item in items:
+            history = list(self.get_item_history(item, kind=kind) or ())
+            if history:
+                res[item] = history[-1]
+        return res
+
+    def get_recent_history(self, items, since, kind="state"):
+        """Return a dict of the (value, time) entries of each of the given
+items since a time, oldest first.
+
+        """
+        res = {}
+        for item in items:
+            history = list(self.get_item_history(item, kind=kind, since=since) or ())
+            if history:
+                res[item] = history
+        return res
+
+    def append_item_history(self, item, time, value, kind="state", extra=None):
+        """Add an entry to the history of the given item. It is buffered,
+and written by write_item_history() later.
+
+        """
+        with self.__lock:
+            if not self.__buffer:
+                self.__buffer_since = _now()
+            self.__buffer.append(HistoryRow(item, time, value, kind, extra))
+            self._invalidate(item.name)
+            due = len(self.__buffer) >= self.batch_size or \
+                  _now() - self.__buffer_since >= self.flush_interval
+
+        if due:
+            self.flush()
+
+    def write_item_history(self, rows):
+        """Write a list of HistoryRows, oldest first, to the database."""
+        raise NotImplementedError()
+
     def set_item_history(self, item, histories, kind="state"):
         pass
+
+class AsyncPersistence:
+    """Runs a persistence engine on a thread of its own, so that a slow
+disk or a locked database never holds up the event loop.
+
+The engine is created, and every call to it is made, on that thread, in
+the order they were made, so even engines which can only be used from
+one thread work unchanged. At most 'max_queue' calls may be waiting;
+append_nowait() drops rows beyond that rather than wait.
+
+If the engine supports 'concurrent_reads', history is read on a second
+thread, with a queue of its own, so queries are not held up by writes.
+
+    """
+    def __init__(self, engine_cls, config, max_queue=10000):
+        self.engine_cls = engine_cls
+        self.config = config
+
+        #: The engine, once start() has created it
+        self.engine = None
+
+        self.max_queue = max_queue
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+
+        #: Where reads are made, if the engine can read concurrently
+        self.read_queue = None
+        self.reader = None
+
+        #: How many rows were dropped because the queue was full
+        self.dropped = 0
+
+        #: How many calls raised an exception
+        self.errors = 0
+
+    def start(self):
+        """Start the thread, then create and connect the engine on it."""
+        self.thread = threading.Thread(target=self._run, args=(self.queue,), daemon=True,
+                                       name="persistence-{}".format(self.engine_cls.__name__))
+        self.thread.start()
+
+        self.engine = self.call(self.engine_cls, self.config)
+        self.call(self.engine.connect)
+
+        if self.engine.concurrent_reads:
+            self.read_queue = queue.Queue(self.max_queue)
+            self.reader = threading.Thread(target=self._run, args=(self.read_queue,), daemon=True,
+                                           name="persistence-reader-{}".format(self.engine_cls.__name__))
+            self.reader.start()
+
+    def stop(self):
+        """Write everything out, disconnect, and stop the thread."""
+        if self.reader:
+            self.query(self.engine.disconnect_reader)
+            self.read_queue.put(None)
+            self.reader.join()
+            self.reader = None
+            self.read_queue = None
+
+        if self.thread:
+            self.call(self.engine.sync)
+            self.call(self.engine.disconnect)
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+
+            future, func, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                self.errors += 1
+                future.set_exception(e)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a call to be made on the engine's thread and return a
+concurrent.futures.Future for its result. Raises queue.Full if there is
+no room.
+
+        """
+        return self._submit(self.queue, func, args, kwargs)
+
+    def _submit(self, tasks, func, args, kwargs):
+        future = concurrent.futures.Future()
+        tasks.put_nowait((future, func, args, kwargs))
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """Make a call on the engine's thread and wait for the result. This
+blocks, so it is meant for starting up and shutting down.
+
+        """
+        future = concurrent.futures.Future()
+        self.queue.put((future, func, args, kwargs))
+        return future.result()
+
+    def query(self, func, *args, **kwargs):
+        """Like call(), but on the reader thread if there is one, so only
+for calls which are safe alongside writes, such as read_item_history().
+
+        """
+        if not self.read_queue:
+            return self.call(func, *args, **kwargs)
+
+        future = concurrent.futures.Future()
+        self.read_queue.put((future, func, args, kwargs))
+        return future.result()
+
+    @asyncio.coroutine
+    def _call(self, func, *args, **kwargs):
+        return (yield from self._wait(self.queue, func, args, kwargs))
+
+    @asyncio.coroutine
+    def _query(self, func, *args, **kwargs):
+        return (yield from self._wait(self.read_queue or self.queue, func, args, kwargs))
+
+    @asyncio.coroutine
+    def _wait(self, tasks, func, args, kwargs):
+        while True:
+            try:
+                future = self._submit(tasks, func, args, kwargs)
+                break
+            except queue.Full:
+                yield from asyncio.sleep(.01)
+
+        return (yield from asyncio.wrap_future(future))
+
+    def backlog(self):
+        """Return the number of calls waiting to be made."""
+        return self.queue.qsize()
+
+    def stats(self):
+        return {
+            "backlog": self.backlog(),
+            "read_backlog": self.read_queue.qsize() if self.read_queue else 0,
+            "cache": self.engine.cache_stats() if self.engine else {},
+            "max_queue": self.max_queue,
+            "pending": self.engine.pending() if self.engine else 0,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def append_nowait(self, item, time, value, kind="state", extra=None):
+        """Queue an entry for the history of the given item, without waiting
+for it to be written.
+
+        """
+        try:
+            future = self.submit(self.engine.append_item_history, item, time, value, kind, extra)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                LOG.warning("Persistence is falling behind; {} rows dropped".format(self.dropped))
+        else:
+            future.add_done_callback(self._log_error)
+
+    def _log_error(self, future):
+        if future.exception() is not None:
+            LOG.error("Unable to append history: {}".format(future.exception()))
+
+    @asyncio.coroutine
+    def append(self, item, time, value, kind="state", extra=None):
+        """Add an entry to the history of the given item, waiting for room
+in the queue if need be, and then for the engine to take it.
+
+        """
+        yield from self._call(self.engine.append_item_history, item, time, value, kind, extra)
+
+    @asyncio.coroutine
+    def get_history(self, item, kind="state", since=None, count=None, resolution=None):
+        """Return a list of (value, time) for the history of the given item,
+or of history.Buckets if a 'resolution' is given.
+
+        """
+        return (yield from self._query(self.engine.read_item_history, item, kind=kind,
+                                       since=since, count=count, resolution=resolution))
+
+    @asyncio.coroutine
+    def flush(self):
+        yield from self._call(self.engine.flush)
+
+    @asyncio.coroutine
+    def sync(self):
+        yield from self._call(self.engine.sync)
+
+    @asyncio.coroutine
+    def purge(self, items=()):
+        yield from self._call(self.engine.purge, list(items))
+        self.engine.clear_cache()
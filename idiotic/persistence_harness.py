@@ -0,0 +1,263 @@
+"""Drive persistence engines with synthetic item traffic on local disk and
+measure how they hold up.
+
+Usage:
+  persistence_harness.py --help
+  persistence_harness.py [--lib=<dir>] [--items=<n>] [--events=<n>] [--rate=<n>] [--commands=<f>] [--span=<s>] [--dir=<dir>] [--keep] [--option=<opt>]... [--engine=<name>]...
+
+Options:
+  -h --help           Show this text.
+  -l --lib=<dir>      Path to idiotic system libraries directory, where
+                      engines not built in are loaded from [default: lib].
+  -i --items=<n>      Number of items [default: 100].
+  -n --events=<n>     Number of states and commands to append [default: 100000].
+  -r --rate=<n>       Events per second to append at, or 0 for as fast as
+                      possible [default: 0].
+  -c --commands=<f>   Fraction of the events which are commands [default: 0.1].
+  -s --span=<s>       Seconds of history the events are spread over, ending
+                      now [default: 604800].
+  -d --dir=<dir>      Directory to keep the data in. A temporary one is used,
+                      and removed afterwards, if not given.
+  -k --keep           Keep the data afterwards.
+  -o --option=<opt>   An engine option, as key=value, where the value is
+                      JSON if it parses as JSON. May be given more than once.
+  -e --engine=<name>  A persistence engine to benchmark. May be given more
+                      than once [default: sql logstore].
+"""
+
+import collections
+import datetime
+import tempfile
+import logging
+import random
+import shutil
+import json
+import time
+import os
+import idiotic
+import idiotic.persistence
+from idiotic import utils
+
+LOG = logging.getLogger("idiotic.persistence_harness")
+
+#: The ranges of history queried, in seconds
+QUERY_RANGES = (60 * 60, 24 * 60 * 60, 7 * 24 * 60 * 60)
+
+#: How many items each range is queried for
+QUERY_ITEMS = 10
+
+#: How much history is loaded at startup, as with the "warmup" setting
+WARMUP = 24 * 60 * 60
+
+# Engines only need an item's name and tags
+SimItem = collections.namedtuple('SimItem', ['name', 'tags'])
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def load_engine(name, lib):
+    """Return the persistence class called 'name', loading the module of
+that name from the library if need be.
+
+    """
+    if name not in idiotic.persist_types:
+        path = os.path.join(lib, "modules", name + ".py")
+        if os.path.exists(path):
+            utils.load_single(path)
+    return idiotic.persist_types.get(name)
+
+def engine_config(name, directory, options):
+    """Return a config which keeps an engine's data under 'directory'."""
+    if name == "sql":
+        config = {"engine": "sqlite:///" + os.path.join(directory, "history.db")}
+    else:
+        config = {"path": directory}
+    config.update(options)
+    return config
+
+def parse_options(options):
+    res = {}
+    for option in options:
+        key, _, value = option.partition("=")
+        try:
+            res[key] = json.loads(value)
+        except ValueError:
+            res[key] = value
+    return res
+
+def disk_usage(directory):
+    return sum(os.path.getsize(os.path.join(path, f))
+               for path, _, files in os.walk(directory) for f in files)
+
+def traffic(items, events, commands, span):
+    """Yield (item, time, value, kind, extra) for 'events' events spread
+evenly over the 'span' seconds up to now.
+
+    """
+    end = datetime.datetime.now()
+    start = end - datetime.timedelta(seconds=span)
+    step = datetime.timedelta(seconds=span / max(events, 1))
+
+    for i in range(events):
+        item = items[i % len(items)]
+        if random.random() < commands:
+            yield item, start + step * i, random.choice(("on", "off")), "command", ((), {})
+        else:
+            yield item, start + step * i, random.random() * 100, "state", None
+
+def timed_writes(engine):
+    """Record how long each batch the engine writes takes, in a list which
+is returned.
+
+    """
+    batches = []
+    write = engine.write_item_history
+
+    def write_item_history(rows):
+        before = time.monotonic()
+        write(rows)
+        batches.append(time.monotonic() - before)
+
+    engine.write_item_history = write_item_history
+    return batches
+
+def run_appends(engine, items, events, rate, commands, span):
+    latencies = []
+    start = time.monotonic()
+
+    for count, (item, when, value, kind, extra) in enumerate(
+            traffic(items, events, commands, span)):
+        if rate:
+            delay = start + count / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        before = time.monotonic()
+        engine.append_item_history(item, when, value, kind, extra)
+        latencies.append(time.monotonic() - before)
+
+    before = time.monotonic()
+    engine.sync()
+    latencies.append(time.monotonic() - before)
+
+    return time.monotonic() - start, latencies
+
+def run_queries(engine, items, span):
+    """Return (range, median seconds, median rows) for each range of history
+queried.
+
+    """
+    res = []
+    for length in QUERY_RANGES:
+        if length > span:
+            continue
+
+        times, sizes = [], []
+        for item in random.sample(items, min(QUERY_ITEMS, len(items))):
+            since = datetime.datetime.now() - datetime.timedelta(seconds=length)
+            before = time.monotonic()
+            sizes.append(len(list(engine.get_item_history(item, since=since) or ())))
+            times.append(time.monotonic() - before)
+
+        res.append((length, percentile(times, 50), percentile(sizes, 50)))
+    return res
+
+def run_rollups(engine, items):
+    times = []
+    for item in random.sample(items, min(QUERY_ITEMS, len(items))):
+        before = time.monotonic()
+        list(engine.get_item_rollups(item, "hour"))
+        times.append(time.monotonic() - before)
+    return percentile(times, 50)
+
+def run_restore(cls, config, items):
+    """Time what startup does: create and connect the engine, and load the
+latest states and recent history.
+
+    """
+    start = time.monotonic()
+    engine = cls(config)
+    engine.connect()
+    engine.get_last_states(items)
+    engine.get_recent_history(items, datetime.datetime.now() - datetime.timedelta(seconds=WARMUP))
+    elapsed = time.monotonic() - start
+    engine.disconnect()
+    return elapsed
+
+def run_engine(name, cls, directory, options, count, events, rate, commands, span):
+    os.makedirs(directory, exist_ok=True)
+    config = engine_config(name, directory, options)
+    items = [SimItem("sensor {}".format(i), frozenset()) for i in range(count)]
+
+    engine = cls(config)
+    engine.connect()
+    batches = timed_writes(engine)
+    elapsed, latencies = run_appends(engine, items, events, rate, commands, span)
+    queries = run_queries(engine, items, span)
+    rollups = run_rollups(engine, items)
+    engine.disconnect()
+
+    restore = run_restore(cls, config, items)
+
+    return {
+        "engine": name,
+        "items": count,
+        "events": events,
+        "throughput": events / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "max": max(latencies) * 1000,
+        "batches": len(batches),
+        "batch_p50": percentile(batches, 50) * 1000,
+        "batch_p99": percentile(batches, 99) * 1000,
+        "queries": queries,
+        "rollups": rollups * 1000,
+        "restore": restore * 1000,
+        "disk": disk_usage(directory),
+    }
+
+def report(result):
+    print("{engine}: {events} events across {items} items".format(**result))
+    print("  throughput     {throughput:.1f} events/s".format(**result))
+    print("  append         p50 {p50:.3f} ms, p99 {p99:.3f} ms, max {max:.3f} ms".format(**result))
+    print("  batch write    p50 {batch_p50:.3f} ms, p99 {batch_p99:.3f} ms over {batches} batches".format(**result))
+    for length, latency, rows in result["queries"]:
+        print("  query {:>6}   {:.3f} ms for {} rows".format(
+            "{}h".format(length // 3600), latency * 1000, rows))
+    print("  hourly rollup  {rollups:.3f} ms".format(**result))
+    print("  restore        {restore:.3f} ms".format(**result))
+    print("  on disk        {disk} bytes ({:.1f} bytes/event)".format(
+        result["disk"] / max(result["events"], 1), **result))
+
+def main():
+    import docopt
+    arguments = docopt.docopt(__doc__)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    count = int(arguments["--items"])
+    events = int(arguments["--events"])
+    rate = float(arguments["--rate"])
+    commands = float(arguments["--commands"])
+    span = float(arguments["--span"])
+    options = parse_options(arguments["--option"])
+
+    base = arguments["--dir"] or tempfile.mkdtemp(prefix="idiotic-bench-")
+    try:
+        for name in arguments["--engine"]:
+            cls = load_engine(name, arguments["--lib"])
+            if cls is None:
+                LOG.error("Unknown persistence engine {}".format(name))
+                continue
+
+            report(run_engine(name, cls, os.path.join(base, name), options,
+                              count, events, rate, commands, span))
+    finally:
+        if not arguments["--keep"]:
+            shutil.rmtree(base, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
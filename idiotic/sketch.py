@@ -0,0 +1,298 @@
+"""Fixed-size summaries of streams of values, which answer approximate
+questions about all of the values seen without keeping them around.
+
+"""
+
+import collections
+import hashlib
+import random
+import math
+import time
+
+#: The quantiles reported by json() when none are asked for
+DEFAULT_QUANTILES = (.5, .95, .99)
+
+class KLL:
+    """A KLL sketch of numbers, for estimating their quantiles and ranks.
+
+Values are kept in a stack of compactors; whenever one is full, it is
+sorted and every other value moves up to the next, which counts each of
+them twice as much. The sketch holds about 3*k values however many it
+has seen, and the error in a rank is roughly 1.7/k.
+
+    """
+    KIND = "quantiles"
+
+    def __init__(self, k=200, c=2 / 3):
+        self.k = k
+        self.c = c
+
+        #: How many values have been added
+        self.count = 0
+        self.min = None
+        self.max = None
+
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self._grow()
+
+    def _grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.c ** depth * self.k)) + 1
+
+    def update(self, value):
+        """Add a value. None and NaN are ignored."""
+        if value is None or value != value:
+            return
+
+        self.compactors[0].append(value)
+        self.size += 1
+        self.count += 1
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if self.size >= self.max_size:
+            self._compress()
+
+    def _compress(self):
+        for height, items in enumerate(self.compactors):
+            if len(items) >= self._capacity(height):
+                if height + 1 == len(self.compactors):
+                    self._grow()
+
+                # An odd value out stays where it is
+                last = items.pop() if len(items) % 2 else None
+                items.sort()
+                self.compactors[height + 1].extend(items[random.randint(0, 1)::2])
+                del items[:]
+                if last is not None:
+                    items.append(last)
+
+                self.size = sum(len(c) for c in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def merge(self, other):
+        """Add all of the values summarized by another KLL."""
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+
+        for items, others in zip(self.compactors, other.compactors):
+            items.extend(others)
+
+        self.count += other.count
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self._compress()
+
+    def _weighted(self):
+        return sorted((value, 1 << height)
+                      for height, items in enumerate(self.compactors)
+                      for value in items)
+
+    def rank(self, value):
+        """Estimate the fraction of values which are at most 'value'."""
+        weighted = self._weighted()
+        total = sum(w for _, w in weighted)
+        if not total:
+            return None
+        return sum(w for v, w in weighted if v <= value) / total
+
+    def quantiles(self, qs=DEFAULT_QUANTILES):
+        """Estimate the value at each fraction in 'qs' of the way through the
+values, in order. The 0 and 1 quantiles are the exact minimum and
+maximum.
+
+        """
+        weighted = self._weighted()
+        total = sum(w for _, w in weighted)
+        if not total:
+            return [None for _ in qs]
+
+        res = []
+        for q in qs:
+            if q <= 0:
+                res.append(self.min)
+            elif q >= 1:
+                res.append(self.max)
+            else:
+                seen = 0
+                for value, weight in weighted:
+                    seen += weight
+                    if seen >= q * total:
+                        break
+                res.append(value)
+        return res
+
+    def quantile(self, q):
+        return self.quantiles((q,))[0]
+
+    def json(self, qs=None):
+        qs = qs or DEFAULT_QUANTILES
+        return {
+            "kind": self.KIND,
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "quantiles": dict(zip((str(q) for q in qs), self.quantiles(qs))),
+        }
+
+class HyperLogLog:
+    """A HyperLogLog sketch, for estimating how many distinct values have
+been seen. It uses 2**p bytes, and the estimate is usually within about
+1.04/sqrt(2**p) of the true count: 3% for the default p of 10.
+
+    """
+    KIND = "distinct"
+
+    def __init__(self, p=10):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+        #: How many values have been added
+        self.count = 0
+
+    def update(self, value):
+        # hash() is randomized per process, and should be the same for
+        # sketches which may be merged
+        digest = hashlib.sha1(repr(value).encode('UTF-8')).digest()
+        bits = int.from_bytes(digest[:8], 'big')
+
+        index = bits >> (64 - self.p)
+        rank = 64 - self.p - (bits & ((1 << (64 - self.p)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+        self.count += 1
+
+    def merge(self, other):
+        """Add all of the values summarized by another HyperLogLog."""
+        if other.p != self.p:
+            raise ValueError("Can't merge HyperLogLogs of different sizes")
+
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        self.count += other.count
+
+    def distinct(self):
+        """Estimate the number of distinct values."""
+        alpha = .7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # Linear counting is better for small numbers
+            estimate = self.m * math.log(self.m / zeros)
+
+        return int(round(estimate))
+
+    def json(self, qs=None):
+        return {
+            "kind": self.KIND,
+            "count": self.count,
+            "distinct": self.distinct(),
+        }
+
+KINDS = {
+    KLL.KIND: KLL,
+    HyperLogLog.KIND: HyperLogLog,
+}
+
+class Windowed:
+    """A sketch of the values seen in the last 'window' seconds, or of every
+value if 'window' is None.
+
+The window is split into 'panes', each with its own sketch from
+'factory'. Adding a value only touches the newest pane, and reading
+merges the panes which are still inside the window, so the window
+moves along one pane at a time.
+
+    """
+    def __init__(self, factory, window=None, panes=6):
+        self.factory = factory
+        self.window = window
+        self.panes = panes if window else 1
+        self.pane_length = window / self.panes if window else None
+
+        self.__panes = collections.deque()
+        self.__merged = None
+
+    def _pane(self, now):
+        if not self.pane_length:
+            return 0
+        return int(now // self.pane_length)
+
+    def _expire(self, now):
+        oldest = self._pane(now) - self.panes
+        while self.__panes and self.__panes[0][0] <= oldest:
+            self.__panes.popleft()
+            self.__merged = None
+
+    def update(self, value, now=None):
+        now = time.time() if now is None else now
+        pane = self._pane(now)
+
+        if not self.__panes or self.__panes[-1][0] != pane:
+            self.__panes.append((pane, self.factory()))
+            self._expire(now)
+
+        self.__panes[-1][1].update(value)
+        self.__merged = None
+
+    def sketch(self, now=None):
+        """Return one sketch of all the values in the window."""
+        self._expire(time.time() if now is None else now)
+
+        if self.__merged is None:
+            self.__merged = self.factory()
+            for _, pane in self.__panes:
+                self.__merged.merge(pane)
+
+        return self.__merged
+
+    @property
+    def count(self):
+        return self.sketch().count
+
+    def quantile(self, q):
+        return self.sketch().quantile(q)
+
+    def quantiles(self, qs=DEFAULT_QUANTILES):
+        return self.sketch().quantiles(qs)
+
+    def rank(self, value):
+        return self.sketch().rank(value)
+
+    def distinct(self):
+        return self.sketch().distinct()
+
+    def json(self, qs=None):
+        res = self.sketch().json(qs)
+        res["window"] = self.window
+        return res
+
+def windowed(kind="quantiles", window=None, panes=6, **kwargs):
+    """Create a Windowed sketch of the given kind, "quantiles" or "distinct".
+Other arguments are given to the sketch class, such as k or p.
+
+    """
+    try:
+        cls = KINDS[kind]
+    except KeyError:
+        raise ValueError("Unknown sketch kind {}".format(kind))
+    # Build one sketch now, so that bad options fail here instead of on
+    # the first update
+    cls(**kwargs)
+    return Windowed(lambda: cls(**kwargs), window, panes)
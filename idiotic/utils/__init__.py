@@ -1,4 +1,4 @@
-from .api import _APIWrapper, join_url, jsonified, single_args
+from .api import _APIWrapper, join_url, jsonified, jsonified_cached, api_error, single_args
 from .etc import mangle_name, IdioticEncoder
 import functools
 import logging
@@ -280,4 +280,4 @@ def load_dir(path, include_assets=False, ignore=[]):
 
     return modules
 
-__ALL__ = [AttrDict, TaggedDict, AlwaysInDict, NeverInDict, SingleItemDict, mangle_name, IdioticEncoder, load_dir, _APIWrapper, join_url, jsonified, single_args]
+__ALL__ = [AttrDict, TaggedDict, AlwaysInDict, NeverInDict, SingleItemDict, mangle_name, IdioticEncoder, load_dir, _APIWrapper, join_url, jsonified, jsonified_cached, api_error, single_args]
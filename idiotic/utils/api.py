@@ -1,21 +1,71 @@
-from .etc import mangle_name
+from .etc import mangle_name, IdioticEncoder
 from werkzeug.wrappers import Response
 from flask.json import jsonify
 from flask import request
+import asyncio
 import logging
 
 LOG = logging.getLogger("idiotic.utils.api")
 
+def _error(e):
+    return {"status": "error", "description": str(e), "type": type(e).__name__}
+
+def api_error(e, args, kwargs):
+    LOG.exception("Exception encountered from API, args={}, kwargs={}".format(args, kwargs))
+    return jsonify(_error(e))
+
 def jsonified(func):
+    """Wrap a view's result, or the exception it raised, in a JSON response.
+A view may also return a coroutine, for a result which it would have to
+wait for, such as history from persistence; see deferred().
+
+    """
     def decorator(*args, **kwargs):
         try:
             res = func(*args, **kwargs)
         except Exception as e:
-            LOG.exception("Exception encountered from API, args={}, kwargs={}".format(args, kwargs))
-            return jsonify({"status": "error", "description": str(e), "type": type(e).__name__})
+            return api_error(e, args, kwargs)
+        if asyncio.iscoroutine(res):
+            return deferred(res, args, kwargs)
         return jsonify({"status": "success", "result": res})
     return decorator
 
+def deferred(coro, args, kwargs):
+    """Return a JSON response, as jsonified() would, whose body is a future
+for the result of a coroutine. aiohttp.wsgi waits for a future in a
+response body without holding up the event loop.
+
+    """
+    @asyncio.coroutine
+    def body():
+        try:
+            res = {"status": "success", "result": (yield from coro)}
+        except Exception as e:
+            LOG.exception("Exception encountered from API, args={}, kwargs={}".format(args, kwargs))
+            res = _error(e)
+        return IdioticEncoder().encode(res).encode('UTF-8')
+
+    # Not a list, or werkzeug would try to work out its length
+    return Response(iter([asyncio.ensure_future(body())]), mimetype='application/json')
+
+def jsonified_cached(func):
+    """Like jsonified, for functions which return their result already
+encoded as JSON bytes, along with an ETag for it. Requests which give
+that ETag in If-None-Match get an empty 304 response instead.
+
+    """
+    def decorator(*args, **kwargs):
+        try:
+            res, etag = func(*args, **kwargs)
+        except Exception as e:
+            return api_error(e, args, kwargs)
+
+        response = Response(b'{"status": "success", "result": ' + res + b'}',
+                            mimetype='application/json')
+        response.set_etag(etag)
+        return response.make_conditional(request)
+    return decorator
+
 def single_args(args):
     return {k: v[0] if isinstance(v, list) else v for k, v in args.items()}
 
@@ -2,15 +2,28 @@
 
 """
 
+import itertools
+import datetime
+import asyncio
+import hashlib
 import logging
-from idiotic.utils import jsonified, single_args
-from flask import request
-from idiotic import version
+import uuid
+import csv
+import io
+from idiotic.utils import jsonified, jsonified_cached, api_error, single_args, IdioticEncoder
+from flask import request, Response, stream_with_context
+from idiotic import version, history
 
 MODULE_NAME = "api"
 
 log = logging.getLogger("module.api")
 
+#: How many entries to read from persistence at a time when exporting
+EXPORT_CHUNK = 1000
+
+# Item versions start over when idiotic does, so ETags include this too
+INSTANCE = uuid.uuid4().hex[:8]
+
 def configure(global_config, config, api, assets):
     api.add_url_rule('/api/version', 'give_version', give_version)
     api.add_url_rule('/api/scene/<name>/command/<command>', 'scene_command', scene_command)
@@ -19,6 +32,10 @@ def configure(global_config, config, api, assets):
     api.add_url_rule('/api/item/<name>/enable', 'item_enable', item_enable)
     api.add_url_rule('/api/item/<name>/disable', 'item_disable', item_disable)
     api.add_url_rule('/api/item/<name>/history', 'item_history', item_history)
+    api.add_url_rule('/api/item/<name>/history/export', 'item_history_export', item_history_export)
+    api.add_url_rule('/api/item/<name>/sketch', 'item_sketch', item_sketch)
+    api.add_url_rule('/api/history/stats', 'history_stats', history_stats)
+    api.add_url_rule('/api/persistence/stats', 'persistence_stats', persistence_stats)
     api.add_url_rule('/api/items', 'list_items', list_items)
     api.add_url_rule('/api/scenes', 'list_scenes', list_scenes)
     api.add_url_rule('/api/item/<name>', 'item_info', item_info)
@@ -73,17 +90,225 @@ def item_history(name, *args, **kwargs):
     args = single_args(request.args)
 
     item = items[name]
+    if "resolution" in args:
+        # Rollups from persistence reach back further than memory does
+        if not context.persist_instance:
+            return []
+        since = datetime.datetime.fromtimestamp(float(args["since"])) if "since" in args else None
+        return context.persist_instance.get_history(item, since=since,
+                                                    resolution=args["resolution"])
+
+    if any(k in args for k in ("since", "until", "points")):
+        return list(item.state_history.downsample(
+            since=float(args["since"]) if "since" in args else None,
+            until=float(args["until"]) if "until" in args else None,
+            points=int(args["points"]) if "points" in args else None))
+
     return item.state_history.all()
 
+def _persisted_history(item, since=None):
+    """Yield the (timestamp, value) history of an item from persistence,
+oldest first, reading only one chunk at a time. Each read waits for the
+persistence thread, so this must not run on the event loop; see
+_off_loop().
+
+    """
+    persistence = context.persist_instance
+    since = None if since is None else datetime.datetime.fromtimestamp(since)
+
+    # 'since' is exclusive, so each chunk after the first starts just
+    # before the last time already sent, and skips the entries at that
+    # time which were
+    skip = 0
+
+    while True:
+        # Chunks are only read once, so they would just push queries out
+        # of the cache
+        chunk = persistence.query(persistence.engine.read_item_history, item,
+                                  since=since, count=EXPORT_CHUNK + skip, cache=False)
+        for value, when in chunk[skip:]:
+            yield when.timestamp(), value
+
+        if len(chunk) < EXPORT_CHUNK + skip:
+            return
+
+        last = chunk[-1][1]
+        skip = sum(1 for _ in itertools.takewhile(lambda e: e[1] == last, reversed(chunk)))
+        since = last - datetime.timedelta(microseconds=1)
+
+def _memory_history(item, since=None):
+    for entry in reversed(item.state_history.since(since or 0)):
+        yield entry.time.timestamp(), entry.state
+
+def _downsample(entries, step):
+    """Summarize (timestamp, value) entries into a history.Bucket for every
+'step' seconds which has any. Only numbers count towards the minimum,
+maximum and mean.
+
+    """
+    start = None
+    for time, value in entries:
+        if start is None or time >= start + step:
+            if start is not None:
+                yield history.Bucket(start, low, high, total / numbers if numbers else None, count, last)
+            start = time - time % step
+            low = high = None
+            total = numbers = count = 0
+
+        count += 1
+        last = value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            low = value if low is None else min(low, value)
+            high = value if high is None else max(high, value)
+            total += value
+            numbers += 1
+
+    if start is not None:
+        yield history.Bucket(start, low, high, total / numbers if numbers else None, count, last)
+
+def _chunks(entries):
+    """Split entries into lists of EXPORT_CHUNK, so each is sent at once."""
+    while True:
+        chunk = list(itertools.islice(entries, EXPORT_CHUNK))
+        if not chunk:
+            return
+        yield chunk
+
+def _ndjson(entries, step):
+    encoder = IdioticEncoder()
+    for chunk in _chunks(entries):
+        if step:
+            rows = (entry._asdict() for entry in chunk)
+        else:
+            rows = ({"time": time, "value": value} for time, value in chunk)
+        yield "".join(encoder.encode(row) + "\n" for row in rows)
+
+def _csv(entries, step):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    writer.writerow(history.Bucket._fields if step else ("time", "value"))
+    for chunk in _chunks(entries):
+        writer.writerows(chunk)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    # With no entries at all, there is still the header
+    if buf.getvalue():
+        yield buf.getvalue()
+
+def _off_loop(pieces):
+    """Yield futures for the pieces of a response body, each produced on an
+executor thread, so that producing them never holds up the event loop.
+aiohttp.wsgi waits for a future in a response body and sends its result.
+
+An empty piece would end a chunked response, so each future also reads
+the piece after its own, to know whether there is one; a body with no
+pieces at all is sent as a blank line.
+
+    """
+    loop = asyncio.get_event_loop()
+    following = [None]
+
+    def advance():
+        for piece in pieces:
+            if piece:
+                return piece.encode('UTF-8')
+        return None
+
+    @asyncio.coroutine
+    def send(piece=None):
+        if piece is None:
+            piece = (yield from loop.run_in_executor(None, advance)) or b'\n'
+        following[0] = yield from loop.run_in_executor(None, advance)
+        return piece
+
+    yield asyncio.ensure_future(send())
+    while following[0] is not None:
+        yield asyncio.ensure_future(send(following[0]))
+
+EXPORT_FORMATS = {
+    "ndjson": (_ndjson, "application/x-ndjson"),
+    "csv": (_csv, "text/csv"),
+}
+
+def item_history_export(name, *args, **kwargs):
+    """Stream the history of an item, from persistence if there is any, as
+newline-delimited JSON or CSV. Entries are read and sent a chunk at a
+time, so any length of history takes the same memory, and chunks from
+persistence are read off the event loop.
+
+    """
+    try:
+        params = single_args(request.args)
+        item = items[name]
+
+        since = float(params["since"]) if "since" in params else None
+        until = float(params["until"]) if "until" in params else None
+        limit = int(params["limit"]) if "limit" in params else None
+        step = float(params["step"]) if "step" in params else None
+
+        if params.get("format", "ndjson") not in EXPORT_FORMATS:
+            raise ValueError("Unknown format {}".format(params["format"]))
+        writer, mimetype = EXPORT_FORMATS[params.get("format", "ndjson")]
+    except Exception as e:
+        return api_error(e, args, dict(kwargs, name=name))
+
+    persisted = bool(context.persist_instance)
+    if persisted:
+        entries = _persisted_history(item, since)
+    else:
+        entries = _memory_history(item, since)
+
+    if until is not None:
+        entries = itertools.takewhile(lambda e: e[0] <= until, entries)
+    if step:
+        entries = _downsample(entries, step)
+    if limit is not None:
+        entries = itertools.islice(entries, limit)
+
+    body = writer(entries, step)
+    if persisted:
+        body = _off_loop(body)
+    return Response(stream_with_context(body), mimetype=mimetype)
+
 @jsonified
+def item_sketch(name, *args, **kwargs):
+    args = single_args(request.args)
+
+    item = items[name]
+    qs = [float(q) for q in args["q"].split(",")] if "q" in args else None
+
+    res = {}
+    for kind, sketch in (("state", item.state_sketch), ("command", item.command_sketch)):
+        if sketch is not None:
+            res[kind] = sketch.json(qs)
+    return res
+
+@jsonified
+def history_stats(*_, **__):
+    return history.manager.stats()
+
+@jsonified
+def persistence_stats(*_, **__):
+    if context.persist_instance:
+        return context.persist_instance.stats()
+
+@jsonified_cached
 def list_items(*_, **__):
-    return [i.json() for i in items.all()]
+    listed = list(items.all())
+    versions = ",".join(str(i.version) for i in listed)
+    etag = "{}-{}".format(INSTANCE, hashlib.sha1(versions.encode('UTF-8')).hexdigest())
+    return b'[' + b', '.join(i.json_bytes() for i in listed) + b']', etag
 
 @jsonified
 def list_scenes():
     return [s.json() for s in scenes.all()]
 
-@jsonified
+@jsonified_cached
 def item_info(name=None, source=None):
-    if name:
-        return items[name].json()
+    if not name:
+        return b'null', "{}-null".format(INSTANCE)
+    item = items[name]
+    return item.json_bytes(), "{}-{}".format(INSTANCE, item.version)
@@ -0,0 +1,742 @@
+"""logstore -- append-only log persistence
+
+History is appended to a series of segment files in one directory, with
+no database at all, which suits small machines writing to SD cards.
+
+Each segment is a sequence of records, each one
+
+    length (4 bytes) | crc32 of payload (4 bytes) | payload
+
+where the payload is a kind (1 byte), an item id (4 bytes) and a time
+in microseconds since the epoch (8 bytes), followed by the value. Item
+ids are given out separately in each segment by name records, so every
+segment can be read, compacted or deleted on its own.
+
+A whole batch from the buffer is written at once and then fsynced (group
+commit), and a record which was torn by a crash fails its CRC and is
+cut off when the log is opened again. A batch that fails is cut off
+straight away, before it is retried. Once a segment reaches
+'segment_size', it is sealed with a sparse index of time to offset,
+and the next batch starts a new one. A manifest, which is only ever replaced by
+rename, lists the live segments. The latest state of each item is kept
+in memory and written to a snapshot every 'snapshot_interval' seconds,
+so starting up only has to read the log written since.
+
+A background thread compacts sealed segments, merging small ones and
+dropping records which are past their retention.
+
+"""
+
+import datetime
+import threading
+import logging
+import struct
+import bisect
+import pickle
+import json
+import time
+import zlib
+import os
+import idiotic.persistence
+
+LOG = logging.getLogger("modules.logstore")
+
+#: The default size, in bytes, at which a segment is sealed
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+#: Roughly how many bytes apart entries in the time index are
+INDEX_INTERVAL = 16 * 1024
+
+MANIFEST = "MANIFEST"
+SNAPSHOT = "snapshot"
+
+# Kinds of record
+NAME = 0
+KINDS = {"state": 1, "command": 2}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+
+HEADER = struct.Struct('<II')
+ENTRY = struct.Struct('<BIq')
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+LENGTH = struct.Struct('<I')
+
+# Value tags
+NONE, FALSE, TRUE, INTEGER, REAL, TEXT, PICKLE = range(7)
+
+def to_epoch(time):
+    """Convert a datetime to integer microseconds since the epoch."""
+    return int(round(time.timestamp() * 1000000))
+
+def from_epoch(epoch):
+    return datetime.datetime.fromtimestamp(epoch // 1000000) + \
+        datetime.timedelta(microseconds=epoch % 1000000)
+
+def pack_value(value):
+    if value is None:
+        return bytes((NONE,))
+    elif value is False:
+        return bytes((FALSE,))
+    elif value is True:
+        return bytes((TRUE,))
+    elif isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        return bytes((INTEGER,)) + INT.pack(value)
+    elif isinstance(value, float):
+        return bytes((REAL,)) + FLOAT.pack(value)
+    elif isinstance(value, str):
+        tag, data = TEXT, value.encode('UTF-8')
+    else:
+        tag, data = PICKLE, pickle.dumps(value, 3)
+    return bytes((tag,)) + LENGTH.pack(len(data)) + data
+
+def unpack_value(data, pos):
+    """Return a value packed at 'pos' in 'data', and the position after it."""
+    tag = data[pos]
+    pos += 1
+
+    if tag == NONE:
+        return None, pos
+    elif tag == FALSE:
+        return False, pos
+    elif tag == TRUE:
+        return True, pos
+    elif tag == INTEGER:
+        return INT.unpack_from(data, pos)[0], pos + INT.size
+    elif tag == REAL:
+        return FLOAT.unpack_from(data, pos)[0], pos + FLOAT.size
+
+    length = LENGTH.unpack_from(data, pos)[0]
+    pos += LENGTH.size
+    raw = bytes(data[pos:pos + length])
+    if tag == TEXT:
+        return raw.decode('UTF-8'), pos + length
+    return pickle.loads(raw), pos + length
+
+def frame(payload):
+    return HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+def _fsync_directory(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _replace(path, data):
+    """Write a file so that it is either entirely old or entirely new."""
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    _fsync_directory(os.path.dirname(path))
+
+class Segment:
+    """One file of the log, and what is known about it without reading it:
+its item ids, the range of times in it, and the sparse time index.
+
+    """
+    def __init__(self, directory, name, seq=0, generation=0):
+        self.directory = directory
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+        #: Segments are read in order of (seq, generation); compacting a
+        #: run of segments gives new generations of its last seq
+        self.seq = seq
+        self.generation = generation
+
+        self.names = {}
+        self.ids = []
+
+        #: (offset, latest time before offset) every INDEX_INTERVAL bytes
+        self.index = []
+        self.first = None
+        self.last = None
+        self.count = 0
+        self.size = 0
+
+        self._latest = None
+
+    @classmethod
+    def create(cls, directory, seq, generation=0):
+        return cls(directory, "{:010d}-{:04d}.log".format(seq, generation), seq, generation)
+
+    @classmethod
+    def parse_name(cls, directory, name):
+        seq, generation = name[:-len(".log")].split("-")
+        return cls(directory, name, int(seq), int(generation))
+
+    def _note(self, offset, timestamp):
+        if not self.index or offset - self.index[-1][0] >= INDEX_INTERVAL:
+            self.index.append((offset, self._latest))
+
+        if self._latest is None or timestamp > self._latest:
+            self._latest = timestamp
+        if self.first is None or timestamp < self.first:
+            self.first = timestamp
+        self.last = self._latest
+        self.count += 1
+
+    def _name(self, item_id, name):
+        self.names[name] = item_id
+        self.ids.append(name)
+
+    def encode(self, kind, name, timestamp, value, extra=None, offset=None):
+        """Return the records for an entry, to be written at 'offset', which is
+the end of the file by default.
+
+        """
+        offset = self.size if offset is None else offset
+        data = b''
+
+        if name not in self.names:
+            self._name(len(self.ids), name)
+            data = frame(ENTRY.pack(NAME, self.names[name], 0) + name.encode('UTF-8'))
+
+        payload = ENTRY.pack(KINDS[kind], self.names[name], timestamp) + pack_value(value)
+        if kind == "command":
+            payload += pack_value(extra)
+
+        self._note(offset + len(data), timestamp)
+        return data + frame(payload)
+
+    def _records(self, data, pos=0):
+        """Yield (offset, kind, item id, time, payload) for each intact record
+in 'data' from 'pos', stopping at the first which is torn or corrupt.
+
+        """
+        end = len(data)
+        while pos + HEADER.size <= end:
+            length, crc = HEADER.unpack_from(data, pos)
+            start = pos + HEADER.size
+            if length < ENTRY.size or start + length > end:
+                return
+
+            payload = data[start:start + length]
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                return
+
+            kind, item_id, timestamp = ENTRY.unpack_from(payload)
+            yield pos, kind, item_id, timestamp, payload
+            pos = start + length
+
+    def scan(self, repair=False):
+        """Rebuild what is known about the segment by reading all of it. The
+file is cut off after the last intact record if 'repair' is True.
+
+        """
+        with open(self.path, "rb") as f:
+            data = f.read()
+
+        self.names, self.ids, self.index = {}, [], []
+        self.first = self.last = self._latest = None
+        self.count = self.size = 0
+
+        for pos, kind, item_id, timestamp, payload in self._records(data):
+            if kind == NAME:
+                self._name(item_id, bytes(payload[ENTRY.size:]).decode('UTF-8'))
+            else:
+                self._note(pos, timestamp)
+            self.size = pos + HEADER.size + len(payload)
+
+        if self.size < len(data):
+            LOG.warning("{} bytes of {} are damaged or incomplete".format(
+                len(data) - self.size, self.name))
+            if repair:
+                with open(self.path, "r+b") as f:
+                    f.truncate(self.size)
+                    os.fsync(f.fileno())
+
+    def read(self, since=None, kinds=None, names=None):
+        """Yield (kind, name, time, value, extra) for the records after 'since'
+of the given kinds and item names, in the order they were written.
+
+        """
+        if self.last is None or (since is not None and self.last <= since):
+            return
+
+        wanted = None
+        if names is not None:
+            wanted = {self.names[name] for name in names if name in self.names}
+            if not wanted:
+                return
+
+        pos = 0
+        if since is not None:
+            # Every record before the chosen offset is at or before 'since'
+            before = [-1 if latest is None else latest for _, latest in self.index]
+            pos = self.index[max(bisect.bisect_right(before, since) - 1, 0)][0]
+
+        with open(self.path, "rb") as f:
+            f.seek(pos)
+            data = memoryview(f.read(self.size - pos))
+
+        for _, kind, item_id, timestamp, payload in self._records(data):
+            if kind == NAME or (kinds is not None and kind not in kinds) or \
+               (wanted is not None and item_id not in wanted) or \
+               (since is not None and timestamp <= since):
+                continue
+
+            value, end = unpack_value(payload, ENTRY.size)
+            extra = unpack_value(payload, end)[0] if kind == KINDS["command"] else None
+            yield KIND_NAMES[kind], self.ids[item_id], timestamp, value, extra
+
+    def save_index(self):
+        _replace(self.path + ".idx", json.dumps({
+            "size": self.size,
+            "count": self.count,
+            "first": self.first,
+            "last": self.last,
+            "names": self.ids,
+            "index": self.index,
+        }).encode('UTF-8'))
+
+    def load_index(self):
+        """Read the index written when the segment was sealed, returning
+False if there is none or it does not match the file.
+
+        """
+        try:
+            with open(self.path + ".idx", "rb") as f:
+                saved = json.loads(f.read().decode('UTF-8'))
+        except (OSError, ValueError):
+            return False
+
+        if saved["size"] != os.path.getsize(self.path):
+            return False
+
+        self.size, self.count = saved["size"], saved["count"]
+        self.first, self.last = saved["first"], saved["last"]
+        self._latest = self.last
+        self.ids = saved["names"]
+        self.names = {name: item_id for item_id, name in enumerate(self.ids)}
+        self.index = [tuple(entry) for entry in saved["index"]]
+        return True
+
+    def remove(self):
+        for path in (self.path, self.path + ".idx"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class LogPersistence(idiotic.persistence.Persistence):
+    NAME = 'logstore'
+    def __init__(self, config):
+        if not config:
+            config = {}
+
+        super().__init__(config)
+
+        self.path = config.get("path", "idiotic-log")
+
+        #: The size, in bytes, at which a segment is sealed
+        self.segment_size = config.get("segment_size", SEGMENT_SIZE)
+
+        #: How often, in seconds, to snapshot the latest states
+        self.snapshot_interval = config.get("snapshot_interval", 5 * 60)
+
+        #: Whether to fsync each batch. Turning this off is faster, but
+        #: the last few seconds may be lost in a power cut
+        self.fsync = config.get("fsync", True)
+
+        #: The live segments, oldest first; the last is being written
+        self.segments = []
+        self.active = None
+        self.file = None
+        self.next_seq = 0
+
+        #: The (time, value, extra) of the latest entry of each kind for
+        #: each item name, by (kind, name)
+        self.latest = {}
+        self.snapshot_time = None
+
+        #: The time before which each item's records may be dropped, from
+        #: the last purge(), and the same for any other item
+        self.cutoffs = {}
+        self.default_cutoff = None
+
+        # Guards the segment list against the compactor
+        self.lock = threading.RLock()
+        self.compactor = None
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+        self.create()
+
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def version(self):
+        return 1
+
+    def _write_manifest(self):
+        _replace(os.path.join(self.path, MANIFEST), json.dumps({
+            "version": self.version(),
+            "segments": [segment.name for segment in self.segments],
+            "next": self.next_seq,
+        }).encode('UTF-8'))
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST), "rb") as f:
+                return json.loads(f.read().decode('UTF-8'))
+        except FileNotFoundError:
+            return None
+
+    def connect(self):
+        with self.lock:
+            manifest = self._read_manifest()
+            if manifest is None:
+                names = sorted(n for n in os.listdir(self.path) if n.endswith(".log"))
+                self.next_seq = 0
+            else:
+                names = manifest["segments"]
+                self.next_seq = manifest["next"]
+
+            # Anything else was left behind by a compaction which crashed
+            for name in os.listdir(self.path):
+                if name.endswith(".idx"):
+                    continue
+                if (name.endswith(".log") and name not in names) or name.endswith(".tmp"):
+                    LOG.info("Removing stray file {}".format(name))
+                    Segment(self.path, name).remove()
+
+            self.segments = [Segment.parse_name(self.path, name) for name in names]
+            for segment in self.segments[:-1]:
+                if not segment.load_index():
+                    segment.scan(repair=True)
+
+            if self.segments:
+                self.active = self.segments[-1]
+                self.active.scan(repair=True)
+                self.next_seq = max(self.next_seq, self.active.seq + 1)
+            else:
+                self._start_segment()
+
+            self.file = open(self.active.path, "ab")
+            self._load_latest()
+
+        self.stopping = False
+        self.compactor = threading.Thread(target=self._compact_loop, daemon=True,
+                                          name="logstore-compactor")
+        self.compactor.start()
+
+    def disconnect(self):
+        super().disconnect()
+
+        if self.compactor is not None:
+            self.stopping = True
+            self.wakeup.set()
+            self.compactor.join()
+            self.compactor = None
+
+        if self.file is not None:
+            self.snapshot()
+            self.file.close()
+            self.file = None
+
+    def _start_segment(self):
+        self.active = Segment.create(self.path, self.next_seq)
+        self.next_seq += 1
+        open(self.active.path, "ab").close()
+        self.segments.append(self.active)
+        self._write_manifest()
+
+    def _roll(self):
+        """Seal the segment being written and start a new one."""
+        self.file.close()
+        self.active.save_index()
+        self._start_segment()
+        self.file = open(self.active.path, "ab")
+        self.wakeup.set()
+
+    def _update_latest(self, kind, name, timestamp, value, extra):
+        key = (kind, name)
+        if key not in self.latest or self.latest[key][0] <= timestamp:
+            self.latest[key] = (timestamp, value, extra)
+
+    def _load_latest(self):
+        """Load the snapshot, and then replay whatever was written after it."""
+        self.latest = {}
+        position = None
+
+        snapshot = Segment(self.path, SNAPSHOT)
+        if os.path.exists(snapshot.path):
+            snapshot.scan()
+            for entry in snapshot.read():
+                self._update_latest(*entry)
+
+            position = self._snapshot_position()
+
+        # Replaying more than needed does no harm, since the newest
+        # entry always wins
+        for segment in self.segments:
+            if position is None or segment.seq >= position:
+                for entry in segment.read():
+                    self._update_latest(*entry)
+
+        self.snapshot_time = time.monotonic()
+
+    def _snapshot_position(self):
+        try:
+            with open(os.path.join(self.path, SNAPSHOT + ".pos"), "rb") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def snapshot(self):
+        """Write the latest entry of each item to the snapshot."""
+        with self.lock:
+            segment = Segment(self.path, SNAPSHOT)
+            data = b''.join(segment.encode(kind, name, *entry)
+                            for (kind, name), entry in self.latest.items())
+            position = self.active.seq if self.active else 0
+
+        # The position is written after the snapshot, so a crash between
+        # the two only means replaying more of the log
+        _replace(segment.path, data)
+        _replace(os.path.join(self.path, SNAPSHOT + ".pos"), str(position).encode('UTF-8'))
+        self.snapshot_time = time.monotonic()
+
+    def write_item_history(self, rows):
+        if self.file is None:
+            raise idiotic.persistence.NotConnected()
+
+        with self.lock:
+            # Segments are only rolled between batches, so a batch that
+            # fails only has to be cut off the end of one file
+            if self.active.size >= self.segment_size:
+                self._roll()
+
+            start = self.active.size
+            data = bytearray()
+            entries = []
+            try:
+                for row in rows:
+                    kind = "command" if row.kind == "command" else "state"
+                    timestamp = to_epoch(row.time)
+                    extra = row.extra if kind == "command" else None
+                    data += self.active.encode(kind, row.item.name, timestamp, row.value, extra,
+                                               offset=start + len(data))
+                    entries.append((kind, row.item.name, timestamp, row.value, extra))
+
+                self._append(data)
+            except:
+                # The batch will be tried again, so cut off any of it that
+                # reached the file, and forget what was encoded
+                self.file.close()
+                with open(self.active.path, "r+b") as f:
+                    f.truncate(start)
+                    os.fsync(f.fileno())
+                self.active.scan()
+                self.file = open(self.active.path, "ab")
+                raise
+
+            for entry in entries:
+                self._update_latest(*entry)
+
+        if time.monotonic() - self.snapshot_time >= self.snapshot_interval:
+            self.snapshot()
+
+    def _append(self, data):
+        if not data:
+            return
+
+        self.file.write(data)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.active.size += len(data)
+
+    def _read(self, since=None, kind=None, names=None):
+        kinds = None if kind is None else {KINDS[kind]}
+        with self.lock:
+            for segment in list(self.segments):
+                yield from segment.read(since, kinds, names)
+
+    def get_item_history(self, item, kind="state", since=None, count=None):
+        """Yield the (value, time) entries in the history of an item, oldest
+first. For commands, the value is the command's name.
+
+        """
+        self.flush()
+        since = to_epoch(since) if since else None
+
+        entries = [(timestamp, value) for _, _, timestamp, value, _ in
+                   self._read(since, kind, {item.name})]
+        entries.sort(key=lambda e: e[0])
+
+        if count and count > 0:
+            entries = entries[:count]
+
+        for timestamp, value in entries:
+            yield (value, from_epoch(timestamp))
+
+    def get_last_states(self, items, kind="state"):
+        self.flush()
+        res = {}
+        for item in items:
+            if (kind, item.name) in self.latest:
+                timestamp, value, _ = self.latest[kind, item.name]
+                res[item] = (value, from_epoch(timestamp))
+        return res
+
+    def get_recent_history(self, items, since, kind="state"):
+        self.flush()
+        by_name = {item.name: item for item in items}
+
+        res = {}
+        for _, name, timestamp, value, _ in self._read(to_epoch(since), kind, set(by_name)):
+            res.setdefault(by_name[name], []).append((timestamp, value))
+
+        for item, entries in res.items():
+            entries.sort(key=lambda e: e[0])
+            res[item] = [(value, from_epoch(timestamp)) for timestamp, value in entries]
+        return res
+
+    def purge(self, items=()):
+        """Delete sealed segments older than the longest retention, and have
+the compactor drop older records of items with shorter ones.
+
+        """
+        self.flush()
+        now = to_epoch(datetime.datetime.now())
+        default = self.retention(None)
+
+        retentions = {item.name: self.retention(item) for item in items}
+        retentions = {name: r for name, r in retentions.items() if r != default}
+
+        def cutoff(retention):
+            return None if retention is None else now - int(retention * 1000000)
+
+        self.cutoffs = {name: cutoff(r) for name, r in retentions.items()}
+        self.default_cutoff = cutoff(default)
+
+        longest = set(retentions.values()) | {default}
+        oldest = None if None in longest else cutoff(max(longest))
+
+        dropped = []
+        with self.lock:
+            for segment in self.segments[:-1]:
+                if oldest is not None and segment.last is not None and segment.last < oldest:
+                    dropped.append(segment)
+
+            if dropped:
+                self.segments = [s for s in self.segments if s not in dropped]
+                self._write_manifest()
+
+        for segment in dropped:
+            segment.remove()
+
+        LOG.info("Purged {} segments of history".format(len(dropped)))
+        self.wakeup.set()
+
+    def _compact_loop(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.stopping:
+                return
+
+            try:
+                self.compact()
+            except:
+                LOG.exception("Error while compacting the log:")
+
+    def _expired(self, kind, name, timestamp):
+        cutoff = self.cutoffs.get(name, self.default_cutoff)
+        return cutoff is not None and timestamp < cutoff
+
+    def _runs(self):
+        """Return runs of adjacent sealed segments worth rewriting: those
+which are small, or may hold records past their retention.
+
+        """
+        cutoffs = [c for c in list(self.cutoffs.values()) + [self.default_cutoff]
+                   if c is not None]
+        earliest = min(cutoffs) if cutoffs else None
+
+        runs, run, expired = [], [], False
+        with self.lock:
+            sealed = self.segments[:-1]
+
+        for segment in sealed + [None]:
+            stale = segment is not None and earliest is not None and \
+                    segment.first is not None and segment.first < earliest
+            if segment is not None and (stale or segment.size < self.segment_size // 2):
+                run.append(segment)
+                expired = expired or stale
+            else:
+                if len(run) > 1 or expired:
+                    runs.append(run)
+                run, expired = [], False
+        return runs
+
+    def compact(self):
+        """Rewrite runs of sealed segments into as few as will hold them,
+without the records past their retention.
+
+        """
+        for run in self._runs():
+            generation = max(segment.generation for segment in run) + 1
+            outputs = []
+
+            # Every output takes the last seq of the run, so anything
+            # which was to be replayed after a snapshot still is
+            def start():
+                output = Segment.create(self.path, run[-1].seq, generation + len(outputs))
+                outputs.append(output)
+                return output, open(output.path, "wb")
+
+            output, f = start()
+            try:
+                for segment in run:
+                    for kind, name, timestamp, value, extra in segment.read():
+                        if self._expired(kind, name, timestamp):
+                            continue
+
+                        if output.size >= self.segment_size:
+                            f.flush()
+                            os.fsync(f.fileno())
+                            f.close()
+                            output.save_index()
+                            output, f = start()
+
+                        data = output.encode(kind, name, timestamp, value, extra)
+                        f.write(data)
+                        output.size += len(data)
+
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+                output.save_index()
+            except:
+                f.close()
+                for output in outputs:
+                    output.remove()
+                raise
+
+            empty = [output for output in outputs if not output.count]
+            outputs = [output for output in outputs if output.count]
+            with self.lock:
+                if not all(segment in self.segments for segment in run):
+                    # Purged meanwhile, so this work is out of date
+                    for output in outputs:
+                        output.remove()
+                    continue
+
+                pos = self.segments.index(run[0])
+                self.segments[pos:pos + len(run)] = outputs
+                self._write_manifest()
+
+            for segment in run + empty:
+                segment.remove()
+
+            LOG.debug("Compacted {} segments into {}".format(len(run), len(outputs)))
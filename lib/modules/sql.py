@@ -1,100 +1,813 @@
-from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, PickleType, ForeignKey, create_engine, select, and_
+from sqlalchemy import MetaData, Table, Column, Index, Integer, BigInteger, Float, Boolean, Text, String, DateTime, PickleType, ForeignKey, create_engine, inspect, select, bindparam, func, and_, not_
+from sqlalchemy.exc import DBAPIError
+import collections
+import contextlib
+import threading
+import datetime
 import logging
+import re
+import idiotic.history
 import idiotic.persistence
 
+from idiotic.persistence import RESOLUTIONS
+
 LOG = logging.getLogger("modules.sql")
 
+#: The version of the schema created by this module
+VERSION = 4
+
+#: How many rows to copy at a time when upgrading
+UPGRADE_CHUNK = 10000
+
+#: History is kept in one table per kind and span of UTC days, so that
+#: expiring it is a DROP TABLE rather than a DELETE which locks out
+#: writers
+DAY = 24 * 60 * 60 * 1000000
+
+#: The prefix of the partition tables of each kind of history. Besides
+#: states and commands, numeric states are rolled up at each resolution
+PREFIXES = {"state": "states", "command": "commands",
+            "minute": "rollups_minute", "hour": "rollups_hour"}
+
+#: How many days each partition of a kind holds
+PARTITION_DAYS = {"state": 1, "command": 1, "minute": 7, "hour": 28}
+
+PARTITION_NAME = re.compile(r"^({})_(\d{{8}})$".format("|".join(PREFIXES.values())))
+
+EPOCH = datetime.date(1970, 1, 1)
+
+def to_epoch(time):
+    """Convert a datetime to integer microseconds since the epoch."""
+    return int(round(time.timestamp() * 1000000))
+
+def from_epoch(epoch):
+    return datetime.datetime.fromtimestamp(epoch // 1000000) + \
+        datetime.timedelta(microseconds=epoch % 1000000)
+
+def encode_value(value):
+    """Return the typed value columns for a state. Anything which is not a
+bool, number, or string is pickled.
+
+    """
+    res = {"int_value": None, "float_value": None, "text_value": None,
+           "bool_value": None, "pickle_value": None}
+
+    if value is None:
+        pass
+    elif isinstance(value, bool):
+        res["bool_value"] = value
+    elif isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        res["int_value"] = value
+    elif isinstance(value, float):
+        res["float_value"] = value
+    elif isinstance(value, str):
+        res["text_value"] = value
+    else:
+        res["pickle_value"] = value
+    return res
+
+def decode_value(int_value, float_value, text_value, bool_value, pickle_value):
+    for value in (int_value, float_value, text_value, bool_value):
+        if value is not None:
+            return value
+    return pickle_value
+
+def partition_day(kind, timestamp):
+    """Return the first day, counted from the epoch, of the partition which
+holds 'kind' history at a time in microseconds.
+
+    """
+    days = PARTITION_DAYS[kind]
+    return timestamp // (DAY * days) * days
+
+def partition_name(kind, day):
+    """Return the name of the table holding 'kind' history from a day,
+counted from the epoch.
+
+    """
+    date = EPOCH + datetime.timedelta(days=day)
+    return "{}_{:%Y%m%d}".format(PREFIXES[kind], date)
+
+def parse_partition_name(name):
+    """Return the (kind, day) of a partition table, or None if the name is
+not one.
+
+    """
+    match = PARTITION_NAME.match(name)
+    if not match:
+        return None
+
+    kind = next(k for k, prefix in PREFIXES.items() if prefix == match.group(1))
+    date = datetime.datetime.strptime(match.group(2), "%Y%m%d").date()
+    return kind, (date - EPOCH).days
+
+def state_table(metadata, name, item_id=None):
+    return Table(
+        name, metadata,
+        Column('item_id', item_id, ForeignKey('items.id'), nullable=False),
+        Column('timestamp', BigInteger, nullable=False),
+        Column('int_value', BigInteger),
+        Column('float_value', Float),
+        Column('text_value', Text),
+        Column('bool_value', Boolean),
+        Column('pickle_value', PickleType),
+        Index(name + '_item_time', 'item_id', 'timestamp')
+    )
+
+def command_table(metadata, name, item_id=None):
+    return Table(
+        name, metadata,
+        Column('item_id', item_id, ForeignKey('items.id'), nullable=False),
+        Column('timestamp', BigInteger, nullable=False),
+        Column('name', String(128)),
+        Column('args', PickleType),
+        Index(name + '_item_time', 'item_id', 'timestamp')
+    )
+
+def rollup_table(metadata, name, item_id=None):
+    return Table(
+        name, metadata,
+        Column('item_id', item_id, ForeignKey('items.id'), nullable=False),
+        Column('timestamp', BigInteger, nullable=False),
+        Column('count', Integer, nullable=False),
+        Column('min_value', Float),
+        Column('max_value', Float),
+        Column('sum_value', Float),
+        Column('last_value', Float),
+        Column('last_time', BigInteger),
+        Index(name + '_item_time', 'item_id', 'timestamp', unique=True)
+    )
+
+def decode_rollup(min_value, max_value, sum_value, count, last_value):
+    return (min_value, max_value, sum_value / count, count, last_value)
+
+def merge_rollup(old, new):
+    """Combine two [count, min, max, sum, last, last time] summaries."""
+    return [old[0] + new[0], min(old[1], new[1]), max(old[2], new[2]), old[3] + new[3]] + \
+        (new[4:] if new[5] >= old[5] else old[4:])
+
+#: For each kind of history: how to create its tables, the columns
+#: holding its value, and how to turn those back into a value
+KINDS = {
+    "state": (state_table,
+              ['int_value', 'float_value', 'text_value', 'bool_value', 'pickle_value'],
+              decode_value),
+    "command": (command_table, ['name'], lambda name: name),
+    "minute": (rollup_table, ['min_value', 'max_value', 'sum_value', 'count', 'last_value'],
+               decode_rollup),
+    "hour": (rollup_table, ['min_value', 'max_value', 'sum_value', 'count', 'last_value'],
+             decode_rollup),
+}
+
+ROLLUP_COLUMNS = ['count', 'min_value', 'max_value', 'sum_value', 'last_value', 'last_time']
+
 class SQLPersistence(idiotic.persistence.Persistence):
     NAME = 'sql'
     def __init__(self, config):
         if not config:
             config = {}
 
+        super().__init__(config)
+
         self.engine = create_engine(config.get("engine", "sqlite:///:memory:"))
+
+        #: The connection used between connect() and disconnect()
         self.connection = None
 
+        # An in-memory database is a different one on each connection
+        in_memory = self.engine.url.database in (None, "", ":memory:")
+
+        #: Whether SQLite databases use write-ahead logging, which lets
+        #: the read connection read while a batch is being written
+        self.wal = config.get("wal", True) and self.engine.name == "sqlite" and not in_memory
+
+        #: Queries made through query_item_history() use a second
+        #: connection of their own, opened on the reader thread
+        self.concurrent_reads = config.get("read_connection", True) and not in_memory
+        self.read_connection = None
+        self.read_compiled_cache = {}
+
+        #: Item ids by name, so they need not be looked up for each write
+        self.item_ids = {}
+
+        #: Compiled forms of the statements below, which are reused for
+        #: every call instead of being built and compiled each time
+        self.compiled_cache = {}
+
         self.connect_args = config.get("parameters", {})
 
         self.metadata = MetaData()
+        self.meta = Table(
+            'meta', self.metadata,
+            Column('key', String(64), primary_key=True),
+            Column('value', String(256))
+        )
+
         self.items = Table(
             'items', self.metadata,
             Column('id', Integer, primary_key=True),
             Column('name', String(128), unique=True)
         )
 
-        self.states = Table(
-            'states', self.metadata,
-            Column('item_id', None, ForeignKey('items.id')),
+        #: The partition tables of each kind, by day
+        self.partitions = {kind: {} for kind in KINDS}
+
+        #: Prebuilt statements for each partition
+        self.statements = {}
+
+        # Held while partitions and their statements are added or
+        # removed, as query_item_history() reads them on another thread
+        self.partition_lock = threading.Lock()
+
+        #: The (kind, day) of each partition created by the transaction
+        #: being written, to be forgotten again if it is rolled back
+        self.new_partitions = []
+
+        #: The [count, min, max, sum, last, last time] of the newest rollup
+        #: rows, by (resolution, item id, timestamp), so that adding to
+        #: them needs no query
+        self.rollup_cache = {}
+
+        self.select_ids = select([self.items.c.name, self.items.c.id])
+        self.insert_item = self.items.insert()
+
+        self.create()
+
+    def create(self):
+        version = self.version()
+        if version is None:
+            self.metadata.create_all(self.engine)
+            self._set_version(VERSION)
+        elif version < VERSION:
+            self.upgrade(version, VERSION)
+
+        self._load_partitions()
+
+    def version(self):
+        if self.engine.has_table('meta'):
+            with self.engine.connect() as conn:
+                version = conn.execute(select([self.meta.c.value]).where(
+                    self.meta.c.key == 'version')).scalar()
+                if version is not None:
+                    return int(version)
+
+        if self.engine.has_table('states'):
+            # Version 1 had no meta table
+            return 1
+
+        return None
+
+    def _set_version(self, version, conn=None):
+        with contextlib.ExitStack() as stack:
+            if conn is None:
+                conn = stack.enter_context(self.engine.begin())
+            conn.execute(self.meta.delete().where(self.meta.c.key == 'version'))
+            conn.execute(self.meta.insert(), {"key": "version", "value": str(version)})
+
+    def upgrade(self, old_version, new_version):
+        if old_version == 1:
+            LOG.info("Upgrading history database from version 1 to 2")
+            self._upgrade_1_2()
+            old_version = 2
+
+        if old_version == 2:
+            LOG.info("Upgrading history database from version 2 to 3")
+            self._upgrade_2_3()
+            old_version = 3
+
+        if old_version == 3:
+            LOG.info("Upgrading history database from version 3 to 4")
+            self._upgrade_3_4()
+
+    def _upgrade_1_2(self):
+        # Version 1 kept pickled values and DateTime timestamps, without
+        # any index; the rows are copied across in chunks
+        old = MetaData()
+        old_states = Table(
+            'states_v1', old,
+            Column('item_id', Integer),
             Column('timestamp', DateTime),
             Column('value', PickleType)
         )
-
-        self.commands = Table(
-            'commands', self.metadata,
-            Column('item_id', None, ForeignKey('items.id')),
+        old_commands = Table(
+            'commands_v1', old,
+            Column('item_id', Integer),
             Column('timestamp', DateTime),
             Column('name', String(128)),
             Column('args', PickleType)
         )
 
-        self.create()
+        new = MetaData()
+        Table('items', new, Column('id', Integer, primary_key=True))
+        new_states = state_table(new, 'states', Integer)
+        new_commands = command_table(new, 'commands', Integer)
 
-    def create(self):
-        self.metadata.create_all(self.engine)
+        with self.engine.begin() as conn:
+            conn.execute("ALTER TABLE states RENAME TO states_v1")
+            conn.execute("ALTER TABLE commands RENAME TO commands_v1")
+            self.meta.create(conn, checkfirst=True)
+            new_states.create(conn)
+            new_commands.create(conn)
 
-    def version(self):
-        return 1
+            for source, target, convert in (
+                    (old_states, new_states, lambda row: dict(
+                        item_id=row.item_id, timestamp=to_epoch(row.timestamp),
+                        **encode_value(row.value))),
+                    (old_commands, new_commands, lambda row: dict(
+                        item_id=row.item_id, timestamp=to_epoch(row.timestamp),
+                        name=row.name, args=row.args))):
+                result = conn.execute(select([source]).where(and_(
+                    source.c.item_id != None, source.c.timestamp != None)))
+                while True:
+                    rows = result.fetchmany(UPGRADE_CHUNK)
+                    if not rows:
+                        break
+                    conn.execute(target.insert(), [convert(row) for row in rows])
+
+                source.drop(conn)
+
+            self._set_version(2, conn)
+
+    def _upgrade_2_3(self):
+        # Version 2 kept all history in one table per kind; it is split
+        # into day partitions, in chunks
+        old = MetaData()
+        Table('items', old, Column('id', Integer, primary_key=True))
+        sources = {"state": state_table(old, 'states', Integer),
+                   "command": command_table(old, 'commands', Integer)}
+
+        with self.engine.begin() as conn:
+            for kind, source in sources.items():
+                result = conn.execute(select([source]).order_by(source.c.timestamp))
+                while True:
+                    rows = result.fetchmany(UPGRADE_CHUNK)
+                    if not rows:
+                        break
+
+                    by_day = collections.defaultdict(list)
+                    for row in rows:
+                        by_day[partition_day(kind, row.timestamp)].append(dict(row))
+
+                    for day, values in by_day.items():
+                        conn.execute(self._partition(conn, kind, day).insert(), values)
+
+                source.drop(conn)
+
+            self._set_version(3, conn)
+
+    def _upgrade_3_4(self):
+        # Version 4 added rollups, which are built from the states kept
+        self._load_partitions()
+
+        with self.engine.begin() as conn:
+            for day in self._days("state"):
+                table = self.partitions["state"][day]
+                result = conn.execute(select([
+                    table.c.item_id, table.c.timestamp, table.c.int_value, table.c.float_value
+                ]).where(
+                    (table.c.int_value != None) | (table.c.float_value != None)
+                ).order_by(table.c.timestamp))
+
+                while True:
+                    rows = result.fetchmany(UPGRADE_CHUNK)
+                    if not rows:
+                        break
+                    self.rollup_cache.update(self._roll_up(conn, [
+                        (row[0], row[1], row[2] if row[2] is not None else row[3])
+                        for row in rows]))
+
+            self._set_version(4, conn)
+
+        self.rollup_cache.clear()
+
+    def _load_partitions(self):
+        for name in inspect(self.engine).get_table_names():
+            parsed = parse_partition_name(name)
+            if parsed and parsed[1] not in self.partitions[parsed[0]]:
+                kind, day = parsed
+                with self.partition_lock:
+                    self.partitions[kind][day] = KINDS[kind][0](self.metadata, name)
+
+    def _partition(self, conn, kind, day, create=True):
+        """Return the partition table for 'kind' history on a day, creating
+it if 'create' is True, or else None if there is none.
+
+        """
+        table = self.partitions[kind].get(day)
+        if table is None and create:
+            table = KINDS[kind][0](self.metadata, partition_name(kind, day))
+            table.create(conn, checkfirst=True)
+            with self.partition_lock:
+                self.partitions[kind][day] = table
+            self.new_partitions.append((kind, day))
+        return table
+
+    def _forget_new(self, known_names):
+        """Forget the partitions and item ids added by a transaction which was
+rolled back, as the database never kept them.
+
+        """
+        with self.partition_lock:
+            for kind, day in self.new_partitions:
+                table = self.partitions[kind].pop(day, None)
+                self.statements.pop((kind, day), None)
+                if table is not None:
+                    self.metadata.remove(table)
+
+        for name in set(self.item_ids) - known_names:
+            del self.item_ids[name]
+
+    def _drop_partition(self, conn, kind, day):
+        with self.partition_lock:
+            table = self.partitions[kind].pop(day)
+            self.statements.pop((kind, day), None)
+        table.drop(conn, checkfirst=True)
+        self.metadata.remove(table)
+
+    def _days(self, kind, since=None, reverse=False):
+        """Return the first days of the 'kind' partitions which may hold
+entries after 'since', which is in microseconds, in order.
+
+        """
+        first = None if since is None else partition_day(kind, since)
+        with self.partition_lock:
+            days = [day for day in self.partitions[kind] if first is None or day >= first]
+        return sorted(days, reverse=reverse)
+
+    def _statements(self, kind, day):
+        """Return the prebuilt statements for a partition, so each is only
+compiled once, or None if the partition has been dropped.
+
+        """
+        key = (kind, day)
+        with self.partition_lock:
+            if key not in self.statements:
+                table = self.partitions[kind].get(day)
+                if table is None:
+                    return None
+                columns = [table.c[name] for name in KINDS[kind][1]]
+                history = select(
+                    [table.c.timestamp] + columns
+                ).where(
+                    table.c.item_id == bindparam('item_id')
+                ).order_by(table.c.timestamp)
+
+                self.statements[key] = {
+                    "insert": table.insert(),
+                    "update": table.update().where(and_(
+                        table.c.item_id == bindparam('b_item_id'),
+                        table.c.timestamp == bindparam('b_timestamp'))),
+                    "history": history,
+                    "history_since": history.where(table.c.timestamp > bindparam('since')),
+                }
+            return self.statements[key]
+
+    def connect(self):
+        self.connection = self.engine.connect().execution_options(
+            compiled_cache=self.compiled_cache)
+        if self.wal:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.item_ids = dict(self.connection.execute(self.select_ids).fetchall())
+
+    def disconnect_reader(self):
+        if self.read_connection is not None:
+            self.read_connection.close()
+            self.read_connection = None
+
+    def disconnect(self):
+        super().disconnect()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    @contextlib.contextmanager
+    def _connect(self):
+        if self.connection is not None:
+            yield self.connection
+        else:
+            with self.engine.connect() as conn:
+                yield conn.execution_options(compiled_cache=self.compiled_cache)
 
     def get_item_history(self, item, kind="state", since=None, count=None):
-        with self.engine.connect() as conn:
-            if kind == "state":
+        """Yield the (value, time) entries in the history of an item, oldest
+first. For commands, the value is the command's name.
+
+        """
+        self.flush()
+        with self._connect() as conn:
+            yield from self._history(conn, item, kind, since, count)
+
+    def _history(self, conn, item, kind, since, count):
+        decode = KINDS[kind][2]
+        since = to_epoch(since) if since else None
+
+        item_id = self._item_ids(conn, [item.name], add=False).get(item.name)
+        if item_id is None:
+            return
+
+        for day in self._days(kind, since):
+            statements = self._statements(kind, day)
+            if statements is None:
+                # Purged since the days were listed
+                continue
+
+            if since is not None and since >= day * DAY:
+                stmt = statements["history_since"]
+                params = {"item_id": item_id, "since": since}
+            else:
+                stmt, params = statements["history"], {"item_id": item_id}
+
+            if count and count > 0:
+                stmt = stmt.limit(count)
+
+            try:
+                result = conn.execute(stmt, params)
+            except DBAPIError:
+                # The table may have been dropped after its statements
+                # were looked up, if this is the read connection
+                if day not in self.partitions[kind]:
+                    continue
+                raise
+
+            for row in result:
+                yield (decode(*row[1:]), from_epoch(row[0]))
+
+                if count and count > 0:
+                    count -= 1
+                    if not count:
+                        return
+
+    def get_item_rollups(self, item, resolution, since=None):
+        self.flush()
+        with self._connect() as conn:
+            return self._rollups(conn, item, resolution, since)
+
+    def _rollups(self, conn, item, resolution, since):
+        if resolution not in RESOLUTIONS:
+            raise ValueError("Unknown resolution {}".format(resolution))
+
+        if since:
+            # Include the bucket which 'since' falls in
+            width = RESOLUTIONS[resolution] * 1000000
+            since = from_epoch(to_epoch(since) // width * width - 1)
+
+        return [idiotic.history.Bucket(time, *value) for value, time in
+                self._history(conn, item, resolution, since, None)]
+
+    def query_item_history(self, item, kind="state", since=None, count=None, resolution=None):
+        if self.read_connection is None:
+            self.read_connection = self.engine.connect().execution_options(
+                compiled_cache=self.read_compiled_cache)
+
+        # Each query is its own transaction, so it sees the latest batch
+        with self.read_connection.begin():
+            if resolution is not None:
+                return self._rollups(self.read_connection, item, resolution, since)
+            return list(self._history(self.read_connection, item, kind, since, count))
+
+    def _items_by_id(self, conn, items):
+        ids = self._item_ids(conn, [item.name for item in items], add=False)
+        return {ids[item.name]: item for item in items if item.name in ids}
+
+    def get_last_states(self, items, kind="state"):
+        self.flush()
+        names, decode = KINDS[kind][1:]
+
+        with self._connect() as conn:
+            by_id = self._items_by_id(conn, items)
+            res = {}
+
+            # Newest partitions first, until every item has been found
+            for day in self._days(kind, reverse=True):
+                missing = [item_id for item_id in by_id if by_id[item_id] not in res]
+                if not missing:
+                    break
+
+                table = self.partitions[kind][day]
+                latest = select([
+                    table.c.item_id,
+                    func.max(table.c.timestamp).label('timestamp')
+                ]).where(
+                    table.c.item_id.in_(missing)
+                ).group_by(table.c.item_id).alias('latest')
+
                 stmt = select(
-                    [self.states.c.value, self.states.c.timestamp]
+                    [table.c.item_id, table.c.timestamp] + [table.c[name] for name in names]
                 ).select_from(
-                    self.states.join(
-                        self.items,
-                        self.states.c.item_id == self.items.c.id
-                    )
-                ).where(
-                    and_(self.items.c.name == item.name,
-                         self.items.c.id != None)
+                    table.join(latest, and_(
+                        table.c.item_id == latest.c.item_id,
+                        table.c.timestamp == latest.c.timestamp))
                 )
 
-                if since:
-                    stmt = stmt.where(self.states.c.timestamp > since)
+                for row in conn.execute(stmt):
+                    res[by_id[row[0]]] = (decode(*row[2:]), from_epoch(row[1]))
 
-                stmt = stmt.order_by(self.states.c.timestamp)
+            return res
 
-                if count:
-                    stmt = stmt.limit(count)
+    def get_recent_history(self, items, since, kind="state"):
+        self.flush()
+        names, decode = KINDS[kind][1:]
+        since = to_epoch(since)
+
+        with self._connect() as conn:
+            by_id = self._items_by_id(conn, items)
+            if not by_id:
+                return {}
+
+            res = {}
+            for day in self._days(kind, since):
+                table = self.partitions[kind][day]
+                stmt = select(
+                    [table.c.item_id, table.c.timestamp] + [table.c[name] for name in names]
+                ).where(and_(
+                    table.c.item_id.in_(list(by_id)),
+                    table.c.timestamp > since
+                )).order_by(table.c.item_id, table.c.timestamp)
 
                 for row in conn.execute(stmt):
-                    yield (row[0], row[1])
+                    res.setdefault(by_id[row[0]], []).append(
+                        (decode(*row[2:]), from_epoch(row[1])))
+            return res
 
-            elif kind == "command":
-                return []
+    def purge(self, items=()):
+        """Drop every partition which is older than the longest retention,
+and delete the rows of items with shorter ones from the rest. Rollups
+are kept for the "rollups" retention, and everything else for "raw".
 
-    def append_item_history(self, item, time, value, kind="state", extra=None):
-        with self.engine.connect() as conn:
-            results = conn.execute(
-                self.items.select(
-                    self.items.c.id
-                ).where(
-                    and_(self.items.c.name == item.name,
-                         self.items.c.id != None)
-                ).limit(1)
-            )
+        """
+        self.flush()
+        now = to_epoch(datetime.datetime.now())
 
-            item_id = results.scalar()
+        with self._connect() as conn, conn.begin():
+            ids = self._item_ids(conn, [item.name for item in items], add=False)
 
-            if not item_id:
-                ins = conn.execute(
-                    self.items.insert(), name=item.name
-                )
-                item_id = ins.inserted_primary_key[0]
+            dropped = deleted = 0
+            for kind in KINDS:
+                default = self.retention(None, "rollups" if kind in RESOLUTIONS else "raw")
 
-            conn.execute(
-                self.states.insert().values(
-                    item_id=item_id, timestamp=time, value=value
-                )
-            )
+                # Item ids by retention, for those which differ from the default
+                special = collections.defaultdict(list)
+                for item in items:
+                    retention = self.retention(item, "rollups" if kind in RESOLUTIONS else "raw")
+                    if item.name in ids and retention != default:
+                        special[retention].append(ids[item.name])
+
+                listed = [item_id for group in special.values() for item_id in group]
+                retentions = set(special) | {default}
+                oldest = None if None in retentions else now - int(max(retentions) * 1000000)
+
+                for day in self._days(kind):
+                    if oldest is not None and (day + PARTITION_DAYS[kind]) * DAY <= oldest:
+                        self._drop_partition(conn, kind, day)
+                        dropped += 1
+                        continue
+
+                    table = self.partitions[kind][day]
+                    for retention, group in list(special.items()) + [(default, None)]:
+                        if retention is None:
+                            continue
+
+                        cutoff = now - int(retention * 1000000)
+                        if day * DAY >= cutoff:
+                            continue
+
+                        conditions = [table.c.timestamp < cutoff]
+                        if group is not None:
+                            conditions.append(table.c.item_id.in_(group))
+                        elif listed:
+                            # The default is for everything not listed
+                            conditions.append(not_(table.c.item_id.in_(listed)))
+
+                        deleted += conn.execute(table.delete().where(and_(*conditions))).rowcount
+
+        # Some of the cached rollup rows may be gone
+        self.rollup_cache.clear()
+
+        LOG.info("Purged {} partitions and {} rows of history".format(dropped, deleted))
+
+    def _item_ids(self, conn, names, add=True):
+        """Return the ids of the items with the given names, adding any that
+are missing if 'add' is True. Ids are cached, so this only needs the
+database the first time an item is seen.
+
+        """
+        missing = [name for name in names if name not in self.item_ids]
+        if missing:
+            # Another instance may have added them
+            self.item_ids.update(conn.execute(self.select_ids.where(
+                self.items.c.name.in_(missing))).fetchall())
+
+            if add:
+                for name in missing:
+                    if name not in self.item_ids:
+                        ins = conn.execute(self.insert_item, {"name": name})
+                        self.item_ids[name] = ins.inserted_primary_key[0]
+
+        return self.item_ids
+
+    def _roll_up(self, conn, rows):
+        """Add (item id, time, number) rows to the rollups at every resolution.
+Returns the new summaries, to go in rollup_cache once they are committed.
+
+        """
+        batch = {}
+        for item_id, timestamp, value in rows:
+            for resolution, seconds in RESOLUTIONS.items():
+                width = seconds * 1000000
+                key = (resolution, item_id, timestamp - timestamp % width)
+                summary = [1, value, value, value, value, timestamp]
+                batch[key] = merge_rollup(batch[key], summary) if key in batch else summary
+
+        # Rows which are not cached may still be in the database
+        missing = collections.defaultdict(list)
+        for key in batch:
+            if key not in self.rollup_cache:
+                missing[key[0], partition_day(key[0], key[2])].append(key)
+
+        found = {}
+        for (resolution, day), keys in missing.items():
+            table = self._partition(conn, resolution, day)
+            for row in conn.execute(select(
+                    [table.c.item_id, table.c.timestamp] + [table.c[c] for c in ROLLUP_COLUMNS]
+            ).where(and_(
+                table.c.item_id.in_({key[1] for key in keys}),
+                table.c.timestamp.in_({key[2] for key in keys})
+            ))):
+                found[resolution, row[0], row[1]] = list(row[2:])
+
+        inserts = collections.defaultdict(list)
+        updates = collections.defaultdict(list)
+        merged = {}
+        for key, summary in batch.items():
+            resolution, item_id, timestamp = key
+            old = self.rollup_cache.get(key) or found.get(key)
+            partition = (resolution, partition_day(resolution, timestamp))
+
+            if old is None:
+                merged[key] = summary
+                inserts[partition].append(dict(zip(ROLLUP_COLUMNS, summary),
+                                               item_id=item_id, timestamp=timestamp))
+            else:
+                merged[key] = merge_rollup(old, summary)
+                updates[partition].append(dict(zip(ROLLUP_COLUMNS, merged[key]),
+                                               b_item_id=item_id, b_timestamp=timestamp))
+
+        for partition, values in inserts.items():
+            self._partition(conn, *partition)
+            conn.execute(self._statements(*partition)["insert"], values)
+
+        for partition, values in updates.items():
+            conn.execute(self._statements(*partition)["update"], values)
+
+        return merged
+
+    def _cache_rollups(self, merged):
+        self.rollup_cache.update(merged)
+
+        # Only the newest two buckets of each resolution are worth keeping
+        newest = {}
+        for resolution, _, timestamp in self.rollup_cache:
+            newest[resolution] = max(newest.get(resolution, timestamp), timestamp)
+
+        for key in list(self.rollup_cache):
+            if key[2] < newest[key[0]] - RESOLUTIONS[key[0]] * 1000000:
+                del self.rollup_cache[key]
+
+    def write_item_history(self, rows):
+        by_partition = collections.defaultdict(list)
+        numbers = []
+
+        known_names = set(self.item_ids)
+        self.new_partitions = []
+
+        # One transaction, and one executemany per partition, for the
+        # whole batch, rollups included
+        try:
+            with self._connect() as conn, conn.begin():
+                ids = self._item_ids(conn, {row.item.name for row in rows})
+
+                for row in rows:
+                    kind = "command" if row.kind == "command" else "state"
+                    timestamp = to_epoch(row.time)
+                    if kind == "command":
+                        values = dict(name=row.value, args=row.extra)
+                    else:
+                        values = encode_value(row.value)
+                        if values["int_value"] is not None or values["float_value"] is not None:
+                            if row.value == row.value:
+                                numbers.append((ids[row.item.name], timestamp, row.value))
+                    values.update(item_id=ids[row.item.name], timestamp=timestamp)
+                    by_partition[kind, partition_day(kind, timestamp)].append(values)
+
+                for (kind, day), values in by_partition.items():
+                    self._partition(conn, kind, day)
+                    conn.execute(self._statements(kind, day)["insert"], values)
+
+                merged = self._roll_up(conn, numbers) if numbers else {}
+        except:
+            self._forget_new(known_names)
+            raise
+        finally:
+            self.new_partitions = []
+
+        self._cache_rollups(merged)
@@ -0,0 +1,136 @@
+import asyncio
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from flask import Flask
+from werkzeug.test import EnvironBuilder
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib", "modules"))
+
+import idiotic
+from idiotic import item
+from idiotic.persistence import HistoryRow
+from idiotic.utils import _APIWrapper, IdioticEncoder
+
+import api
+import sql
+
+START = datetime.datetime(2016, 1, 1, 12, 0, 0)
+
+class APITest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.instance = idiotic.Idiotic({}, "test")
+        idiotic.instance = self.instance
+
+        self.app = Flask(__name__)
+        self.app.json_encoder = IdioticEncoder
+        self.instance.augment_module(api)
+        api.configure({}, {}, _APIWrapper(self.app, api, '/'), None)
+
+        self.item = item.Number("thermostat")
+
+    def tearDown(self):
+        self.instance._stop_persistence()
+        self.directory.cleanup()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def persist(self, **config):
+        config.setdefault("engine", "sqlite:///" + os.path.join(self.directory.name, "history.db"))
+        self.instance._start_persistence(sql.SQLPersistence.NAME, config)
+        return self.instance.persist_instance
+
+    def fetch(self, path, query_string=None):
+        """Make a request the way aiohttp.wsgi does, on the event loop,
+        waiting for any future in the body.
+
+        """
+        @asyncio.coroutine
+        def request():
+            status = []
+            environ = EnvironBuilder(path=path, query_string=query_string).get_environ()
+            body = self.app(environ, lambda s, headers, exc_info=None: status.append(s))
+            data = b''
+            try:
+                for piece in body:
+                    if isinstance(piece, asyncio.Future):
+                        piece = yield from piece
+                    # An empty piece would end a chunked response
+                    self.assertTrue(piece)
+                    data += piece
+            finally:
+                body.close()
+            return status[0], data.decode('UTF-8')
+
+        return self.loop.run_until_complete(asyncio.wait_for(request(), 30))
+
+    def test_export_while_writes_are_queued(self):
+        # Reads wait behind writes when there is no read connection
+        persistence = self.persist(read_connection=False)
+        rows = [HistoryRow(self.item, START + datetime.timedelta(seconds=i), float(i), "state", None)
+                for i in range(2500)]
+        persistence.call(persistence.engine.write_item_history, rows)
+
+        # Hold up the writer until the event loop lets it go
+        gate = threading.Event()
+        held = persistence.submit(gate.wait, 10)
+        for i in range(10):
+            persistence.append_nowait(self.item, START + datetime.timedelta(hours=1, seconds=i), -1.0)
+        self.loop.call_later(0.1, gate.set)
+
+        status, body = self.fetch("/api/item/thermostat/history/export", {"format": "csv"})
+        self.assertTrue(status.startswith("200"))
+        self.assertTrue(held.result())
+
+        lines = body.splitlines()
+        self.assertEqual(lines[0], "time,value")
+        self.assertEqual(len(lines), 1 + 2500 + 10)
+        self.assertEqual(float(lines[2500].split(",")[1]), 2499.0)
+
+    def test_rollups_while_writes_are_queued(self):
+        persistence = self.persist(read_connection=False)
+        rows = [HistoryRow(self.item, START + datetime.timedelta(seconds=i), float(i % 60), "state", None)
+                for i in range(600)]
+        persistence.call(persistence.engine.write_item_history, rows)
+
+        gate = threading.Event()
+        held = persistence.submit(gate.wait, 10)
+        self.loop.call_later(0.1, gate.set)
+
+        status, body = self.fetch("/api/item/thermostat/history",
+                                  {"resolution": "minute", "since": str(START.timestamp())})
+        self.assertTrue(held.result())
+
+        res = json.loads(body)
+        self.assertEqual(res["status"], "success")
+        self.assertEqual(len(res["result"]), 10)
+        self.assertEqual(res["result"][0][1:5], [0, 59, 29.5, 60])
+
+    def test_empty_export(self):
+        self.persist()
+        status, body = self.fetch("/api/item/thermostat/history/export", {"format": "csv"})
+        self.assertEqual(body.splitlines(), ["time,value"])
+        status, body = self.fetch("/api/item/thermostat/history/export")
+        self.assertEqual(body.strip(), "")
+
+    def test_item_info(self):
+        with self.app.test_request_context():
+            self.assertIsNone(json.loads(api.item_info().get_data(as_text=True))["result"])
+
+        status, body = self.fetch("/api/item/thermostat")
+        self.assertEqual(json.loads(body)["result"]["name"], "thermostat")
+
+        client = self.app.test_client()
+        etag = client.get("/api/item/thermostat").headers["ETag"]
+        self.assertEqual(client.get("/api/item/thermostat", headers={"If-None-Match": etag}).status_code, 304)
+        self.item.state = 21
+        self.assertEqual(client.get("/api/item/thermostat", headers={"If-None-Match": etag}).status_code, 200)
@@ -0,0 +1,173 @@
+import datetime
+import os
+import random
+import tempfile
+import unittest
+
+from idiotic import history
+
+NOW = datetime.datetime(2016, 1, 1, 12, 0, 0)
+
+def ago(seconds):
+    return NOW - datetime.timedelta(seconds=seconds)
+
+class MixedStatesTest(unittest.TestCase):
+    """States that aren't numbers are skipped by the aggregations, with
+    NumPy or without it.
+
+    """
+    def setUp(self):
+        self.numpy = history.numpy
+
+    def tearDown(self):
+        history.numpy = self.numpy
+
+    def _history(self):
+        h = history.History()
+        h.record(1, ago(30))
+        h.record("unavailable", ago(20))
+        h.record(3, ago(10))
+        return h
+
+    def _check(self):
+        h = self._history()
+        self.assertEqual(h.integral(time=ago(30), until=NOW), 40)
+        self.assertEqual(h.mean(time=ago(30), until=NOW), 2)
+        self.assertEqual(h.minimum(time=ago(30), until=NOW), 1)
+        self.assertEqual(h.maximum(time=ago(30), until=NOW), 3)
+        self.assertEqual(h.duration_in_state("unavailable", time=ago(30), until=NOW), 10)
+
+    @unittest.skipIf(history.numpy is None, "NumPy is not installed")
+    def test_numpy(self):
+        self._check()
+
+    def test_pure_python(self):
+        history.numpy = None
+        self._check()
+
+class BlockCodecTest(unittest.TestCase):
+    def round_trip(self, keys, states, typecode):
+        data = history._encode_block(keys, states, typecode)
+        decoded_keys, decoded_states = history._decode_block(data, typecode)
+        self.assertEqual(list(decoded_keys), list(keys))
+        self.assertEqual(len(decoded_states), len(states))
+        for decoded, state in zip(decoded_states, states):
+            if state != state:
+                self.assertNotEqual(decoded, decoded)
+            else:
+                self.assertEqual(decoded, state)
+        return data
+
+    def test_single(self):
+        self.round_trip([1451649600000000], [21.5], 'd')
+        self.round_trip([0], [-1], 'q')
+
+    def test_steady(self):
+        keys = [1451649600000000 + i * 10000000 for i in range(256)]
+        data = self.round_trip(keys, [20.0] * 256, 'd')
+        # A bit for each time and each state, after the first two
+        self.assertLessEqual(len(data), history._BLOCK_HEADER.size + (2 * 254 + 7) // 8 + 1)
+
+    def test_delta_widths(self):
+        # Jitter of every size, up to deltas which need all 64 bits
+        gaps = [1, 10, 100, 5000, 1000000, 2 ** 30, 2 ** 40, 1, 2 ** 62, 3, 7]
+        keys = [0]
+        for gap in gaps:
+            keys.append(keys[-1] + gap)
+        self.round_trip(keys, [float(i) for i in range(len(keys))], 'd')
+        self.round_trip([-key for key in reversed(keys)], list(range(len(keys))), 'q')
+
+    def test_floats(self):
+        states = [0.0, -0.0, 1.0, 1.5, -1e300, 1e-300, float('inf'), float('-inf'),
+                  float('nan'), 20.1, 20.2, 20.2, 20.15, 5e-324]
+        self.round_trip(list(range(len(states))), states, 'd')
+
+    def test_ints(self):
+        states = [0, 1, -1, 2 ** 63 - 1, history.NULL_INT, 42, 42, 43, -2 ** 31, 2 ** 31]
+        self.round_trip(list(range(0, 1000 * len(states), 1000)), states, 'q')
+
+    def test_random(self):
+        rng = random.Random(35)
+        for typecode in ('d', 'q'):
+            for count in (2, 3, 17, 500):
+                keys = [rng.randrange(2 ** 50)]
+                for _ in range(count - 1):
+                    keys.append(keys[-1] + rng.choice((1, 1000000, rng.randrange(2 ** 40))))
+                if typecode == 'd':
+                    states = [rng.choice((rng.random(), round(rng.gauss(20, 2), 1), 0.0))
+                              for _ in range(count)]
+                else:
+                    states = [rng.randrange(-2 ** 63, 2 ** 63) for _ in range(count)]
+                self.round_trip(keys, states, typecode)
+
+class CompressedHistoryTest(unittest.TestCase):
+    def test_matches_history(self):
+        plain = history.NumericHistory()
+        compressed = history.CompressedHistory(block_size=16)
+        for i in range(200):
+            when = ago(1000 - i * 5 - (i % 3))
+            plain.record(float(i % 7) / 3, when)
+            compressed.record(float(i % 7) / 3, when)
+
+        self.assertEqual([(e.time, e.state) for e in compressed.all()],
+                         [(e.time, e.state) for e in plain.all()])
+        for start in (ago(1000), ago(512), ago(3)):
+            self.assertEqual([e.state for e in compressed.since(start)],
+                             [e.state for e in plain.since(start)])
+            self.assertAlmostEqual(compressed.mean(time=start, until=NOW),
+                                   plain.mean(time=start, until=NOW))
+
+class MMapHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "thermostat.hist")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_reopen(self):
+        h = history.MMapHistory(self.path, capacity=100)
+        for i in range(50):
+            h.record(float(i), ago(100 - i))
+        h.close()
+
+        h = history.MMapHistory(self.path)
+        self.assertEqual(len(h), 50)
+        self.assertEqual([e.state for e in h.all()], [float(i) for i in range(50)])
+        self.assertEqual(h.all()[0].time, ago(100))
+        h.record(50.0, ago(50))
+        self.assertEqual(h.last().state, 50.0)
+        h.close()
+
+    def test_ring(self):
+        h = history.MMapHistory(self.path, capacity=16)
+        for i in range(40):
+            h.record(float(i), ago(100 - i))
+
+        # Only the newest entries are kept, wrapped around the file
+        self.assertEqual([e.state for e in h.all()], [float(i) for i in range(24, 40)])
+        self.assertEqual(h.maximum(time=ago(100), until=ago(60)), 39.0)
+        self.assertEqual(h.mean(time=ago(76), until=ago(74)), 24.5)
+
+        # An entry which is a little late goes in its place
+        h.record(99.0, ago(65.5))
+        self.assertEqual([e.state for e in h.since(ago(67))],
+                         [39.0, 38.0, 37.0, 36.0, 35.0, 99.0, 34.0])
+        self.assertEqual(len(h), 16)
+        h.close()
+
+        h = history.MMapHistory(self.path, capacity=32)
+        self.assertEqual(h.capacity, 16)
+        self.assertEqual(h.all()[-1].state, 39.0)
+        h.close()
+
+    def test_wrong_file(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 128)
+        with self.assertRaises(ValueError):
+            history.MMapHistory(self.path)
+
+        os.remove(self.path)
+        history.MMapHistory(self.path, kind=int).close()
+        with self.assertRaises(ValueError):
+            history.MMapHistory(self.path, kind=float)
@@ -0,0 +1,180 @@
+import collections
+import datetime
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib", "modules"))
+
+import logstore
+from idiotic.persistence import HistoryRow
+
+Item = collections.namedtuple("Item", "name")
+
+START = datetime.datetime(2016, 1, 1, 12, 0, 0)
+
+def rows(item, first, count):
+    return [HistoryRow(item, START + datetime.timedelta(seconds=i), float(i), "state", None)
+            for i in range(first, first + count)]
+
+class LogStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.item = Item("thermostat")
+        self.store = self.open()
+
+    def tearDown(self):
+        if self.store.file is not None:
+            self.store.disconnect()
+        self.directory.cleanup()
+
+    def open(self, **config):
+        config.setdefault("snapshot_interval", 3600)
+        store = logstore.LogPersistence(dict(config, path=self.directory.name))
+        store.connect()
+        return store
+
+    def reopen(self, **config):
+        self.store.disconnect()
+        self.store = self.open(**config)
+
+    def crash(self):
+        """Stop the store without writing anything more, as a crash would."""
+        self.store.stopping = True
+        self.store.wakeup.set()
+        self.store.compactor.join()
+        self.store.file.close()
+        self.store.file = None
+
+    def active_path(self):
+        return self.store.active.path
+
+    def history(self):
+        return [value for value, _ in self.store.get_item_history(self.item)]
+
+    def test_round_trip(self):
+        self.store.write_item_history(rows(self.item, 0, 10))
+        self.reopen()
+        self.assertEqual(self.history(), [float(i) for i in range(10)])
+        value, when = self.store.get_last_states([self.item])[self.item]
+        self.assertEqual((value, when), (9.0, START + datetime.timedelta(seconds=9)))
+
+    def test_failed_batch(self):
+        self.store.write_item_history(rows(self.item, 0, 10))
+
+        # Only half of the batch reaches the file
+        append = self.store._append
+        def fail(data):
+            append(data[:len(data) // 2])
+            raise OSError("disk full")
+        self.store._append = fail
+        with self.assertRaises(OSError):
+            self.store.write_item_history(rows(self.item, 10, 10))
+        del self.store._append
+
+        self.assertEqual(self.store.get_last_states([self.item])[self.item][0], 9.0)
+
+        # Retrying the batch must not leave any of it written twice
+        self.store.write_item_history(rows(self.item, 10, 10))
+        self.assertEqual(self.history(), [float(i) for i in range(20)])
+        self.reopen()
+        self.assertEqual(self.history(), [float(i) for i in range(20)])
+
+    def test_failed_batch_after_roll(self):
+        self.reopen(segment_size=64)
+        self.store.write_item_history(rows(self.item, 0, 10))
+
+        def fail(data):
+            raise OSError("disk full")
+        self.store._append = fail
+        with self.assertRaises(OSError):
+            self.store.write_item_history(rows(self.item, 10, 10))
+        del self.store._append
+
+        self.store.write_item_history(rows(self.item, 10, 10))
+        self.assertEqual(len(self.store.segments), 2)
+        self.reopen(segment_size=64)
+        self.assertEqual(self.history(), [float(i) for i in range(20)])
+
+    def test_torn_write(self):
+        self.store.write_item_history(rows(self.item, 0, 10))
+        path, size = self.active_path(), self.store.active.size
+        self.crash()
+
+        # Half of the next batch was written when the power went
+        record = logstore.Segment(self.directory.name, "x").encode(
+            "state", self.item.name, logstore.to_epoch(START), 10.0)
+        with open(path, "ab") as f:
+            f.write(record[:len(record) // 2])
+
+        self.store = self.open()
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(self.history(), [float(i) for i in range(10)])
+
+        self.store.write_item_history(rows(self.item, 10, 5))
+        self.reopen()
+        self.assertEqual(self.history(), [float(i) for i in range(15)])
+
+    def test_corrupt_record(self):
+        self.store.write_item_history(rows(self.item, 0, 10))
+        self.store.write_item_history(rows(self.item, 10, 1))
+        path, size = self.active_path(), self.store.active.size
+        self.crash()
+
+        # Damage the last record, so that it fails its CRC
+        with open(path, "r+b") as f:
+            f.seek(size - 1)
+            last = f.read(1)
+            f.seek(size - 1)
+            f.write(bytes((last[0] ^ 0xff,)))
+
+        self.store = self.open()
+        self.assertEqual(self.history(), [float(i) for i in range(10)])
+        self.assertLess(os.path.getsize(path), size)
+
+    def test_latest_without_snapshot(self):
+        self.store.write_item_history(rows(self.item, 0, 10))
+        self.store.snapshot()
+        self.store.write_item_history(rows(self.item, 10, 10))
+        self.crash()
+
+        # The snapshot is older than the last batch, which is replayed
+        self.store = self.open()
+        value, when = self.store.get_last_states([self.item])[self.item]
+        self.assertEqual((value, when), (19.0, START + datetime.timedelta(seconds=19)))
+
+    def test_sealed_segments(self):
+        self.reopen(segment_size=256)
+        for first in range(0, 100, 10):
+            self.store.write_item_history(rows(self.item, first, 10))
+        self.assertGreater(len(self.store.segments), 2)
+        sealed = self.store.segments[0]
+        self.crash()
+
+        # The end of a sealed segment was lost after its index was
+        # written, so the index no longer matches it
+        with open(sealed.path, "r+b") as f:
+            f.truncate(sealed.size - 3)
+        lost = sealed.count
+
+        self.store = self.open(segment_size=256)
+        self.assertEqual(self.store.segments[0].count, lost - 1)
+        self.assertEqual(self.history(), [float(i) for i in range(100) if i != lost - 1])
+
+    def test_stray_files(self):
+        self.store.write_item_history(rows(self.item, 0, 10))
+        self.crash()
+
+        # Left behind by a compaction which was interrupted
+        stray = logstore.Segment.create(self.directory.name, 0, 1)
+        with open(stray.path, "wb") as f:
+            f.write(b"partial")
+        with open(os.path.join(self.directory.name, logstore.MANIFEST + ".tmp"), "wb") as f:
+            f.write(b"partial")
+
+        self.store = self.open()
+        self.assertFalse(os.path.exists(stray.path))
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name,
+                                                     logstore.MANIFEST + ".tmp")))
+        self.assertEqual(self.history(), [float(i) for i in range(10)])
@@ -0,0 +1,31 @@
+import collections
+import unittest
+
+from idiotic import persistence
+
+Item = collections.namedtuple("Item", "name tags")
+
+class RetentionTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = persistence.Persistence({"retention": {
+            "raw": "7d",
+            "items": {"porch_light": {"raw": "1d"}},
+            "tags": {"Climate": {"raw": "30d"}, "archive": {"raw": None}},
+        }})
+
+    def test_default(self):
+        self.assertEqual(self.engine.retention(Item("door", set()), "raw"), 7 * 86400)
+        self.assertEqual(self.engine.retention(None, "raw"), 7 * 86400)
+
+    def test_item(self):
+        item = Item("porch_light", {"climate"})
+        self.assertEqual(self.engine.retention(item, "raw"), 86400)
+
+    def test_tags_ignore_case(self):
+        for tags in ({"climate"}, {"Climate"}, {"CLIMATE"}):
+            self.assertEqual(self.engine.retention(Item("thermostat", tags), "raw"),
+                             30 * 86400)
+
+    def test_forever_wins(self):
+        item = Item("thermostat", {"Climate", "Archive"})
+        self.assertIsNone(self.engine.retention(item, "raw"))
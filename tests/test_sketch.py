@@ -0,0 +1,81 @@
+import random
+import unittest
+
+from idiotic import sketch
+
+class KLLTest(unittest.TestCase):
+    def test_quantiles(self):
+        values = list(range(100000))
+        random.Random(36).shuffle(values)
+        kll = sketch.KLL()
+        for value in values:
+            kll.update(value)
+
+        self.assertEqual(kll.count, 100000)
+        self.assertEqual(kll.quantiles((0, 1)), [0, 99999])
+        for q in (.01, .25, .5, .75, .99):
+            self.assertAlmostEqual(kll.quantile(q) / 100000, q, delta=.02)
+            self.assertAlmostEqual(kll.rank(q * 100000), q, delta=.02)
+
+        # Only a small sample of the values is kept
+        self.assertLess(sum(len(c) for c in kll.compactors), 2000)
+
+    def test_merge(self):
+        rng = random.Random(36)
+        whole, parts = sketch.KLL(), [sketch.KLL() for _ in range(4)]
+        for i in range(40000):
+            value = rng.gauss(20, 5)
+            whole.update(value)
+            parts[i % 4].update(value)
+
+        merged = sketch.KLL()
+        for part in parts:
+            merged.merge(part)
+        self.assertEqual(merged.count, whole.count)
+        self.assertEqual((merged.min, merged.max), (whole.min, whole.max))
+        self.assertAlmostEqual(merged.quantile(.5), 20, delta=.5)
+
+    def test_empty(self):
+        self.assertEqual(sketch.KLL().quantiles((0, .5)), [None, None])
+        self.assertIsNone(sketch.KLL().rank(1))
+
+class HyperLogLogTest(unittest.TestCase):
+    def test_distinct(self):
+        hll = sketch.HyperLogLog()
+        for i in range(50000):
+            hll.update("sensor-{}".format(i % 20000))
+        self.assertEqual(hll.count, 50000)
+        self.assertAlmostEqual(hll.distinct() / 20000, 1, delta=.1)
+
+    def test_small(self):
+        hll = sketch.HyperLogLog()
+        for state in ["on", "off", "on", None, 1, 1.0, "on"] * 10:
+            hll.update(state)
+        # 1 and 1.0 are told apart by their repr
+        self.assertEqual(hll.distinct(), 5)
+
+    def test_merge(self):
+        a, b = sketch.HyperLogLog(), sketch.HyperLogLog()
+        for i in range(3000):
+            a.update(i)
+            b.update(i + 1500)
+        a.merge(b)
+        self.assertAlmostEqual(a.distinct() / 4500, 1, delta=.1)
+        with self.assertRaises(ValueError):
+            a.merge(sketch.HyperLogLog(p=12))
+
+class WindowedTest(unittest.TestCase):
+    def test_bad_options(self):
+        with self.assertRaises(TypeError):
+            sketch.windowed("distinct", k=100)
+        with self.assertRaises(ValueError):
+            sketch.windowed("median")
+
+    def test_window(self):
+        s = sketch.windowed("quantiles", window=60, panes=6)
+        for i in range(100):
+            s.update(i, now=1000)
+        for i in range(100, 200):
+            s.update(i, now=1070)
+        # The first hundred values have left the window
+        self.assertGreaterEqual(s.sketch(now=1070).quantile(0), 100)
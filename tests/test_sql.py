@@ -0,0 +1,145 @@
+import collections
+import datetime
+import os
+import sys
+import tempfile
+import unittest
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, PickleType, ForeignKey, create_engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib", "modules"))
+
+import sql
+from idiotic.persistence import HistoryRow
+
+Item = collections.namedtuple("Item", "name")
+
+START = datetime.datetime(2016, 1, 1, 12, 0, 0)
+
+def rows(item, first, count, value=float):
+    return [HistoryRow(item, START + datetime.timedelta(seconds=i), value(i), "state", None)
+            for i in range(first, first + count)]
+
+class SQLTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = "sqlite:///" + os.path.join(self.directory.name, "history.db")
+        self.item = Item("thermostat")
+        self.store = None
+
+    def tearDown(self):
+        if self.store is not None:
+            self.store.disconnect()
+            self.store.engine.dispose()
+        self.directory.cleanup()
+
+    def open(self):
+        if self.store is not None:
+            self.store.disconnect()
+            self.store.engine.dispose()
+        self.store = sql.SQLPersistence({"engine": self.url})
+        self.store.connect()
+        return self.store
+
+    def history(self, item=None):
+        return [value for value, _ in self.store.get_item_history(item or self.item)]
+
+    def test_round_trip(self):
+        self.open().write_item_history(rows(self.item, 0, 10) + rows(Item("door"), 0, 3, str))
+        self.open()
+        self.assertEqual(self.history(), [float(i) for i in range(10)])
+        self.assertEqual(self.history(Item("door")), ["0", "1", "2"])
+
+    def test_rolled_back(self):
+        store = self.open()
+        day = sql.partition_day("state", sql.to_epoch(START))
+
+        def fail(conn, numbers):
+            raise RuntimeError("interrupted")
+        store._roll_up = fail
+        with self.assertRaises(RuntimeError):
+            store.write_item_history(rows(self.item, 0, 10))
+        del store._roll_up
+
+        # Neither the partition nor the item's id outlived the rollback
+        self.assertNotIn(day, store.partitions["state"])
+        self.assertNotIn(self.item.name, store.item_ids)
+
+        store.write_item_history(rows(self.item, 0, 10))
+        self.assertEqual(self.history(), [float(i) for i in range(10)])
+
+    def test_cache(self):
+        store = self.open()
+        store.write_item_history(rows(self.item, 0, 3600))
+        end = START + datetime.timedelta(hours=1)
+
+        # A dashboard showing the last half hour, as time goes by
+        for seconds in range(0, 600, 10):
+            since = end - datetime.timedelta(minutes=30) + datetime.timedelta(seconds=seconds)
+            self.assertEqual(store.read_item_history(self.item, since=since),
+                             list(store.get_item_history(self.item, since=since)))
+            self.assertEqual(store.read_item_history(self.item, since=since, resolution="minute"),
+                             store.get_item_rollups(self.item, "minute", since=since))
+
+        stats = store.cache_stats()
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hits"], 118)
+
+        # Changing the item drops what was cached
+        store.append_item_history(self.item, end, 1.0)
+        since = end - datetime.timedelta(minutes=1)
+        self.assertEqual(len(store.read_item_history(self.item, since=since)), 60)
+        self.assertEqual(store.cache_stats()["misses"], 3)
+
+    def test_upgrade_from_version_1(self):
+        # The schema before versions were recorded
+        engine = create_engine(self.url)
+        metadata = MetaData()
+        items = Table('items', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('name', String(128), unique=True))
+        states = Table('states', metadata,
+                       Column('item_id', None, ForeignKey('items.id')),
+                       Column('timestamp', DateTime),
+                       Column('value', PickleType))
+        commands = Table('commands', metadata,
+                         Column('item_id', None, ForeignKey('items.id')),
+                         Column('timestamp', DateTime),
+                         Column('name', String(128)),
+                         Column('args', PickleType))
+        metadata.create_all(engine)
+
+        values = [float(i % 10) for i in range(100)] + [3, "on", None, True]
+        with engine.begin() as conn:
+            conn.execute(items.insert(), [{"id": 1, "name": self.item.name}, {"id": 2, "name": "door"}])
+            conn.execute(states.insert(), [
+                {"item_id": 1, "timestamp": START + datetime.timedelta(minutes=i), "value": value}
+                for i, value in enumerate(values)])
+            # Rows version 1 could leave without an item or time
+            conn.execute(states.insert(), [{"item_id": None, "timestamp": START, "value": 1.0},
+                                           {"item_id": 1, "timestamp": None, "value": 1.0}])
+            conn.execute(commands.insert(), [
+                {"item_id": 2, "timestamp": START + datetime.timedelta(days=i),
+                 "name": "open" if i % 2 else "close", "args": {"by": "test"}}
+                for i in range(3)])
+        engine.dispose()
+
+        store = self.open()
+        self.assertEqual(store.version(), sql.VERSION)
+        self.assertEqual(self.history(), values)
+        self.assertEqual(self.history(Item("door")), [])
+        self.assertEqual([value for value, _ in store.get_item_history(Item("door"), kind="command")],
+                         ["close", "open", "close"])
+
+        # Partitioned by day, with rollups built from the numbers
+        self.assertEqual(sorted(store.partitions["command"]),
+                         [sql.partition_day("command", sql.to_epoch(START)) + i for i in range(3)])
+        # Only numbers are rolled up, so not True, "on" or None
+        buckets = store.get_item_rollups(self.item, "hour")
+        self.assertEqual([b.count for b in buckets], [60, 41])
+        self.assertEqual(buckets[0].max, 9.0)
+
+        # And it is written to as usual afterwards
+        store.write_item_history(rows(self.item, 7200, 1))
+        self.open()
+        self.assertEqual(self.history()[-1], 7200.0)